@@ -163,7 +163,7 @@ def optimal_selection(dbfile):
     from copy import copy
 
     # 1. connect to db
-    dbh = DBHandler('sqlite:///'+ dbfile)
+    dbh = DBHandler.for_url('sqlite:///'+ dbfile)
     s_date = copy(START_DATE)
 
     # 1.5 generate dataframe for opportunities
@@ -204,13 +204,11 @@ def optimal_selection(dbfile):
 
 def main():
     from util import compute_fitness, filling
-    from shutil import copyfile,rmtree
     import time
     start = time.clock()
 
-    ### COPY THE DATABASE TEMPLATE
-    rmtree(dbfile, ignore_errors = True)
-    copyfile(dbfile_template, dbfile)
+    ### LOAD THE DATABASE TEMPLATE INTO MEMORY
+    dbh = DBHandler.open_in_memory(dbfile_template, 'sqlite:///'+ dbfile)
 
     ### BASELINE GENERATION
     baselines = optimal_selection(dbfile)
@@ -234,6 +232,9 @@ def main():
     fitness = compute_fitness(schedules)
     fitness.to_pickle('fitness.pkl')
 
+    ### WRITE THE RESULTS TO THE DATABASE FILE
+    dbh.flush_to(dbfile)
+
     import pdb; pdb.set_trace()
 
 if __name__ == '__main__':
@@ -39,7 +39,7 @@ class KTIBruggCables:
     def get_opportunities(self):
         from BruggCablesKTI.db.pandas_utils import get_opportunities_as_df
 
-        dbh = DBHandler('sqlite:///'+ self.dbfile)
+        dbh = DBHandler.for_url('sqlite:///'+ self.dbfile)
 
         return get_opportunities_as_df(dbh)
 
@@ -48,7 +48,7 @@ class KTIBruggCables:
     def get_batches(self):
         from BruggCablesKTI.db.pandas_utils import get_batches_as_df
 
-        dbh = DBHandler('sqlite:///'+ self.dbfile)
+        dbh = DBHandler.for_url('sqlite:///'+ self.dbfile)
 
         return get_batches_as_df(dbh)
 
@@ -427,7 +427,7 @@ class KTIBruggCables:
         from BruggCablesKTI.db.pandas_utils import get_batches_as_df
 
         # 1. connect to db
-        dbh = DBHandler('sqlite:///'+ self.dbfile)
+        dbh = DBHandler.for_url('sqlite:///'+ self.dbfile)
         s_date = copy(self.start_date)
 
         # 1.5 generate dataframe for opportunities
@@ -0,0 +1,95 @@
+'''
+Module storing sets of batches as compressed bitmaps.
+
+Every batch has a stable ``ordinal`` (see
+:class:`BruggCablesKTI.db.model.Batch`), a set of batches is the bitmap with
+the bit of each member ordinal set. The packed bits are zlib compressed, so
+candidate schedules sharing most of their batches cost a few bytes each and
+can be compared without touching the batches table.
+
+'''
+
+import zlib
+import hashlib
+
+import numpy as np
+
+
+def encode(ordinals):
+    ''' Encodes a set of batch ordinals as a compressed bitmap.
+
+    Arguments
+    ---------
+    ordinals : iterable of int
+
+    Returns
+    -------
+    blob : bytes
+    '''
+    ordinals = np.asarray(list(ordinals), dtype=np.int64)
+    bits = np.zeros(ordinals.max() + 1 if len(ordinals) else 0, dtype=bool)
+    bits[ordinals] = True
+    return zlib.compress(np.packbits(bits, bitorder='little').tobytes())
+
+
+def digest(ordinals):
+    ''' The content hash of a set of batch ordinals, the same for every
+    order and repetition of the ordinals.
+
+    Returns
+    -------
+    digest : string, 40 hexadecimal digits
+    '''
+    ordinals = np.unique(np.asarray(list(ordinals), dtype=np.int64))
+    return hashlib.sha1(ordinals.astype('<i8').tobytes()).hexdigest()
+
+
+def packed(blob):
+    ''' The packed bits of a bitmap, one uint8 per 8 ordinals.
+    '''
+    return np.frombuffer(zlib.decompress(blob), dtype=np.uint8)
+
+
+def decode(blob):
+    ''' The sorted batch ordinals of a bitmap.
+
+    Arguments
+    ---------
+    blob : bytes, as returned by :func:`encode`
+
+    Returns
+    -------
+    ordinals : numpy.ndarray of int64
+    '''
+    bits = np.unpackbits(packed(blob), bitorder='little')
+    return np.flatnonzero(bits).astype(np.int64)
+
+
+def count(blob):
+    ''' The number of batches in a bitmap.
+    '''
+    return int(np.unpackbits(packed(blob)).sum())
+
+
+def _aligned(blob_a, blob_b):
+    bits_a, bits_b = packed(blob_a), packed(blob_b)
+    size = max(len(bits_a), len(bits_b))
+    return (np.pad(bits_a, (0, size - len(bits_a))),
+            np.pad(bits_b, (0, size - len(bits_b))))
+
+
+def common(blob_a, blob_b):
+    ''' The number of batches two bitmaps have in common.
+    '''
+    bits_a, bits_b = _aligned(blob_a, blob_b)
+    return int(np.unpackbits(bits_a & bits_b).sum())
+
+
+def similarity(blob_a, blob_b):
+    ''' The Jaccard similarity of two bitmaps, 1. for two empty sets.
+    '''
+    bits_a, bits_b = _aligned(blob_a, blob_b)
+    union = int(np.unpackbits(bits_a | bits_b).sum())
+    if union == 0:
+        return 1.
+    return int(np.unpackbits(bits_a & bits_b).sum()) / union
@@ -24,11 +24,14 @@ def import_opportunities_from_xlsx(xlsx_file, dbfile):
 
     db_url = 'sqlite:///'+dbfile
     logger.debug('Creating Handler for db at '+db_url)
-    dbh = model.DBHandler(db_url)
+    dbh = model.DBHandler(db_url, performance_profile='bulk_load')
 
     logger.debug('reading excel file : ' + xlsx_file)
     df = pd.read_excel(xlsx_file)
 
+    opp_records = []
+    cable_records = []
+
     for record in df.to_dict(orient='records'):
 
         try:
@@ -114,7 +117,8 @@ def import_opportunities_from_xlsx(xlsx_file, dbfile):
         joppattrs = opp_attrs.copy()
         joppattrs['delivery_date'] = str(joppattrs['delivery_date'])
         logger.debug('update or add opportunity: ' + json.dumps(joppattrs))
-        opp = dbh.update_or_create_opportunity(opp_id, **opp_attrs)
+        opp_attrs['brugg_cables_id'] = opp_id
+        opp_records.append(opp_attrs)
 
         cable1_attrs = {
                 'kind': cable_type,
@@ -122,11 +126,10 @@ def import_opportunities_from_xlsx(xlsx_file, dbfile):
                 'area': area,
                 'length': length,
                 'production_line': production_line,
-                'opportunity_pk': opp.pk,
                 }
 
         logger.debug('update or add cable: ' + json.dumps(cable1_attrs))
-        dbh.add_cable(**cable1_attrs)
+        cable_records.append((len(opp_records)-1, cable1_attrs))
 
         cable2_attrs = {
                 'kind': cable_type2,
@@ -134,21 +137,25 @@ def import_opportunities_from_xlsx(xlsx_file, dbfile):
                 'area': area2,
                 'length': length2,
                 'production_line': production_line,
-                'opportunity_pk': opp.pk,
                 }
 
         if cable2_attrs['kind'] not in ['', None]:
             logger.debug('update or add cable: ' + json.dumps(cable2_attrs))
-            dbh.add_cable(**cable2_attrs)
+            cable_records.append((len(opp_records)-1, cable2_attrs))
+
+    _write_opportunities_and_cables(dbh, opp_records, cable_records)
 
 
 def import_projects_from_xlsx(xlsx_file, dbfile):
 
     db_url = 'sqlite:///'+dbfile
-    dbh = model.DBHandler(db_url)
+    dbh = model.DBHandler(db_url, performance_profile='bulk_load')
 
     df = pd.read_excel(xlsx_file)
 
+    opp_records = []
+    cable_records = []
+
     for record in df.to_dict(orient='records'):
 
         try:
@@ -243,7 +250,8 @@ def import_projects_from_xlsx(xlsx_file, dbfile):
                 'kind': kind ,
                 }
 
-        opp = dbh.update_or_create_opportunity(opp_id, **opp_attrs)
+        opp_attrs['brugg_cables_id'] = opp_id
+        opp_records.append(opp_attrs)
 
         cable1_attrs = {
                 'kind': cable_type,
@@ -251,10 +259,9 @@ def import_projects_from_xlsx(xlsx_file, dbfile):
                 'area': area,
                 'length': length,
                 'production_line': production_line,
-                'opportunity': opp,
                 }
 
-        dbh.update_or_create_cable(None, **cable1_attrs)
+        cable_records.append((len(opp_records)-1, cable1_attrs))
 
         cable2_attrs = {
                 'kind': cable_type2,
@@ -262,23 +269,69 @@ def import_projects_from_xlsx(xlsx_file, dbfile):
                 'area': area2,
                 'length': length2,
                 'production_line': production_line,
-                'opportunity': opp,
                 }
 
         if cable2_attrs['kind'] not in ['', None]:
-            dbh.update_or_create_cable(None, **cable2_attrs)
+            cable_records.append((len(opp_records)-1, cable2_attrs))
+
+    _write_opportunities_and_cables(dbh, opp_records, cable_records)
+
+
+def _write_opportunities_and_cables(dbh, opp_records, cable_records):
+    ''' Bulk writes the opportunities and their cables to the db.
+
+    Arguments
+    ---------
+    dbh : a database handler
+    opp_records : list of opportunity attribute dictionaries
+    cable_records : list of tuples (index into opp_records, cable attributes)
+    '''
+    opp_pks = dbh.bulk_upsert_opportunities(opp_records)
+    for opp_idx, cable_attrs in cable_records:
+        cable_attrs['opportunity_pk'] = opp_pks[opp_idx]
+    dbh.bulk_upsert_cables([attrs for (idx, attrs) in cable_records])
 
 
-def generate_batches(dbfile, projects_xlsx_file):
+def generate_batches(dbfile, projects_xlsx_file, since=None):
     ''' Generates and persists the batches to be produced to the db.
+
+    Arguments
+    ---------
+    dbfile : the path to the database file
+    projects_xlsx_file : the path to the projects excel file
+    since : (defaults to None : all cables) only regenerate the batches of
+        the cables which changed, or whose opportunity changed, after this
+        data version, see DBHandler.changed_since()
+
+    Returns
+    -------
+    version : the data version after the batches are written
     '''
 
     df = pd.read_excel(projects_xlsx_file)
 
     db_url = 'sqlite:///'+dbfile
-    dbh = model.DBHandler(db_url)
+    dbh = model.DBHandler(db_url, performance_profile='bulk_load')
+
+    if since is not None:
+        changed = dbh.changed_since(since)['changed']
+        changed_cables = set(changed['cables'])
+        changed_opportunities = set(changed['opportunities'])
+        logger.info('Regenerating the batches of {} cables and {} '
+                'opportunities changed since version {}'.format(
+                    len(changed_cables), len(changed_opportunities), since))
+
+    batch_records = []
+    # the number of batches generated per regenerated cable
+    batch_counts = {}
+
+    for cable in dbh.cables_with(opportunity=True):
 
-    for cable in dbh.cables:
+        if since is not None and cable.pk not in changed_cables \
+                and cable.opportunity_pk not in changed_opportunities:
+            continue
+
+        batch_counts[cable.pk] = 0
 
         if cable.opportunity.kind == 'offer':
 
@@ -321,10 +374,17 @@ def generate_batches(dbfile, projects_xlsx_file):
             elif cable.opportunity.kind == 'internal':
                 potential_type = 'internal'
 
-            dbh.update_or_create_batch(
-                    cable_pk=cable.pk,
-                    number=idx,
-                    delivery_date=delivery_date,
-                    workload=batch,
-                    potential_type=potential_type,
-                    )
+            batch_records.append({
+                    'cable_pk': cable.pk,
+                    'number': idx,
+                    'delivery_date': delivery_date,
+                    'workload': batch,
+                    'potential_type': potential_type,
+                    })
+            batch_counts[cable.pk] = idx + 1
+
+    dbh.bulk_upsert_batches(batch_records)
+    # a regenerated cable may have fewer batches than before
+    dbh.remove_batches(dbh.batches_beyond(batch_counts))
+
+    return dbh.current_version()
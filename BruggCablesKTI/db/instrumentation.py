@@ -0,0 +1,228 @@
+'''
+Module collecting statistics of the SQL statements issued through DBHandlers,
+to find and keep out the query storms of the simulation code.
+
+The statements are grouped by the public DBHandler method issuing them (or
+the relationship lazily loaded) and the call site outside of the handler. For
+every group the report lists the number of statements, their total and 95th
+percentile latency and the rows written or objects loaded. Groups repeating
+the same statements many times from one call site, typically lazy loads or
+point lookups in a loop, are flagged as possible N+1 patterns.
+
+Enable it for a run with
+
+    $ export BRUGGCABLES_QUERY_REPORT=1
+
+all DBHandlers are then instrumented and the report is printed at exit. A
+single engine is instrumented with ``instrument(dbh.engine)``.
+
+'''
+
+import os
+import sys
+import time
+import atexit
+import threading
+from array import array
+
+import numpy as np
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.orm import Mapper
+
+
+# the environment variable enabling the instrumentation of all DBHandlers
+REPORT_VARIABLE = 'BRUGGCABLES_QUERY_REPORT'
+
+# the repetitions of the same statements from one call site flagged as N+1
+N_PLUS_ONE_THRESHOLD = 50
+
+# the number of groups listed in the report
+REPORT_LENGTH = 30
+
+_SQLALCHEMY_DIR = os.path.dirname(os.path.abspath(sqlalchemy.__file__))
+_MODEL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'model.py')
+_INTERNAL_FILES = (_MODEL_FILE, os.path.abspath(__file__))
+_ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+
+class QueryStats(object):
+    ''' The statistics of the statements of one method and call site.
+    '''
+    # distinct statements tracked per group, enough to tell a loop
+    MAX_STATEMENTS = 4
+
+    def __init__(self):
+        self.durations = array('d')
+        self.rows = 0
+        self.statements = set()
+
+    @property
+    def count(self):
+        return len(self.durations)
+
+    @property
+    def total(self):
+        return sum(self.durations)
+
+    @property
+    def p95(self):
+        return float(np.percentile(self.durations, 95))
+
+    def add(self, statement, duration):
+        self.durations.append(duration)
+        if len(self.statements) < self.MAX_STATEMENTS:
+            self.statements.add(statement)
+
+    def is_repeated(self):
+        ''' Whether a few statements are repeated many times, the mark of a
+        query in a loop.'''
+        return self.count >= N_PLUS_ONE_THRESHOLD and \
+                len(self.statements) < self.MAX_STATEMENTS
+
+
+class QueryProfiler(object):
+    ''' Collects the statistics of the instrumented engines.
+    '''
+
+    def __init__(self):
+        self.stats = {}
+        self.engines = []
+        self._local = threading.local()
+
+    def instrument(self, engine):
+        ''' Start collecting the statements of ``engine``.
+        '''
+        if engine in self.engines:
+            return
+        if not self.engines:
+            event.listen(Mapper, 'load', self._on_load)
+            atexit.register(self.print_report)
+        self.engines.append(engine)
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context,
+            executemany):
+        conn.info.setdefault('query_start_times', []).append(
+                time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+            executemany):
+        duration = time.perf_counter() - \
+                conn.info['query_start_times'].pop()
+        key = locate(sys._getframe(1))
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = QueryStats()
+        stats.add(statement, duration)
+        if cursor.rowcount > 0:
+            stats.rows += cursor.rowcount
+        self._local.last = stats
+
+    def _on_load(self, target, context):
+        # the object was loaded from the rows of the last statement
+        stats = getattr(self._local, 'last', None)
+        if stats is not None:
+            stats.rows += 1
+
+    def reset(self):
+        ''' Forget the statistics collected so far.
+        '''
+        self.stats.clear()
+
+    def report(self):
+        ''' The report of the collected statistics.
+
+        Returns
+        -------
+        report : string
+        '''
+        groups = sorted(self.stats.items(), key=lambda item: -item[1].total)
+        lines = ['SQL statements by DBHandler method and call site : {} '
+            'statements in {:.1f} ms'.format(
+                sum(stats.count for stats in self.stats.values()),
+                1e3*sum(stats.total for stats in self.stats.values())),
+            '{:>8} {:>10} {:>8} {:>8}  {:<32} {}'.format('count',
+                'total ms', 'p95 ms', 'rows', 'method', 'call site')]
+        for ((method, site), stats) in groups[:REPORT_LENGTH]:
+            lines.append('{:>8} {:>10.1f} {:>8.2f} {:>8}  {:<32} {}'.format(
+                stats.count, 1e3*stats.total, 1e3*stats.p95, stats.rows,
+                method, site))
+
+        repeated = [(key, stats) for (key, stats) in groups
+                if stats.is_repeated()]
+        if repeated:
+            lines.append('')
+            lines.append('Possible N+1 patterns, the same statements repeated '
+                'from one call site :')
+            for ((method, site), stats) in repeated:
+                lines.append('{:>8} x {} at {}'.format(stats.count, method,
+                    site))
+        return '\n'.join(lines)
+
+    def print_report(self):
+        if self.stats:
+            print(self.report())
+
+
+def locate(frame):
+    ''' The (method, call site) of the statement executed from ``frame``.
+
+    The method is the outermost public DBHandler method on the stack, or the
+    relationship lazily loaded, the call site is the first frame outside of
+    the DBHandler and SQLAlchemy.
+    '''
+    method, lazy_load = None, None
+    while frame is not None:
+        code = frame.f_code
+        filename = code.co_filename
+        # '<string>' are the functions SQLAlchemy generates
+        if filename.startswith(_SQLALCHEMY_DIR) or filename == '<string>':
+            if code.co_name == '_emit_lazyload' and lazy_load is None:
+                strategy = frame.f_locals.get('self')
+                lazy_load = 'lazy load {}'.format(
+                        getattr(strategy, 'parent_property', '?'))
+        elif filename in _INTERNAL_FILES:
+            handler = frame.f_locals.get('self')
+            if type(handler).__name__ == 'DBHandler' and \
+                    not code.co_name.startswith('_'):
+                method = code.co_name
+        else:
+            break
+        frame = frame.f_back
+
+    if frame is None:
+        site = '?'
+    else:
+        filename = frame.f_code.co_filename
+        if filename.startswith(_ROOT_DIR):
+            filename = os.path.relpath(filename, _ROOT_DIR)
+        site = '{}:{} {}'.format(filename, frame.f_lineno,
+                frame.f_code.co_name)
+    return (lazy_load or method or 'session', site)
+
+
+# the profiler of all instrumented engines
+PROFILER = QueryProfiler()
+
+
+def instrument(engine):
+    ''' Collect the statistics of the statements of ``engine``, the report is
+    printed at exit.
+    '''
+    PROFILER.instrument(engine)
+
+
+def report():
+    ''' The report of the statements of all instrumented engines so far.
+    '''
+    return PROFILER.report()
+
+
+def enabled():
+    ''' Whether the environment enables the instrumentation of all
+    DBHandlers.'''
+    return os.environ.get(REPORT_VARIABLE, '') not in ('', '0')
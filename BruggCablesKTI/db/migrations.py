@@ -0,0 +1,144 @@
+'''
+Module bringing database files created by older versions of the data model up
+to date.
+
+``Base.metadata.create_all`` only creates missing tables, the steps in here add
+what is missing inside the existing ones. Every step is idempotent. SQLite
+databases record the schema version they were brought to in ``PRAGMA
+user_version``, the steps only run once per upgrade.
+
+'''
+
+from sqlalchemy import inspect
+
+
+# the version of the data model, increment it with every change to the steps
+SCHEMA_VERSION = 1
+
+
+def schema_version(engine):
+    ''' The schema version of the database, 0 for databases never upgraded
+    (and other databases than sqlite).
+    '''
+    if engine.dialect.name != 'sqlite':
+        return 0
+    return engine.execute('PRAGMA user_version').scalar()
+
+
+def upgrade(engine, metadata):
+    ''' Applies all migration steps to a database older than
+    :data:`SCHEMA_VERSION`.
+
+    Arguments
+    ---------
+    engine : the engine connected to the database
+    metadata : the metadata of the data model
+    '''
+    if schema_version(engine) >= SCHEMA_VERSION:
+        return
+    inspector = inspect(engine)
+    add_missing_columns(engine, inspector, metadata)
+    assign_batch_ordinals(engine)
+    initialize_data_version(engine)
+    initialize_workloads(engine)
+    create_missing_indexes(engine, inspector, metadata)
+    create_triggers(engine, metadata)
+    if engine.dialect.name == 'sqlite':
+        engine.execute('PRAGMA user_version = {:d}'.format(SCHEMA_VERSION))
+
+
+def add_missing_columns(engine, inspector, metadata):
+    ''' Adds the columns declared in the data model but missing in the
+    existing tables. The new columns are empty.
+    '''
+    tables = set(inspector.get_table_names())
+    for table in metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = set(column['name'] for column in
+                inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                engine.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    table.name, column.name,
+                    column.type.compile(dialect=engine.dialect)))
+
+
+def assign_batch_ordinals(engine):
+    ''' Numbers the batches without an ordinal after the existing ones, in
+    the order they were inserted.
+    '''
+    engine.execute('''
+        UPDATE batches SET ordinal = rowid +
+            (SELECT coalesce(max(ordinal), -1) FROM batches)
+        WHERE ordinal IS NULL''')
+
+
+def create_missing_indexes(engine, inspector, metadata):
+    ''' Creates the indexes declared in the data model but missing in the
+    database. Tables shadowed by views (see BruggCablesKTI.db.scenarios) are
+    left alone.
+    '''
+    tables = set(inspector.get_table_names())
+    for table in metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = set(index['name'] for index in
+                inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=engine)
+
+
+def create_triggers(engine, metadata):
+    ''' Creates the triggers running the ``after_delete`` statements in the
+    ``info`` of the tables for every deleted row. The scenario overlays run
+    them in their own delete triggers, see BruggCablesKTI.db.scenarios.
+    '''
+    tables = set(inspect(engine).get_table_names())
+    for table in metadata.sorted_tables:
+        statements = table.info.get('after_delete')
+        if table.name not in tables or not statements:
+            continue
+        engine.execute('''
+            CREATE TRIGGER IF NOT EXISTS {0}_after_delete AFTER DELETE ON {0}
+            BEGIN
+                {1};
+            END'''.format(table.name, ';\n                '.join(statements)))
+
+
+def initialize_data_version(engine):
+    ''' Creates the single row of the data version counter and gives the
+    database its random identity.
+    '''
+    engine.execute('''
+        INSERT INTO data_version (pk, version)
+        SELECT 1, 0 WHERE NOT EXISTS (SELECT 1 FROM data_version)''')
+    engine.execute('''
+        UPDATE data_version SET identity = lower(hex(randomblob(16)))
+        WHERE identity IS NULL''')
+
+
+def initialize_workloads(engine):
+    ''' Fills the workload aggregates of a database with batches but none
+    yet, the DBHandler keeps them up to date from then on.
+    '''
+    if engine.execute('SELECT 1 FROM opportunity_workloads LIMIT 1').first() \
+            or not engine.execute('SELECT 1 FROM batches LIMIT 1').first():
+        return
+    engine.execute('''
+        INSERT INTO opportunity_workloads (opportunity_pk, workload, batches)
+        SELECT c.opportunity_pk, coalesce(sum(b.workload), 0.), count(b.pk)
+        FROM batches b JOIN cables c ON b.cable_pk = c.pk
+        WHERE c.opportunity_pk IS NOT NULL
+        GROUP BY c.opportunity_pk''')
+    engine.execute('''
+        INSERT INTO monthly_workloads
+            (opportunity_pk, month, production_line, workload, batches)
+        SELECT c.opportunity_pk,
+            strftime('%Y-%m-01 00:00:00.000000', b.delivery_date) AS month,
+            coalesce(c.production_line, '') AS line,
+            coalesce(sum(b.workload), 0.), count(b.pk)
+        FROM batches b JOIN cables c ON b.cable_pk = c.pk
+        WHERE c.opportunity_pk IS NOT NULL AND b.delivery_date IS NOT NULL
+        GROUP BY c.opportunity_pk, month, line''')
@@ -5,21 +5,33 @@ Module defining the datamodel for the BruggCables Opportunity Simulator.
 
 import os
 import sys
+import time
+import sqlite3
 import datetime
+from contextlib import contextmanager
+from collections import OrderedDict
+from functools import wraps
+from itertools import chain
 
 
 from sqlalchemy import Column, ForeignKey, Integer, String, Float, DateTime,\
-        Enum
+        Enum, Index, LargeBinary, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm.exc import NoResultFound, FlushError
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import sessionmaker, scoped_session, relationship,\
-        column_property
-from sqlalchemy import create_engine, and_, or_, select
+        column_property, joinedload, selectinload, object_session
+from sqlalchemy import create_engine, and_, or_, select, func, inspect, event,\
+        literal_column, literal, true
 
 from uuid import uuid4
 
+import numpy as np
+
 from BruggCablesKTI.simulation.production_batches import calculate_batches
+from BruggCablesKTI.db import migrations, bitsets, scenarios, instrumentation
 
 
 '''
@@ -28,6 +40,7 @@ TODO michael ::
 - profile saving
 - saving lists of first selections (clusterwise)
 - investigate size of primary keys -> how to get db size down?
+  -> set BRUGGCABLES_KEY_TYPE=integer, see scripts/migrate_to_integer_keys.py
 
 
 '''
@@ -37,11 +50,72 @@ class InvalidEntry(ValueError):
     pass
 class MissingEntry(ValueError):
     pass
+class OutdatedSchema(ValueError):
+    pass
 
 
 def new_uuid():
     return uuid4().hex
 
+
+# the type of all primary and foreign keys is fixed when this module is
+# imported : 'uuid' (String(32) hex uuids, the default) or 'integer'
+# (autoincrementing integers, several times smaller in tables and indexes)
+KEY_TYPE_VARIABLE = 'BRUGGCABLES_KEY_TYPE'
+KEY_TYPES = ('uuid', 'integer')
+KEY_TYPE = os.environ.get(KEY_TYPE_VARIABLE, 'uuid')
+if KEY_TYPE not in KEY_TYPES:
+    raise ValueError('{} has to be one of {}, not {!r}'.format(
+        KEY_TYPE_VARIABLE, KEY_TYPES, KEY_TYPE))
+
+def key_column(*args, **kwargs):
+    """ A primary or foreign key column of the configured :data:`KEY_TYPE`.
+    """
+    if KEY_TYPE == 'integer':
+        return Column(Integer, *args, **kwargs)
+    if kwargs.get('primary_key') and not args:
+        kwargs.setdefault('default', new_uuid)
+    return Column(String(32), *args, **kwargs)
+
+
+# the maximum number of keys bound into a single ``IN (...)`` clause, sqlite
+# refuses statements with more than 999 host parameters
+IN_CLAUSE_CHUNK = 500
+
+# the number of rows written per ``executemany`` by the bulk writers
+BULK_INSERT_CHUNK = 50000
+
+# the number of objects kept by the find_batch(), find_cable() and
+# find_opportunity() cache of a DBHandler
+LOOKUP_CACHE_SIZE = 10000
+
+# reference time of the integer hour stamps returned by the array loaders
+ARRAY_EPOCH = datetime.datetime(1970, 1, 1)
+
+# the hour stamp of a missing date in the array loaders
+MISSING_HOURS = np.iinfo(np.int64).min
+
+
+def chunks(sequence, size=IN_CLAUSE_CHUNK):
+    """ Yield successive slices of length ``size`` from ``sequence``."""
+    sequence = list(sequence)
+    for idx in range(0, len(sequence), size):
+        yield sequence[idx:idx+size]
+
+
+def call_in_savepoint(method):
+    """ Decorate a DBHandler method which rolls back its changes when it
+    fails. Called inside a :meth:`DBHandler.transaction` block, the method
+    runs in a nested block, so the failure only rolls back the changes of
+    the call and the enclosing block can go on."""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not self._transaction_depth:
+            return method(self, *args, **kwargs)
+        with self.transaction():
+            return method(self, *args, **kwargs)
+    return wrapper
+
 Base = declarative_base()
 
 
@@ -56,10 +130,11 @@ class Opportunity(Base):
     __tablename__ = 'opportunities'
 
     # primary key
-    pk = Column(String(32), primary_key=True, default=new_uuid)
+    pk = key_column(primary_key=True)
 
     # relationships
-    cables = relationship("Cable", back_populates="opportunity")
+    cables = relationship("Cable", back_populates="opportunity",
+            passive_deletes=True)
 
     # the Brugg Cables id
     brugg_cables_id = Column(Integer, unique=True)
@@ -77,12 +152,15 @@ class Opportunity(Base):
     probability = Column(Float)
 
     # the delivery date associated with the opportunity
-    delivery_date = Column(DateTime)
+    delivery_date = Column(DateTime, index=True)
 
     # 'offer' or 'project'
     KINDS = ('offer', 'project', 'internal')
     kind = Column(Enum(*KINDS))
 
+    # the data version of the last change to the row, see changed_since()
+    version = Column(Integer, index=True)
+
     def __repr__(self):
         return "Opportunity<{}, {}>".format(self.brugg_cables_id,
                 self.description)
@@ -112,13 +190,15 @@ class Cable(Base):
     __tablename__ = 'cables'
 
     # primary key
-    pk = Column(String(32), primary_key=True, default=new_uuid)
+    pk = key_column(primary_key=True)
 
     # relationships
-    opportunity_pk = Column(String(32), ForeignKey('opportunities.pk'),
-            nullable=False)
+    opportunity_pk = key_column(
+            ForeignKey('opportunities.pk', ondelete='CASCADE'),
+            nullable=False, index=True)
     opportunity = relationship("Opportunity", back_populates="cables")
-    batches = relationship("Batch", back_populates="cable")
+    batches = relationship("Batch", back_populates="cable",
+            passive_deletes=True)
 
     # the cable type/kind associated with the opportunity
     KINDS = ('SEG', 'RMV')
@@ -137,6 +217,20 @@ class Cable(Base):
     PRODUCTION_LINES = ('Line1', 'Line2', '')
     production_line = Column(Enum(*PRODUCTION_LINES))
 
+    # the data version of the last change to the row, see changed_since()
+    version = Column(Integer, index=True)
+
+    # the attributes identifying a cable of an opportunity on re-import
+    NATURAL_KEY = ('opportunity_pk', 'kind', 'voltage', 'area',
+            'production_line')
+
+    @staticmethod
+    def natural_key(values):
+        ''' The hashable natural key of the ``NATURAL_KEY`` values, missing
+        (None or NaN) values compare equal.'''
+        return tuple(None if value is None or value != value else value
+                for value in values)
+
     def to_dict(self):
         """ Convert the object to a JSON-friendly dictionary representation.
         """
@@ -168,9 +262,12 @@ class FirstSelectionItem(Base):
     #pk = Column(String(32), primary_key=True, default=new_uuid)
 
     # relationships
-    batch_pk = Column(String(32), ForeignKey('batches.pk'), primary_key=True)
+    batch_pk = key_column(ForeignKey('batches.pk', ondelete='CASCADE'),
+            primary_key=True)
     batch = relationship("Batch", back_populates="first_selections")
-    first_selection_pk = Column(String(32), ForeignKey('first_selections.pk'), primary_key=True)
+    first_selection_pk = key_column(
+            ForeignKey('first_selections.pk', ondelete='CASCADE'),
+            primary_key=True, index=True)
     first_selection = relationship("FirstSelection", back_populates="batches")
 
     def to_dict(self):
@@ -197,16 +294,19 @@ class Batch(Base):
     __tablename__ = 'batches'
 
     # primary key
-    pk = Column(String(32), primary_key=True, default=new_uuid)
+    pk = key_column(primary_key=True)
 
     # relationships
-    cable_pk = Column(String(32), ForeignKey('cables.pk'))
+    cable_pk = key_column(ForeignKey('cables.pk', ondelete='CASCADE'),
+            index=True)
     cable = relationship("Cable", back_populates="batches")
 
-    first_selections = relationship("FirstSelectionItem", back_populates="batch",)
+    first_selections = relationship("FirstSelectionItem", back_populates="batch",
+            passive_deletes=True)
             #secondary="first_selection_items")
 
-    production_slots = relationship("ProductionSlot", back_populates="batch")
+    production_slots = relationship("ProductionSlot", back_populates="batch",
+            passive_deletes=True)
 
     # the number in the row of batches for this production
     number = Column(Integer, nullable=False)
@@ -222,6 +322,28 @@ class Batch(Base):
     # the production workload in hours
     workload = Column(Float)
 
+    # the stable position of the batch in the schedule bitmaps, assigned in
+    # the database when the batch is inserted, see BruggCablesKTI.db.bitsets.
+    # Ordinals are never handed out twice : new ordinals come after those of
+    # the existing batches and DataVersion.max_ordinal, of the deleted ones
+    ordinal = Column(Integer, index=True, unique=True,
+            default=text('(SELECT max(coalesce(max(ordinal), -1), '
+                '(SELECT coalesce(max(max_ordinal), -1) FROM data_version))'
+                ' + 1 FROM batches)'))
+
+    # the data version of the last change to the row, see changed_since()
+    version = Column(Integer, index=True)
+
+    # select_batch_timerange() : equality on the number, range on the date
+    # after_delete : the statements run for every deleted row, see
+    # migrations.create_triggers()
+    __table_args__ = (
+        Index('ix_batches_number_delivery_date', 'number', 'delivery_date'),
+        {'info': {'after_delete': [
+            'UPDATE data_version SET max_ordinal = OLD.ordinal '
+            'WHERE coalesce(max_ordinal, -1) < OLD.ordinal']}},
+    )
+
     def to_dict(self):
         """ Convert the object to a JSON-friendly dictionary representation.
         """
@@ -252,10 +374,11 @@ class Schedule(Base):
     __tablename__ = 'schedules'
 
     # primary key
-    pk = Column(String(32), primary_key=True, default=new_uuid)
+    pk = key_column(primary_key=True)
 
     # relationships
-    production_slots = relationship("ProductionSlot", back_populates="schedule")
+    production_slots = relationship("ProductionSlot", back_populates="schedule",
+            passive_deletes=True)
 
     # the margin calculated for the entire schedule in sFr.
     margin = Column(Float)
@@ -263,9 +386,28 @@ class Schedule(Base):
     # the revenue calculated for the entire schedule in sFr.
     revenue = Column(Float)
 
+    # the batches of a schedule stored as a bitmap (see add_schedule), None
+    # if all its batches have a production slot
+    membership = Column(LargeBinary)
+
+    @property
+    def batch_ordinals(self):
+        """ The sorted ordinals of the batches of a bitmap schedule."""
+        if self.membership is None:
+            return None
+        return bitsets.decode(self.membership)
+
     @property
     def batches(self):
-        return [ps.batch for ps in self.production_slots ]
+        if self.membership is None:
+            return [ps.batch for ps in self.production_slots ]
+        session = object_session(self)
+        batches = []
+        for ordinals in chunks(self.batch_ordinals.tolist()):
+            batches.extend(session.query(Batch)\
+                    .filter(Batch.ordinal.in_(ordinals))\
+                    .order_by(Batch.ordinal).all())
+        return batches
 
     def to_dict(self):
         """ Convert the object to a JSON-friendly dictionary representation.
@@ -288,13 +430,15 @@ class ProductionSlot(Base):
     __tablename__ = 'production_slots'
 
     # primary key
-    pk = Column(String(32), primary_key=True, default=new_uuid)
+    pk = key_column(primary_key=True)
 
     # relationships
-    batch_pk = Column(String(32), ForeignKey('batches.pk'), nullable=False)
+    batch_pk = key_column(ForeignKey('batches.pk', ondelete='CASCADE'),
+            nullable=False, index=True)
     batch = relationship("Batch", back_populates="production_slots")
-    schedule_pk = Column(String(32),
-            ForeignKey('schedules.pk'), nullable=False)
+    schedule_pk = key_column(
+            ForeignKey('schedules.pk', ondelete='CASCADE'),
+            nullable=False, index=True)
     schedule = relationship("Schedule", back_populates="production_slots")
 
     # attributes
@@ -319,20 +463,66 @@ class ProductionSlot(Base):
         return "FirstSelectionItem<{}>".format(self.pk)
 
 
+class SelectionSet(Base):
+    ''' A set of batches stored once, however many first selections it is
+    the content of.
+    '''
+    __tablename__ = 'selection_sets'
+
+    # the content hash of the batch ordinals, see bitsets.digest()
+    digest = Column(String(40), primary_key=True)
+
+    # the batches as a bitmap of their ordinals, see bitsets.encode()
+    membership = Column(LargeBinary, nullable=False)
+
+    # the number of batches
+    size = Column(Integer, nullable=False)
+
+
 class FirstSelection(Base):
     '''
     '''
     __tablename__ = 'first_selections'
 
     # primary key
-    pk = Column(String(32), primary_key=True, default=new_uuid)
+    pk = key_column(primary_key=True)
 
-    # relationships
-    batches = relationship("FirstSelectionItem", back_populates="first_selection",)
+    # relationships, the items are empty for a content addressed selection,
+    # see selected_batches
+    batches = relationship("FirstSelectionItem", back_populates="first_selection",
+            passive_deletes=True)
             #secondary="first_selection_items")
 
+    # the set of batches (see add_first_selections_bulk), None if the
+    # batches are first selection items
+    selection_digest = Column(String(40),
+            ForeignKey('selection_sets.digest'), index=True)
+    selection_set = relationship("SelectionSet")
+
     # cluster number
-    cluster_number = Column(Integer)
+    cluster_number = Column(Integer, index=True)
+
+    @property
+    def batch_ordinals(self):
+        """ The sorted ordinals of the batches of a content addressed first
+        selection."""
+        if self.selection_set is None:
+            return None
+        return bitsets.decode(self.selection_set.membership)
+
+    @property
+    def selected_batches(self):
+        """ The batches of the first selection, from its items or its
+        selection set."""
+        if self.selection_digest is None:
+            return [item.batch for item in self.batches]
+        session = object_session(self)
+        batches = []
+        for ordinals in chunks(self.batch_ordinals.tolist()):
+            batches.extend(session.query(Batch)\
+                    .filter(Batch.ordinal.in_(ordinals))\
+                    .order_by(Batch.ordinal).all())
+        return batches
 
     #@property
     #def batches(self):
@@ -353,6 +543,169 @@ class FirstSelection(Base):
         return "FirstSelection<{}>".format(self.pk)
 
 
+# the order of the first selections of a cluster, see select_first_selection()
+# : their insertion order, the views of a scenario have no rowid and fall back
+# to the primary key
+FIRST_SELECTION_ORDER = (literal_column('first_selections.rowid'),
+        FirstSelection.__table__.c.pk)
+
+
+class DataVersion(Base):
+    ''' The single row counter of the data versions, incremented for every
+    set of changes to the versioned tables.
+    '''
+    __tablename__ = 'data_version'
+
+    pk = Column(Integer, primary_key=True)
+
+    version = Column(Integer, nullable=False, default=0)
+
+    # a random id telling apart databases (and working copies) reaching the
+    # same versions with different data
+    identity = Column(String(32))
+
+    # the highest ordinal of a deleted batch, see Batch.ordinal
+    max_ordinal = Column(Integer)
+
+
+class Deletion(Base):
+    ''' A row deleted from a versioned table, see DBHandler.changed_since().
+    '''
+    __tablename__ = 'deletions'
+
+    table_name = Column(String(64), primary_key=True)
+
+    key = key_column(primary_key=True)
+
+    version = Column(Integer, primary_key=True, index=True)
+
+
+# the tables whose rows carry the version of their last change
+VERSIONED_CLASSES = (Opportunity, Cable, Batch)
+
+
+class OpportunityWorkload(Base):
+    ''' The total production workload of the batches of an opportunity,
+    kept up to date by the DBHandler, see DBHandler.refresh_workloads().
+    '''
+    __tablename__ = 'opportunity_workloads'
+
+    opportunity_pk = key_column(ForeignKey('opportunities.pk',
+        ondelete='CASCADE'), primary_key=True)
+
+    # the production workload in hours
+    workload = Column(Float, nullable=False)
+
+    # the number of batches
+    batches = Column(Integer, nullable=False)
+
+
+class MonthlyWorkload(Base):
+    ''' The production workload of the batches of an opportunity delivered
+    in a month on a production line, kept up to date by the DBHandler.
+    '''
+    __tablename__ = 'monthly_workloads'
+
+    opportunity_pk = key_column(ForeignKey('opportunities.pk',
+        ondelete='CASCADE'), primary_key=True)
+
+    # the first day of the delivery month
+    month = Column(DateTime, primary_key=True)
+
+    # the production line of the cables, '' if not assigned
+    production_line = Column(String(8), primary_key=True)
+
+    # the production workload in hours
+    workload = Column(Float, nullable=False)
+
+    # the number of batches
+    batches = Column(Integer, nullable=False)
+
+    # monthly_workloads() : range on the month
+    __table_args__ = (
+        Index('ix_monthly_workloads_month', 'month', 'production_line'),
+    )
+
+
+# the aggregates of the batches maintained on every write
+WORKLOAD_CLASSES = (OpportunityWorkload, MonthlyWorkload)
+
+
+# SQLITE PERFORMANCE PROFILES
+###############################################################################
+
+# pragmas set on every new sqlite connection of a DBHandler, see
+# https://www.sqlite.org/pragma.html (negative cache sizes are in KiB)
+PERFORMANCE_PROFILES = {
+    # durable : rollback journal and a full fsync on every commit
+    'safe': {
+        'journal_mode': 'DELETE',
+        'synchronous': 'FULL',
+        'cache_size': -64000,
+        },
+    # many readers, few small commits : wal journal, no fsync on commit
+    'read_mostly': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -256000,
+        'mmap_size': 2**30,
+        'temp_store': 'MEMORY',
+        },
+    # imports and scratch copies of the database : never wait for the disk,
+    # an os crash (not a python one) may corrupt the file
+    'bulk_load': {
+        'journal_mode': 'WAL',
+        'synchronous': 'OFF',
+        'cache_size': -512000,
+        'mmap_size': 2**30,
+        'temp_store': 'MEMORY',
+        },
+}
+
+
+def set_sqlite_pragmas(engine, pragmas):
+    """ Executes ``PRAGMA name = value`` for all ``pragmas`` on every new
+    connection of the (sqlite) ``engine``.
+    """
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in pragma_statements(pragmas):
+            cursor.execute(statement)
+        cursor.close()
+    event.listen(engine, 'connect', on_connect)
+
+
+def pragma_statements(pragmas):
+    """ The ``PRAGMA`` statements setting ``pragmas``. The journal mode is
+    only set for the main database, an attached scenario base is read-only.
+    """
+    return ['PRAGMA {}{} = {}'.format('main.' if name == 'journal_mode'
+        else '', name, value) for name, value in sorted(pragmas.items())]
+
+
+def profile_pragmas(engine, performance_profile):
+    """ The pragmas of ``performance_profile`` for the (sqlite) ``engine``.
+    """
+    if performance_profile not in PERFORMANCE_PROFILES:
+        raise ValueError('Unknown performance profile {!r}, use one '
+            'of {}'.format(performance_profile, sorted(PERFORMANCE_PROFILES)))
+    if engine.dialect.name != 'sqlite':
+        raise ValueError('Performance profiles are only available '
+            'for sqlite databases.')
+    return PERFORMANCE_PROFILES[performance_profile]
+
+
+def absolute_url(db_url):
+    """ ``db_url`` with the path of a sqlite database file made absolute, so
+    all URLs of a file are the same."""
+    url = make_url(db_url)
+    if url.drivername.startswith('sqlite') and url.database and \
+            url.database != ':memory:' and \
+            not url.database.startswith('file:'):
+        url.database = os.path.abspath(url.database)
+    return str(url)
+
+
 # DATABASE HANDLER
 ###############################################################################
 
@@ -362,20 +715,945 @@ class DBHandler(object):
 
     """
 
-    def __init__(self, db_url='sqlite:///BruggCables.db'):
+    # the handlers shared through for_url(), by (db_url, performance_profile)
+    _registry = {}
+
+    # the in-memory working copies returned by for_url() instead of the
+    # handlers of their db_url, see open_in_memory()
+    _working_copies = {}
+
+    @classmethod
+    def for_url(cls, db_url='sqlite:///BruggCables.db',
+            performance_profile=None):
+        """ The shared handler for a database, created on first use.
+
+        Later calls with the same arguments (relative and absolute paths of
+        a sqlite file are the same) return the same handler, so its engine,
+        connection pool and session factory are reused and the schema isn't
+        checked again. Unless it has uncommitted changes, all objects of the
+        handler are expired on every call, so they are reloaded with the
+        changes other handlers and processes committed meanwhile.
+
+        If an in-memory working copy or a scenario was opened for ``db_url``
+        (see :meth:`open_in_memory`) it is returned instead, switched to the
+        requested ``performance_profile``.
+
+        Arguments
+        ---------
+        db_url : string
+            The URL to the database, e.g. ``sqlite:///BruggCables.db``
+        performance_profile : string
+            see :meth:`__init__`
+
+        Returns
+        -------
+        dbh : :class:`BruggCablesKTI.db.model.DBHandler`
+        """
+        db_url = absolute_url(db_url)
+        handler = cls._working_copies.get(db_url)
+        if handler is not None:
+            if performance_profile is not None and \
+                    performance_profile != handler.performance_profile:
+                handler._switch_performance_profile(performance_profile)
+            return handler
+
+        key = (db_url, performance_profile)
+        handler = cls._registry.get(key)
+        if handler is None:
+            handler = cls(db_url, performance_profile=performance_profile)
+            cls._registry[key] = handler
+        else:
+            session = handler.db
+            if not (session.new or session.dirty or session.deleted):
+                session.expire_all()
+        return handler
+
+    def _switch_performance_profile(self, performance_profile):
+        """ Set the pragmas of ``performance_profile`` on the single
+        connection of a working copy."""
+        pragmas = profile_pragmas(self.engine, performance_profile)
+        connection = self.engine.raw_connection()
+        try:
+            if connection.in_transaction:
+                # the journal mode can't change inside a transaction
+                pragmas = dict(pragmas)
+                pragmas.pop('journal_mode', None)
+            cursor = connection.cursor()
+            for statement in pragma_statements(pragmas):
+                cursor.execute(statement)
+            cursor.close()
+        finally:
+            connection.close()
+        self.performance_profile = performance_profile
+
+    @classmethod
+    def open_in_memory(cls, source_path, db_url=None,
+            performance_profile=None):
+        """ Load a database file into an in-memory sqlite database.
+
+        The file is copied with the sqlite backup API and is not modified,
+        all reads and writes of the handler run at memory speed. The results
+        are only written to disk by :meth:`flush_to`.
+
+        Arguments
+        ---------
+        source_path : string
+            the path to the database file, e.g. a template database
+        db_url : string
+            (defaults to None) if given, :meth:`for_url` returns the working
+            copy for this URL until it is closed, so code opening the
+            database by its URL uses the copy
+        performance_profile : string
+            see :meth:`__init__`
+
+        Returns
+        -------
+        dbh : :class:`BruggCablesKTI.db.model.DBHandler`
+        """
+        if not os.path.isfile(source_path):
+            raise MissingEntry("No such database file: {}".format(source_path))
+        source = sqlite3.connect(source_path)
+        memory = sqlite3.connect(':memory:', check_same_thread=False)
+        try:
+            source.backup(memory)
+        finally:
+            source.close()
+
+        # all sessions share the single connection holding the database
+        handler = cls('sqlite://', performance_profile=performance_profile,
+                engine_options={'creator': lambda: memory,
+                                'poolclass': StaticPool})
+        if db_url is not None:
+            cls._working_copies[absolute_url(db_url)] = handler
+        handler._renew_identity()
+        return handler
+
+    @classmethod
+    def open_scenario(cls, base_path, overlay_path=None, db_url=None,
+            performance_profile=None):
+        """ Open a what-if scenario on top of a shared, read-only base
+        database.
+
+        The scenario sees all rows of the base and can add, modify and
+        remove any of them, but only its changes are stored, in the overlay
+        database (see :mod:`BruggCablesKTI.db.scenarios`). Any number of
+        scenarios can share the same base side by side, opening one takes
+        milliseconds.
+
+        Arguments
+        ---------
+        base_path : string
+            the path to the base database file, it is only read. A base
+            created by an older version of the data model is refused, open
+            it once with a DBHandler to bring it up to date
+        overlay_path : string
+            (defaults to None : in memory) the path to the overlay database
+            file, an existing overlay continues its scenario
+        db_url : string
+            (defaults to None) if given, :meth:`for_url` returns the scenario
+            for this URL until it is closed
+        performance_profile : string
+            see :meth:`__init__`
+
+        Returns
+        -------
+        dbh : :class:`BruggCablesKTI.db.model.DBHandler`
+        """
+        if not os.path.isfile(base_path):
+            raise MissingEntry("No such database file: {}".format(base_path))
+        base = sqlite3.connect('file:{}?mode=ro'.format(
+            os.path.abspath(base_path)), uri=True)
+        try:
+            (version, ) = base.execute('PRAGMA user_version').fetchone()
+        finally:
+            base.close()
+        if version < migrations.SCHEMA_VERSION:
+            raise OutdatedSchema("The base database {} has schema version {}, "
+                "open it once with a DBHandler to upgrade it to version "
+                "{}".format(base_path, version, migrations.SCHEMA_VERSION))
+
+        overlay = sqlite3.connect(overlay_path or ':memory:', uri=True,
+                check_same_thread=False)
+        scenarios.attach_base(overlay, os.path.abspath(base_path),
+                Base.metadata)
+
+        handler = cls('sqlite://', performance_profile=performance_profile,
+                engine_options={'creator': lambda: overlay,
+                                'poolclass': StaticPool})
+        # writes to the views don't report the rows changed by the triggers
+        handler.engine.dialect.supports_sane_rowcount = False
+        handler.engine.dialect.supports_sane_multi_rowcount = False
+        if KEY_TYPE == 'integer':
+            # .. nor the rowid of the inserted rows, the keys are set up front
+            event.listen(handler.db, 'before_flush', handler._assign_pks)
+            # the keys of deleted base rows are not reused
+            for table in Base.metadata.sorted_tables:
+                if 'pk' in table.c:
+                    handler._used_pks[table.name] = overlay.execute(
+                        'SELECT max(pk) FROM (SELECT max(pk) AS pk FROM {0} '
+                        'UNION ALL SELECT max(pk) FROM base.{0})'.format(
+                            table.name)).fetchone()[0] or 0
+        if db_url is not None:
+            cls._working_copies[absolute_url(db_url)] = handler
+        handler._renew_identity()
+        return handler
+
+    def _assign_pks(self, session, flush_context, instances):
+        """ Give the new objects of a flush their integer primary keys."""
+        new = {}
+        for obj in session.new:
+            if getattr(obj, 'pk', 0) is None:
+                new.setdefault(type(obj), []).append(obj)
+        for (model_class, objects) in new.items():
+            for (obj, pk) in zip(objects, self.new_pks(model_class,
+                    len(objects))):
+                obj.pk = pk
+
+    def scenario_changes(self):
+        """ The number of rows a scenario opened with :meth:`open_scenario`
+        added or modified and removed per table.
+
+        Returns
+        -------
+        changes : dict {table name: (changed, removed)}
+        """
+        return scenarios.changes(self.db, Base.metadata)
+
+    def flush_to(self, path):
+        """ Write the committed state of the database to a file with the
+        sqlite backup API, replacing the file's content.
+
+        Close the other handlers of the file first.
+
+        Arguments
+        ---------
+        path : string
+            the path to the database file
+        """
+        self.commit()
+        connection = self.engine.raw_connection()
+        try:
+            target = sqlite3.connect(path)
+            try:
+                connection.connection.backup(target)
+            finally:
+                target.close()
+        finally:
+            connection.close()
+
+    def __init__(self, db_url='sqlite:///BruggCables.db',
+            performance_profile=None, engine_options=None,
+            lookup_cache_size=LOOKUP_CACHE_SIZE):
         """ Initialize the connection to the database.
 
         Arguments
         ---------
         db_url : string
             The URL to the database, e.g. ``sqlite:///BruggCables.db``
+        performance_profile : string
+            (defaults to None : the sqlite defaults) the name of the sqlite
+            pragmas preset in :data:`PERFORMANCE_PROFILES`, 'safe',
+            'read_mostly' or 'bulk_load'
+        lookup_cache_size : int
+            (defaults to :data:`LOOKUP_CACHE_SIZE`) the number of objects
+            cached by the find_batch(), find_cable() and find_opportunity()
+            lookups, 0 disables the cache
+        engine_options : dict
+            (defaults to None) additional keyword arguments to
+            ``sqlalchemy.create_engine``
         """
         # create the connection to the database
-        engine = create_engine(db_url)
+        engine = create_engine(db_url, **(engine_options or {}))
+        if instrumentation.enabled():
+            instrumentation.instrument(engine)
+        if performance_profile is not None:
+            set_sqlite_pragmas(engine,
+                    profile_pragmas(engine, performance_profile))
+        self.engine = engine
+        self.performance_profile = performance_profile
         self.db = scoped_session(sessionmaker(autoflush=True, bind=engine))
 
         # this creates all the tables in the database if they don't already exist
         Base.metadata.create_all(bind=engine)
+        # .. and brings the tables of older database files up to date
+        migrations.upgrade(engine, Base.metadata)
+        self._check_key_type(engine)
+
+        # nesting depth of transaction() blocks, commits are deferred while > 0
+        self._transaction_depth = 0
+        # the savepoints of the nested transaction() blocks, innermost last
+        self._savepoints = []
+
+        # the highest integer primary key handed out per table by new_pks()
+        self._reserved_pks = {}
+
+        # integer primary keys new_pks() must never hand out again per table,
+        # e.g. the keys of base rows a scenario deleted
+        self._used_pks = {}
+
+        # cluster number -> the ordered first selection pks of the cluster
+        self._first_selection_index = {}
+
+        # (model class, key) -> object, in least recently used order
+        self._lookup_cache = OrderedDict()
+        self._lookup_cache_size = lookup_cache_size
+        self.cache_hits = 0
+        self.cache_refreshes = 0
+        self.cache_misses = 0
+        event.listen(self.db, 'after_flush', self._invalidate_flushed)
+
+        event.listen(self.db, 'before_flush', self._stamp_versions)
+        event.listen(self.db, 'after_flush', self._refresh_flushed_workloads)
+
+    def close(self):
+        """ Closes the sessions and all pooled connections of the handler and
+        removes it from the :meth:`for_url` registry. An in-memory database
+        is discarded.
+
+        Call this before the database file is replaced, e.g. by a fresh copy
+        of a template.
+        """
+        for registry in (self._registry, self._working_copies):
+            for key, handler in list(registry.items()):
+                if handler is self:
+                    del registry[key]
+        self.db.remove()
+        self.engine.dispose()
+
+
+    @staticmethod
+    def _check_key_type(engine):
+        """ Make sure the keys of the database match :data:`KEY_TYPE`."""
+        columns = dict((column['name'], column) for column in
+                inspect(engine).get_columns(Opportunity.__tablename__))
+        is_integer = isinstance(columns['pk']['type'], Integer)
+        if is_integer != (KEY_TYPE == 'integer'):
+            raise InvalidEntry('The database has {} keys, but {} is {!r}.'\
+                .format('integer' if is_integer else 'uuid',
+                    KEY_TYPE_VARIABLE, KEY_TYPE))
+
+    def new_pks(self, model_class, count):
+        """ Reserve ``count`` new primary keys for rows of ``model_class``
+        which are inserted in bulk, bypassing the ORM defaults.
+
+        Arguments
+        ---------
+        model_class : the mapped class, e.g. :class:`Batch`
+        count : int
+
+        Returns
+        -------
+        pks : list of new primary keys
+        """
+        if KEY_TYPE == 'uuid':
+            return [new_uuid() for idx in range(count)]
+        table = model_class.__table__
+        current = self.db.query(func.max(table.c.pk)).scalar() or 0
+        start = max(current, self._reserved_pks.get(table.name, 0),
+                self._used_pks.get(table.name, 0)) + 1
+        self._reserved_pks[table.name] = start + count - 1
+        return list(range(start, start + count))
+
+
+    def commit(self):
+        """ Commit the pending changes to the database.
+
+        Inside a :meth:`transaction` block the commit is deferred to the end
+        of the outermost block.
+        """
+        if self._transaction_depth:
+            return
+        try:
+            self.db.commit()
+        except (IntegrityError, FlushError) as e:
+            self.rollback()
+            raise InvalidEntry(*e.args)
+
+    def rollback(self):
+        """ Discard the pending changes and everything the handler cached
+        since the last commit.
+
+        Inside a nested :meth:`transaction` block only the changes of the
+        block are discarded."""
+        if self._savepoints:
+            # unless the savepoint was already rolled back
+            if self._savepoints[-1] is self.db().transaction:
+                self._savepoints[-1].rollback()
+        else:
+            self.db.rollback()
+        self._reserved_pks.clear()
+        self.clear_first_selection_index()
+        self.clear_lookup_cache()
+
+    def _cached_lookup(self, model_class, key, load):
+        """ The object of ``model_class`` with ``key`` from the lookup cache,
+        or loaded with ``load(key)`` and cached."""
+        cache_key = (model_class, key)
+        obj = self._lookup_cache.pop(cache_key, None)
+        if obj is not None and inspect(obj).persistent:
+            self._count_hit(obj)
+            self._lookup_cache[cache_key] = obj
+            return obj
+
+        self.cache_misses += 1
+        obj = load(key)
+        self._cache_store(cache_key, obj)
+        return obj
+
+    def _count_hit(self, obj):
+        # an object expired by a commit is refreshed with a query on its
+        # first attribute access, only its identity was found in the cache
+        if inspect(obj).expired_attributes:
+            self.cache_refreshes += 1
+        else:
+            self.cache_hits += 1
+
+    def _cache_store(self, cache_key, obj):
+        if self._lookup_cache_size > 0:
+            self._lookup_cache[cache_key] = obj
+            if len(self._lookup_cache) > self._lookup_cache_size:
+                self._lookup_cache.popitem(last=False)
+
+    def _find_many(self, query, column, keys):
+        """ The objects of ``query`` whose ``column`` is one of ``keys``, in
+        the order of ``keys``, through the lookup cache and one query per
+        :data:`IN_CLAUSE_CHUNK` keys not cached.
+
+        Raises MissingEntry listing all the keys not found.
+        """
+        model_class = column.class_
+        keys = list(keys)
+        found, uncached = {}, []
+        for key in OrderedDict.fromkeys(keys):
+            obj = self._lookup_cache.get((model_class, key))
+            if obj is not None and inspect(obj).persistent:
+                self._count_hit(obj)
+                self._lookup_cache.move_to_end((model_class, key))
+                found[key] = obj
+            else:
+                uncached.append(key)
+
+        self.cache_misses += len(uncached)
+        for chunk in chunks(uncached):
+            for obj in query.filter(column.in_(chunk)):
+                key = getattr(obj, column.key)
+                found[key] = obj
+                self._cache_store((model_class, key), obj)
+
+        missing = [key for key in OrderedDict.fromkeys(keys)
+                if key not in found]
+        if missing:
+            raise MissingEntry("No such {}: {}".format(model_class.__name__,
+                ', '.join(str(key) for key in missing)))
+        return [found[key] for key in keys]
+
+    def _invalidate_flushed(self, session, flush_context):
+        """ Drop the deleted and modified objects of a flush from the lookup
+        cache, a modification may change their key."""
+        changed = set(id(obj) for obj in session.deleted)
+        changed.update(id(obj) for obj in session.dirty)
+        if changed and self._lookup_cache:
+            for (cache_key, obj) in list(self._lookup_cache.items()):
+                if id(obj) in changed:
+                    del self._lookup_cache[cache_key]
+
+    def invalidate_lookups(self, *model_classes):
+        """ Drop all cached objects of ``model_classes`` from the lookup
+        cache, needed after writes bypassing the ORM."""
+        for cache_key in list(self._lookup_cache):
+            if cache_key[0] in model_classes:
+                del self._lookup_cache[cache_key]
+
+    def clear_lookup_cache(self):
+        """ Empty the find_batch(), find_cable() and find_opportunity()
+        cache."""
+        self._lookup_cache.clear()
+
+    def cache_info(self):
+        """ The statistics of the lookup cache.
+
+        Only the 'hits' saved a query. The cached objects are expired by
+        every commit, the 'refreshes' found the object in the cache but it
+        is reloaded with a query on its first attribute access, like a miss.
+
+        Returns
+        -------
+        info : dict with 'hits', 'refreshes', 'misses', 'size' and 'maxsize'
+        """
+        return {
+            'hits': self.cache_hits,
+            'refreshes': self.cache_refreshes,
+            'misses': self.cache_misses,
+            'size': len(self._lookup_cache),
+            'maxsize': self._lookup_cache_size,
+        }
+
+    def _next_version(self):
+        """ Increment the data version counter, in the current transaction.
+
+        Returns
+        -------
+        version : int, the new data version
+        """
+        table = DataVersion.__table__
+        self.db.execute(table.update().values(version=table.c.version + 1))
+        return self.current_version()
+
+    def current_version(self):
+        """ The current data version, the version of the latest changes to
+        the opportunities, cables and batches.
+
+        Returns
+        -------
+        version : int
+        """
+        return self.db.execute(
+                select([DataVersion.__table__.c.version])).scalar()
+
+    def _renew_identity(self):
+        """ Give the database a new identity, for copies whose changes
+        diverge from the ones of their source."""
+        self.db.execute(DataVersion.__table__.update().values(
+            identity=func.lower(func.hex(func.randomblob(16)))))
+        self.commit()
+
+    def data_key(self):
+        """ A key of the current state of the opportunities, cables and
+        batches, e.g. to cache results derived from them.
+
+        Writes bypassing the handler (plain SQL) don't change the key.
+
+        Returns
+        -------
+        key : string, the database identity and the current data version
+        """
+        (identity, version) = self.db.execute(select([
+            DataVersion.__table__.c.identity,
+            DataVersion.__table__.c.version])).first()
+        return '{}-{}'.format(identity, version)
+
+    def _stamp_versions(self, session, flush_context, instances):
+        """ Give the versioned objects written by a flush a new version and
+        record the deleted ones."""
+        written = [obj for obj in session.new
+                if isinstance(obj, VERSIONED_CLASSES)]
+        written.extend(obj for obj in session.dirty
+                if isinstance(obj, VERSIONED_CLASSES) and
+                session.is_modified(obj, include_collections=False))
+        deleted = [obj for obj in session.deleted
+                if isinstance(obj, VERSIONED_CLASSES)]
+        if not (written or deleted):
+            return
+        version = self._next_version()
+        for obj in written:
+            obj.version = version
+        for obj in deleted:
+            session.add(Deletion(table_name=obj.__tablename__, key=obj.pk,
+                version=version))
+
+    def changed_since(self, version):
+        """ The opportunities, cables and batches changed after a data
+        version, to recompute only what they affect.
+
+        Rows written before the versions were introduced have no version and
+        are never reported as changed.
+
+        Arguments
+        ---------
+        version : int
+            a version returned by :meth:`current_version` earlier
+
+        Returns
+        -------
+        changes : dict
+            'version' : the current version, to pass to the next call
+            'changed' : {table name: list of the pks added or modified}
+            'deleted' : {table name: list of the pks deleted}
+        """
+        deletions = Deletion.__table__
+        changes = {'version': self.current_version(),
+                   'changed': {}, 'deleted': {}}
+        for model_class in VERSIONED_CLASSES:
+            table = model_class.__table__
+            changes['changed'][table.name] = [pk for (pk, ) in
+                    self.db.execute(select([table.c.pk])\
+                    .where(table.c.version > version)\
+                    .order_by(table.c.version))]
+            changes['deleted'][table.name] = [pk for (pk, ) in
+                    self.db.execute(select([deletions.c.key])\
+                    .where(and_(deletions.c.table_name == table.name,
+                        deletions.c.version > version))\
+                    .order_by(deletions.c.version))]
+        return changes
+
+    def _workload_opportunities(self, column, keys):
+        """ The pks of the opportunities whose workload aggregates depend on
+        the batches or cables whose ``column`` is one of ``keys``.
+
+        Returns
+        -------
+        pks : set
+        """
+        batches, cables = Batch.__table__, Cable.__table__
+        if column.table is batches:
+            joined = batches.join(cables, batches.c.cable_pk == cables.c.pk)
+        elif column.table is cables:
+            joined = cables
+        else:
+            return set()
+        pks = set()
+        for chunk in chunks(keys):
+            pks.update(pk for (pk, ) in self.db.execute(
+                select([cables.c.opportunity_pk]).select_from(joined)\
+                    .where(column.in_(chunk)).distinct()))
+        pks.discard(None)
+        return pks
+
+    def _refresh_workloads(self, opportunity_pks=None):
+        """ Recompute the workload aggregates of ``opportunity_pks`` (None :
+        all opportunities) with set-based statements, in the current
+        transaction."""
+        batches, cables = Batch.__table__, Cable.__table__
+        totals = OpportunityWorkload.__table__
+        monthly = MonthlyWorkload.__table__
+        joined = batches.join(cables, batches.c.cable_pk == cables.c.pk)
+        workload = func.coalesce(func.sum(batches.c.workload), 0.)
+        # the format sqlalchemy stores DateTime columns in
+        month = func.strftime('%Y-%m-01 00:00:00.000000',
+                batches.c.delivery_date)
+        line = func.coalesce(cables.c.production_line, '')
+
+        if opportunity_pks is None:
+            conditions = [true()]
+            for table in WORKLOAD_CLASSES:
+                self.db.execute(table.__table__.delete())
+        else:
+            conditions = [cables.c.opportunity_pk.in_(chunk)
+                    for chunk in chunks(list(opportunity_pks))]
+            for chunk in chunks(list(opportunity_pks)):
+                for table in (totals, monthly):
+                    self.db.execute(table.delete()\
+                            .where(table.c.opportunity_pk.in_(chunk)))
+
+        for condition in conditions:
+            self.db.execute(totals.insert().from_select(
+                ['opportunity_pk', 'workload', 'batches'],
+                select([cables.c.opportunity_pk, workload,
+                    func.count(batches.c.pk)]).select_from(joined)\
+                    .where(and_(condition,
+                        cables.c.opportunity_pk.isnot(None)))\
+                    .group_by(cables.c.opportunity_pk)))
+            self.db.execute(monthly.insert().from_select(
+                ['opportunity_pk', 'month', 'production_line', 'workload',
+                    'batches'],
+                select([cables.c.opportunity_pk, month, line, workload,
+                    func.count(batches.c.pk)]).select_from(joined)\
+                    .where(and_(condition,
+                        cables.c.opportunity_pk.isnot(None),
+                        batches.c.delivery_date.isnot(None)))\
+                    .group_by(cables.c.opportunity_pk, month, line)))
+
+    def _refresh_flushed_workloads(self, session, flush_context):
+        """ Refresh the workload aggregates of the opportunities whose
+        batches or cables were written by a flush."""
+        cable_pks, opportunity_pks = set(), set()
+        for obj in chain(session.new, session.dirty, session.deleted):
+            if isinstance(obj, Batch):
+                keys, attribute = cable_pks, 'cable_pk'
+            elif isinstance(obj, Cable):
+                keys, attribute = opportunity_pks, 'opportunity_pk'
+            else:
+                continue
+            if obj in session.dirty and \
+                    not session.is_modified(obj, include_collections=False):
+                continue
+            # the current and, if it was moved, the former parent
+            keys.add(getattr(obj, attribute))
+            keys.update(inspect(obj).attrs[attribute].history.deleted or ())
+        cable_pks.discard(None)
+        opportunity_pks.update(self._workload_opportunities(
+            Cable.__table__.c.pk, list(cable_pks)))
+        opportunity_pks.discard(None)
+        if opportunity_pks:
+            self._refresh_workloads(opportunity_pks)
+
+    def refresh_workloads(self, opportunity_pks=None):
+        """ Recompute the workload aggregates from the batches.
+
+        The writes through the handler keep the aggregates up to date, this
+        is only needed after writing batches or cables behind its back.
+
+        Arguments
+        ---------
+        opportunity_pks : list
+            (defaults to None : all opportunities) the opportunities to
+            recompute
+        """
+        with self.transaction():
+            self._refresh_workloads(opportunity_pks)
+
+    def opportunity_workloads(self):
+        """ The total production workload of every opportunity, read from
+        the maintained aggregate.
+
+        Returns
+        -------
+        workloads : dict {opportunity pk: workload in hours}, opportunities
+            without batches are left out
+        """
+        totals = OpportunityWorkload.__table__
+        return dict(self.db.execute(
+            select([totals.c.opportunity_pk, totals.c.workload])).fetchall())
+
+    def monthly_workloads(self, start_date=None, end_date=None,
+            epoch=ARRAY_EPOCH):
+        """ The production workload per opportunity, delivery month and
+        production line, read from the maintained aggregate. Batches without
+        a delivery date are left out.
+
+        Arguments
+        ---------
+        start_date, end_date : datetime.datetime
+            (defaults to None : unbounded) the range of the months, the end
+            is excluded
+        epoch : datetime.datetime
+            reference time of the hour stamps
+
+        Returns
+        -------
+        arrays : dict of numpy.ndarray, one entry per row in every column
+            'opportunity' (the opportunity pks), 'month' (the first hour of
+            the month since ``epoch`` as int64), 'production_line' (codes
+            into ``Cable.PRODUCTION_LINES``), 'workload' and 'batches'
+        """
+        monthly = MonthlyWorkload.__table__
+        query = select([monthly.c.opportunity_pk, monthly.c.month,
+                monthly.c.production_line, monthly.c.workload,
+                monthly.c.batches])\
+            .order_by(monthly.c.month, monthly.c.opportunity_pk)
+        if start_date is not None:
+            query = query.where(monthly.c.month >= start_date)
+        if end_date is not None:
+            query = query.where(monthly.c.month < end_date)
+        rows = self.db.execute(query).fetchall()
+        columns = list(zip(*rows)) if rows else [()] * 5
+
+        lines = dict((c, i) for (i, c) in enumerate(Cable.PRODUCTION_LINES))
+        months = np.array(columns[1], dtype='datetime64[h]')
+        return {
+            'opportunity': np.array(columns[0], dtype=object),
+            'month': months.astype(np.int64) -
+                np.datetime64(epoch, 'h').astype(np.int64),
+            'production_line': np.fromiter((lines.get(v, -1)
+                for v in columns[2]), dtype=np.int8, count=len(rows)),
+            'workload': np.array(columns[3], dtype=np.float64),
+            'batches': np.array(columns[4], dtype=np.int64),
+        }
+
+    @contextmanager
+    def transaction(self):
+        """ Group the writes of many handler calls into a single unit of work.
+
+        Inside the block the mutating methods don't commit and the session
+        doesn't autoflush, the changes are committed once when the block
+        exits. If the block raises, everything done inside it is rolled back.
+        Blocks can be nested, only the outermost one commits. A nested block
+        runs in a savepoint : if it raises, only its own changes are rolled
+        back and the enclosing block can go on. The same holds for a handler
+        call failing with :class:`InvalidEntry` inside a block.
+
+        As autoflush is off, queries inside the block don't see objects added
+        through the ORM in the same block until they are flushed.
+
+        Example
+        -------
+        >>> with dbh.transaction():
+        ...     for pk, end_time in slots:
+        ...         dbh.update_or_create_production_slot(pk, end_time=end_time)
+        """
+        savepoint = None
+        if self._transaction_depth == 0:
+            self._autoflush = self.db.autoflush
+            self.db.autoflush = False
+        else:
+            savepoint = self._begin_savepoint()
+        self._transaction_depth += 1
+        try:
+            yield self
+            if savepoint is not None:
+                try:
+                    savepoint.commit()
+                except (IntegrityError, FlushError) as e:
+                    raise InvalidEntry(*e.args)
+        except:
+            self.rollback()
+            raise
+        finally:
+            self._transaction_depth -= 1
+            if savepoint is not None:
+                self._savepoints.pop()
+            if self._transaction_depth == 0:
+                self.db.autoflush = self._autoflush
+        if savepoint is None:
+            self.commit()
+
+    def _begin_savepoint(self):
+        """ Start the savepoint of a nested transaction() block."""
+        if self.engine.dialect.name == 'sqlite':
+            # pysqlite only begins a transaction before a write, the release
+            # of a savepoint outside of a transaction would commit it
+            connection = self.db.connection().connection
+            if not connection.in_transaction:
+                connection.execute('BEGIN')
+        savepoint = self.db.begin_nested()
+        self._savepoints.append(savepoint)
+        return savepoint
+
+    def _keys_in(self, key_column, column, keys):
+        """ The values of ``key_column`` in the rows whose ``column`` is one
+        of ``keys``, one query per :data:`IN_CLAUSE_CHUNK` keys."""
+        selected = []
+        for chunk in chunks(keys):
+            selected.extend(pk for (pk, ) in self.db.execute(
+                select([key_column]).where(column.in_(chunk))))
+        return selected
+
+    def _delete_in(self, column, keys):
+        """ Delete the rows of the table of ``column`` whose ``column`` is
+        one of ``keys``, one statement per :data:`IN_CLAUSE_CHUNK` keys.
+
+        Returns
+        -------
+        count : the number of deleted rows
+        """
+        table = column.table
+        versioned = any(model_class.__table__ is table
+                for model_class in VERSIONED_CLASSES)
+        version = self._next_version() if versioned and keys else None
+        affected = self._workload_opportunities(column, keys)
+        count = 0
+        for chunk in chunks(keys):
+            if versioned:
+                self.db.execute(Deletion.__table__.insert().from_select(
+                    ['table_name', 'key', 'version'],
+                    select([literal(table.name), table.c.pk,
+                        literal(version)]).where(column.in_(chunk))))
+            count += self.db.execute(
+                    table.delete().where(column.in_(chunk))).rowcount
+        self._refresh_workloads(affected)
+        self.invalidate_lookups(*[model_class for model_class in
+            (Opportunity, Cable, Batch)
+            if model_class.__table__ is column.table])
+        return count
+
+    def _iter_chunked(self, query, chunk_size):
+        """ Iterate over the objects of ``query``, fetching and buffering
+        only ``chunk_size`` rows at a time.
+
+        Once the next chunk is started the unmodified objects of the
+        previous one are expunged from the session, so memory stays bounded
+        as long as the caller doesn't keep references to them. Expunged
+        objects can't lazy load their relationships any more.
+        """
+        chunk = []
+        for obj in query.yield_per(chunk_size):
+            if len(chunk) == chunk_size:
+                self._expunge_unmodified(chunk)
+                chunk = []
+            chunk.append(obj)
+            yield obj
+        self._expunge_unmodified(chunk)
+
+    def _expunge_unmodified(self, objects):
+        for obj in objects:
+            if obj in self.db and not self.db.is_modified(obj):
+                self.db.expunge(obj)
+
+    def _changed_records(self, model_class, records):
+        """ The update ``records`` whose values differ from their row."""
+        table = model_class.__table__
+        names = sorted(set(name for record in records for name in record
+            if name in table.c and name not in ('pk', 'version')))
+        current = {}
+        for chunk in chunks([record['pk'] for record in records]):
+            current.update((row[0], row) for row in self.db.execute(
+                select([table.c.pk] + [table.c[name] for name in names])\
+                        .where(table.c.pk.in_(chunk))))
+
+        def missing(value):
+            # sqlite stores NaN as NULL
+            return value is None or value != value
+
+        def same(a, b):
+            return a == b or (missing(a) and missing(b))
+
+        positions = dict((name, idx + 1) for idx, name in enumerate(names))
+        return [record for record in records if record['pk'] not in current
+                or not all(same(value, current[record['pk']][positions[name]])
+                    for (name, value) in record.items() if name in positions)]
+
+    @call_in_savepoint
+    def _bulk_upsert(self, model_class, records, keys, existing):
+        """ Split ``records`` into inserts and updates and write them in a
+        single transaction.
+
+        Arguments
+        ---------
+        model_class : the mapped class to write
+        records : list of dict
+        keys : the lookup key of every record (``None`` : always insert)
+        existing : dict mapping the keys found in the table to their pk
+
+        Returns
+        -------
+        pks : list of the primary keys in input order
+        """
+        # owners : the existing pk, or the record inserting the row
+        inserts, updates, owners = [], [], []
+        for key, record in zip(keys, records):
+            owner = existing.get(key) if key is not None else None
+            if owner is None:
+                if key is not None:
+                    existing[key] = record
+                inserts.append(record)
+                owners.append(record)
+            else:
+                updates.append(record)
+                owners.append(owner)
+
+        fresh = [record for record in inserts if record.get('pk') is None]
+        for record, pk in zip(fresh, self.new_pks(model_class, len(fresh))):
+            record['pk'] = pk
+        pks = [owner['pk'] if isinstance(owner, dict) else owner
+               for owner in owners]
+        for record, pk in zip(records, pks):
+            record['pk'] = pk
+
+        # rewriting unchanged rows would give them a new version
+        updates = self._changed_records(model_class, updates)
+        if model_class in VERSIONED_CLASSES and (inserts or updates):
+            version = self._next_version()
+            for record in inserts + updates:
+                record['version'] = version
+
+        pk_column = model_class.__table__.c.pk
+        try:
+            # the opportunities the updated rows belong to before and after
+            affected = self._workload_opportunities(pk_column,
+                    [record['pk'] for record in updates])
+            if inserts:
+                self.db.bulk_insert_mappings(model_class, inserts)
+            if updates:
+                self.db.bulk_update_mappings(model_class, updates)
+                self.invalidate_lookups(model_class)
+            affected.update(self._workload_opportunities(pk_column,
+                    [record['pk'] for record in inserts + updates]))
+            self._refresh_workloads(affected)
+        except (IntegrityError, FlushError) as e:
+            self.rollback()
+            raise InvalidEntry(*e.args)
+        self.commit()
+        return pks
 
 
     # OPPORTUNITIES -----------------------------------------------------------
@@ -384,6 +1662,29 @@ class DBHandler(object):
         """ A list of all opportunities in the database."""
         return self.db.query(Opportunity).all()
 
+    def opportunities_with(self, cables=False, batches=False):
+        """ A list of all opportunities in the database, with the requested
+        relationships loaded in a constant number of queries.
+
+        Arguments
+        ---------
+        cables : bool
+            load ``opportunity.cables``
+        batches : bool
+            load ``opportunity.cables[..].batches`` (implies ``cables``)
+
+        Returns
+        -------
+        list of :class:`BruggCablesKTI.db.model.Opportunity`
+        """
+        query = self.db.query(Opportunity)
+        if cables or batches:
+            option = selectinload(Opportunity.cables)
+            if batches:
+                option = option.selectinload(Cable.batches)
+            query = query.options(option)
+        return query.all()
+
     def add_opportunity(self, brugg_cables_id, **kwargs):
         """ Add a new opportunity to the database.
 
@@ -400,11 +1701,7 @@ class DBHandler(object):
         """
         opportunity = Opportunity(brugg_cables_id=brugg_cables_id, **kwargs)
         self.db.add(opportunity)
-        try:
-            self.db.commit()
-        except (IntegrityError, FlushError) as e:
-            self.db.rollback()
-            raise InvalidEntry(*e.args)
+        self.commit()
         return opportunity
 
 
@@ -419,7 +1716,34 @@ class DBHandler(object):
         Returns
         -------
         opportunity : :class:`BruggCablesKTI.db.model.Opportunity`
+
+        The objects are cached, repeated lookups don't query the database
+        until the next commit expires the object, see :meth:`cache_info`.
         """
+        return self._cached_lookup(Opportunity, brugg_cables_id,
+                self._load_opportunity)
+
+    def find_opportunities_many(self, brugg_cables_ids):
+        """ Find many opportunities with a few queries.
+
+        Arguments
+        ---------
+        brugg_cables_ids: list of int
+            the ids of the opportunities used by Brugg Cables, repetitions
+            are allowed
+
+        Returns
+        -------
+        opportunities : list of :class:`BruggCablesKTI.db.model.Opportunity`
+            in the order of ``brugg_cables_ids``
+
+        Raises MissingEntry listing all the ids not found. The objects are
+        shared with the cache of :meth:`find_opportunity`.
+        """
+        return self._find_many(self.db.query(Opportunity),
+                Opportunity.brugg_cables_id, brugg_cables_ids)
+
+    def _load_opportunity(self, brugg_cables_id):
         try:
             opportunity = self.db.query(Opportunity)\
                 .filter(Opportunity.brugg_cables_id == brugg_cables_id)\
@@ -451,14 +1775,39 @@ class DBHandler(object):
         else:
             for attr in kwargs:
                 setattr(opportunity, attr, kwargs[attr])
-            try:
-                self.db.commit()
-            except (IntegrityError, FlushError) as e:
-                self.db.rollback()
-                raise InvalidEntry(*e.args)
+            self.commit()
         return opportunity
 
 
+    def bulk_upsert_opportunities(self, records):
+        """ Update or create many opportunities in a single transaction.
+
+        Existing opportunities are resolved by their ``brugg_cables_id`` with
+        one query (per :data:`IN_CLAUSE_CHUNK` keys), records without a
+        ``brugg_cables_id`` are always inserted.
+
+        Arguments
+        ---------
+        records : list of dict
+            keyword arguments for the
+            :class:`BruggCablesKTI.db.model.Opportunity`, each including
+            ``brugg_cables_id``
+
+        Returns
+        -------
+        pks : list of the opportunity primary keys in input order
+        """
+        records = [dict(record) for record in records]
+        ids = set(r.get('brugg_cables_id') for r in records) - set([None])
+        existing = {}
+        for ids_chunk in chunks(ids):
+            existing.update(self.db.query(
+                    Opportunity.brugg_cables_id, Opportunity.pk)\
+                .filter(Opportunity.brugg_cables_id.in_(ids_chunk)))
+        keys = [r.get('brugg_cables_id') for r in records]
+        return self._bulk_upsert(Opportunity, records, keys, existing)
+
+
     def remove_opportunity(self, brugg_cables_id):
         """ Deletes an existing Opportunity from the database.
 
@@ -467,16 +1816,30 @@ class DBHandler(object):
         brugg_cables_id: int
             the Brugg Cables internal id of the opportunity to delete
         """
-        opportunity = self.find_opportunity(brugg_cables_id)
-        # delete all associated batches too
-        for cable in opportunity.cables:
-            self.remove_cable(cable.pk)
-        self.db.delete(opportunity)
-        try:
-            self.db.commit()
-        except (IntegrityError, FlushError) as e:
-            self.db.rollback()
-            raise InvalidEntry(*e.args)
+        self.find_opportunity(brugg_cables_id)
+        self.remove_opportunities([brugg_cables_id])
+
+    def remove_opportunities(self, brugg_cables_ids):
+        """ Deletes many Opportunities, their cables and batches from the
+        database with a few set-based statements.
+
+        Arguments
+        ---------
+        brugg_cables_ids: list of int
+            the Brugg Cables internal ids of the opportunities to delete
+
+        Returns
+        -------
+        count : the number of deleted opportunities
+        """
+        opportunities = Opportunity.__table__
+        pks = self._keys_in(opportunities.c.pk,
+                opportunities.c.brugg_cables_id, brugg_cables_ids)
+        with self.transaction():
+            self.remove_cables(self._keys_in(Cable.__table__.c.pk,
+                Cable.__table__.c.opportunity_pk, pks))
+            count = self._delete_in(opportunities.c.pk, pks)
+        return count
 
 
     def select_opportunity(self, start_date, end_date):
@@ -507,6 +1870,28 @@ class DBHandler(object):
         """ A list of all cables in the database."""
         return self.db.query(Cable).all()
 
+    def cables_with(self, opportunity=False, batches=False):
+        """ A list of all cables in the database, with the requested
+        relationships loaded in a constant number of queries.
+
+        Arguments
+        ---------
+        opportunity : bool
+            load ``cable.opportunity``
+        batches : bool
+            load ``cable.batches``
+
+        Returns
+        -------
+        list of :class:`BruggCablesKTI.db.model.Cable`
+        """
+        query = self.db.query(Cable)
+        if opportunity:
+            query = query.options(joinedload(Cable.opportunity))
+        if batches:
+            query = query.options(selectinload(Cable.batches))
+        return query.all()
+
     def add_cable(self, opportunity_pk, **kwargs):
         """ Add a new cable to the database.
 
@@ -523,11 +1908,7 @@ class DBHandler(object):
         """
         cable = Cable(opportunity_pk=opportunity_pk, **kwargs)
         self.db.add(cable)
-        try:
-            self.db.commit()
-        except (IntegrityError, FlushError) as e:
-            self.db.rollback()
-            raise InvalidEntry(*e.args)
+        self.commit()
         return cable
 
     def find_cable(self, pk):
@@ -541,7 +1922,36 @@ class DBHandler(object):
         Returns
         -------
         cable: :class:`BruggCablesKTI.db.model.Cable`
+
+        The objects are cached, repeated lookups don't query the database
+        until the next commit expires the object, see :meth:`cache_info`.
         """
+        return self._cached_lookup(Cable, pk, self._load_cable)
+
+    def find_cables_many(self, pks, opportunity=False):
+        """ Find many cables with a few queries.
+
+        Arguments
+        ---------
+        pks : list of str
+            the primary keys of the cables, repetitions are allowed
+        opportunity : bool
+            load ``cable.opportunity`` of the cables not cached yet
+
+        Returns
+        -------
+        cables : list of :class:`BruggCablesKTI.db.model.Cable`
+            in the order of ``pks``
+
+        Raises MissingEntry listing all the keys not found. The objects are
+        shared with the cache of :meth:`find_cable`.
+        """
+        query = self.db.query(Cable)
+        if opportunity:
+            query = query.options(joinedload(Cable.opportunity))
+        return self._find_many(query, Cable.pk, pks)
+
+    def _load_cable(self, pk):
         try:
             cable = self.db.query(Cable).filter(Cable.pk == pk).one()
         except NoResultFound:
@@ -572,13 +1982,47 @@ class DBHandler(object):
         else:
             for attr in kwargs:
                 setattr(cable, attr, kwargs[attr])
-            try:
-                self.db.commit()
-            except (IntegrityError, FlushError) as e:
-                self.db.rollback()
-                raise InvalidEntry(*e.args)
+            self.commit()
         return cable
 
+    def bulk_upsert_cables(self, records):
+        """ Update or create many cables in a single transaction.
+
+        A record updates the existing cable with the same ``pk`` or, without
+        ``pk``, the existing cable of the same opportunity with the same
+        :data:`Cable.NATURAL_KEY` attributes. All the other records are
+        inserted (with their ``pk`` if given).
+
+        Arguments
+        ---------
+        records : list of dict
+            keyword arguments for the :class:`BruggCablesKTI.db.model.Cable`,
+            the opportunity has to be given as ``opportunity_pk``
+
+        Returns
+        -------
+        pks : list of the cable primary keys in input order
+        """
+        records = [dict(record) for record in records]
+        pks = set(r.get('pk') for r in records) - set([None])
+        opportunity_pks = set(r.get('opportunity_pk') for r in records) - \
+                set([None])
+        existing = {}
+        for pks_chunk in chunks(pks):
+            existing.update((pk, pk) for (pk, ) in
+                self.db.query(Cable.pk).filter(Cable.pk.in_(pks_chunk)))
+        natural_columns = [getattr(Cable, name) for name in Cable.NATURAL_KEY]
+        for opportunity_pks_chunk in chunks(opportunity_pks):
+            for row in self.db.query(Cable.pk, *natural_columns)\
+                    .filter(Cable.opportunity_pk.in_(opportunity_pks_chunk))\
+                    .order_by(Cable.pk):
+                # the first of identical cables is the one updated
+                existing.setdefault(Cable.natural_key(row[1:]), row[0])
+        keys = [r['pk'] if r.get('pk') is not None else
+                Cable.natural_key(r.get(name) for name in Cable.NATURAL_KEY)
+                for r in records]
+        return self._bulk_upsert(Cable, records, keys, existing)
+
     def remove_cable(self, pk):
         """ Deletes an existing Cable from the database.
 
@@ -587,16 +2031,28 @@ class DBHandler(object):
         pk: string
             The primary key used in our database table.
         """
-        cable = self.find_cable(pk)
-        # delete all associated batches too
-        for batch in cable.cables:
-            self.remove_batch(batch.pk)
-        self.db.delete(cable)
-        try:
-            self.db.commit()
-        except (IntegrityError, FlushError) as e:
-            self.db.rollback()
-            raise InvalidEntry(*e.args)
+        self.find_cable(pk)
+        self.remove_cables([pk])
+
+    def remove_cables(self, pks):
+        """ Deletes many Cables and their batches from the database with a
+        few set-based statements.
+
+        Arguments
+        ---------
+        pks: list of str
+            the primary keys of the cables to delete
+
+        Returns
+        -------
+        count : the number of deleted cables
+        """
+        cables = Cable.__table__
+        with self.transaction():
+            self.remove_batches(self._keys_in(Batch.__table__.c.pk,
+                Batch.__table__.c.cable_pk, pks))
+            count = self._delete_in(cables.c.pk, pks)
+        return count
 
 
     # BATCHES -----------------------------------------------------------------
@@ -605,6 +2061,156 @@ class DBHandler(object):
         """ A list of all batches in the database."""
         return self.db.query(Batch).all()
 
+    def iter_batches(self, chunk_size=1000):
+        """ Iterate over all batches in the database in bounded
+        memory.
+
+        The objects of a chunk are expunged from the session once the next
+        chunk is fetched, don't keep references to them.
+
+        Arguments
+        ---------
+        chunk_size : int
+            the number of rows fetched at a time
+
+        Returns
+        -------
+        generator of :class:`BruggCablesKTI.db.model.Batch`
+        """
+        return self._iter_chunked(self.db.query(Batch), chunk_size)
+
+    def batches_with(self, cable=False, opportunity=False):
+        """ A list of all batches in the database, with the requested
+        relationships loaded in a single joined query.
+
+        Arguments
+        ---------
+        cable : bool
+            load ``batch.cable``
+        opportunity : bool
+            load ``batch.cable.opportunity`` (implies ``cable``)
+
+        Returns
+        -------
+        list of :class:`BruggCablesKTI.db.model.Batch`
+        """
+        return self._load_batch_graph(self.db.query(Batch),
+                cable=cable, opportunity=opportunity).all()
+
+    def load_batch_arrays(self, epoch=ARRAY_EPOCH):
+        """ A columnar snapshot of all batches with their cable and
+        opportunity attributes, read with a single joined query.
+
+        Categorical columns are integer codes into the corresponding tuple of
+        the model, e.g. ``Cable.KINDS[cable_kind[i]]``. Related rows are coded
+        by their position in the ``cable_pks`` and ``opportunity_pks`` arrays.
+        Missing categories and relations are coded as -1. Dates are hours
+        since ``epoch`` as int64, missing dates are :data:`MISSING_HOURS`,
+        missing floats are NaN.
+
+        Arguments
+        ---------
+        epoch : datetime.datetime
+            reference time of the hour stamps
+
+        Returns
+        -------
+        arrays : dict of numpy.ndarray, one entry per batch in every column
+            'pk', 'number', 'workload', 'delivery_date', 'potential_type',
+            'cable', 'cable_voltage', 'cable_area', 'cable_kind',
+            'cable_production_line', 'opportunity', 'opportunity_id',
+            'opportunity_kind', 'opportunity_revenue', 'opportunity_margin',
+            'opportunity_probability', plus the lookup arrays 'cable_pks' and
+            'opportunity_pks'
+        """
+        batches, cables = Batch.__table__, Cable.__table__
+        opportunities = Opportunity.__table__
+        query = select([
+                batches.c.pk, batches.c.number, batches.c.workload,
+                batches.c.delivery_date, batches.c.potential_type,
+                cables.c.pk, cables.c.voltage, cables.c.area, cables.c.kind,
+                cables.c.production_line, opportunities.c.pk,
+                opportunities.c.brugg_cables_id, opportunities.c.kind,
+                opportunities.c.revenue, opportunities.c.margin,
+                opportunities.c.probability,
+                ])\
+            .select_from(batches.outerjoin(cables).outerjoin(opportunities))\
+            .order_by(batches.c.pk)
+        rows = self.db.execute(query).fetchall()
+        columns = list(zip(*rows)) if rows else [()] * 16
+
+        def floats(column):
+            return np.array([np.nan if v is None else v for v in column],
+                    dtype=np.float64)
+
+        def codes(column, categories):
+            lookup = dict((c, i) for (i, c) in enumerate(categories))
+            return np.fromiter((lookup.get(v, -1) for v in column),
+                    dtype=np.int8, count=len(column))
+
+        def keys(column):
+            lookup = {}
+            codes = np.fromiter((-1 if v is None else
+                    lookup.setdefault(v, len(lookup)) for v in column),
+                    dtype=np.int64, count=len(column))
+            uniques = np.empty(len(lookup), dtype=object)
+            uniques[:] = list(lookup)
+            return uniques, codes
+
+        dates = np.array(columns[3], dtype='datetime64[h]')
+        hours = dates.astype(np.int64) - np.datetime64(epoch, 'h').astype(
+                np.int64)
+        hours[np.isnat(dates)] = MISSING_HOURS
+
+        cable_pks, cable_codes = keys(columns[5])
+        opportunity_pks, opportunity_codes = keys(columns[10])
+
+        return {
+            'pk': np.array(columns[0], dtype=object),
+            'number': np.array(columns[1], dtype=np.int64),
+            'workload': floats(columns[2]),
+            'delivery_date': hours,
+            'potential_type': codes(columns[4], Batch.POTENTIAL_TYPES),
+            'cable': cable_codes,
+            'cable_pks': cable_pks,
+            'cable_voltage': floats(columns[6]),
+            'cable_area': floats(columns[7]),
+            'cable_kind': codes(columns[8], Cable.KINDS),
+            'cable_production_line': codes(columns[9],
+                    Cable.PRODUCTION_LINES),
+            'opportunity': opportunity_codes,
+            'opportunity_pks': opportunity_pks,
+            'opportunity_id': np.array([-1 if v is None else v
+                    for v in columns[11]], dtype=np.int64),
+            'opportunity_kind': codes(columns[12], Opportunity.KINDS),
+            'opportunity_revenue': floats(columns[13]),
+            'opportunity_margin': floats(columns[14]),
+            'opportunity_probability': floats(columns[15]),
+        }
+
+    def _load_batch_graph(self, query, cable=False, opportunity=False,
+            cable_batches=False, opportunity_batches=False):
+        """ Add the joined loading of ``Batch.cable(.opportunity)`` to a
+        query on batches, and the loading of ``Batch.cable.batches`` or
+        ``Batch.cable.opportunity.cables[..].batches`` with one more query
+        per relationship."""
+        if opportunity_batches:
+            opportunity = True
+        if cable or opportunity or cable_batches:
+            option = joinedload(Batch.cable)
+            if opportunity:
+                option = option.joinedload(Cable.opportunity)
+            query = query.options(option)
+        if cable_batches:
+            query = query.options(
+                    joinedload(Batch.cable).selectinload(Cable.batches))
+        if opportunity_batches:
+            query = query.options(joinedload(Batch.cable)\
+                    .joinedload(Cable.opportunity)\
+                    .selectinload(Opportunity.cables)\
+                    .selectinload(Cable.batches))
+        return query
+
     def add_batch(self, **kwargs):
         """ Add a new batch to the database.
 
@@ -621,11 +2227,7 @@ class DBHandler(object):
         """
         batch = Batch(**kwargs)
         self.db.add(batch)
-        try:
-            self.db.commit()
-        except (IntegrityError, FlushError) as e:
-            self.db.rollback()
-            raise InvalidEntry(*e.args)
+        self.commit()
         return batch
 
     def find_batch(self, pk):
@@ -639,7 +2241,42 @@ class DBHandler(object):
         Returns
         -------
         batch: :class:`BruggCablesKTI.db.model.Batch`
+
+        The objects are cached, repeated lookups don't query the database
+        until the next commit expires the object, see :meth:`cache_info`.
+        """
+        return self._cached_lookup(Batch, pk, self._load_batch)
+
+    def find_batches_many(self, pks, cable=False, opportunity=False,
+            opportunity_batches=False):
+        """ Find many batches with a few queries.
+
+        Arguments
+        ---------
+        pks : list of str
+            the primary keys of the batches, repetitions are allowed
+        cable : bool
+            load ``batch.cable`` of the batches not cached yet
+        opportunity : bool
+            load ``batch.cable.opportunity`` (implies ``cable``)
+        opportunity_batches : bool
+            load ``batch.cable.opportunity.cables[..].batches``, all the
+            batches of the opportunities (implies ``opportunity``)
+
+        Returns
+        -------
+        batches : list of :class:`BruggCablesKTI.db.model.Batch`
+            in the order of ``pks``
+
+        Raises MissingEntry listing all the keys not found. The objects are
+        shared with the cache of :meth:`find_batch`.
         """
+        query = self._load_batch_graph(self.db.query(Batch), cable=cable,
+                opportunity=opportunity,
+                opportunity_batches=opportunity_batches)
+        return self._find_many(query, Batch.pk, pks)
+
+    def _load_batch(self, pk):
         try:
             batch = self.db.query(Batch)\
                 .filter(Batch.pk == pk)\
@@ -671,13 +2308,41 @@ class DBHandler(object):
         else:
             for attr in kwargs:
                 setattr(batch, attr, kwargs[attr])
-            try:
-                self.db.commit()
-            except (IntegrityError, FlushError) as e:
-                self.db.rollback()
-                raise InvalidEntry(*e.args)
+            self.commit()
         return batch
 
+    def bulk_upsert_batches(self, records):
+        """ Update or create many batches in a single transaction.
+
+        A record updates the existing batch with the same ``pk`` or, without
+        ``pk``, the existing batch with the same ``(cable_pk, number)``. All
+        the other records are inserted.
+
+        Arguments
+        ---------
+        records : list of dict
+            keyword arguments for the :class:`BruggCablesKTI.db.model.Batch`
+
+        Returns
+        -------
+        pks : list of the batch primary keys in input order
+        """
+        records = [dict(record) for record in records]
+        pks = set(r.get('pk') for r in records) - set([None])
+        cable_pks = set(r.get('cable_pk') for r in records) - set([None])
+        existing = {}
+        for pks_chunk in chunks(pks):
+            existing.update((pk, pk) for (pk, ) in
+                self.db.query(Batch.pk).filter(Batch.pk.in_(pks_chunk)))
+        for cable_pks_chunk in chunks(cable_pks):
+            existing.update(((cable_pk, number), pk)
+                for (cable_pk, number, pk) in
+                self.db.query(Batch.cable_pk, Batch.number, Batch.pk)\
+                    .filter(Batch.cable_pk.in_(cable_pks_chunk)))
+        keys = [r['pk'] if r.get('pk') is not None
+                else (r.get('cable_pk'), r.get('number')) for r in records]
+        return self._bulk_upsert(Batch, records, keys, existing)
+
     def remove_batch(self, pk):
         """ Deletes an existing Batch from the database.
 
@@ -686,18 +2351,59 @@ class DBHandler(object):
         pk: str
             the primary key of Batch used in our table
         """
-        batch = self.find_batch(pk)
-        # delete all associated first_selection_items too
-        for fsi in batch.first_selection_items:
-            self.remove_first_selection_item(fsi.pk)
-        self.db.delete(batch)
-        try:
-            self.db.commit()
-        except (IntegrityError, FlushError) as e:
-            self.db.rollback()
-            raise InvalidEntry(*e.args)
+        self.find_batch(pk)
+        self.remove_batches([pk])
+
+    def batches_beyond(self, counts):
+        """ The batches numbered past the given count of their cable.
+
+        Arguments
+        ---------
+        counts : dict
+            mapping cable primary keys to their number of batches
 
-    def select_batch_timerange(self, start_date, end_date, batch_number=0):
+        Returns
+        -------
+        pks : list of the primary keys of the batches with
+            ``number >= counts[cable_pk]``
+        """
+        pks = []
+        for chunk in chunks(list(counts)):
+            pks.extend(pk for (pk, cable_pk, number) in
+                self.db.query(Batch.pk, Batch.cable_pk, Batch.number)\
+                    .filter(Batch.cable_pk.in_(chunk))
+                if number >= counts[cable_pk])
+        return pks
+
+    def remove_batches(self, pks):
+        """ Deletes many Batches from the database with a few set-based
+        statements, together with their first selection items and production
+        slots.
+
+        The ordinals of the batches are never handed out again, so the
+        bitmap schedules and selection sets still holding them are left
+        alone, they only select the remaining batches.
+
+        Arguments
+        ---------
+        pks: list of str
+            the primary keys of the batches to delete
+
+        Returns
+        -------
+        count : the number of deleted batches
+        """
+        pks = list(pks)
+        batches = Batch.__table__
+        with self.transaction():
+            self._delete_in(FirstSelectionItem.__table__.c.batch_pk, pks)
+            self._delete_in(ProductionSlot.__table__.c.batch_pk, pks)
+            count = self._delete_in(batches.c.pk, pks)
+            self.clear_first_selection_index()
+        return count
+
+    def select_batch_timerange(self, start_date, end_date, batch_number=0,
+            opportunity=False, cable_batches=False):
             """ return batches with delivery date within a
                 specified time range.
 
@@ -707,6 +2413,10 @@ class DBHandler(object):
             end_date : end date of the selected interval
 
             batch_number : (defaults to 0) the batch number
+            opportunity : (defaults to False) load ``batch.cable.opportunity``
+                in the same query
+            cable_batches : (defaults to False) load ``batch.cable.batches``,
+                all the batches of the cables, with one more query
 
             Returns
             -------
@@ -717,7 +2427,9 @@ class DBHandler(object):
                              Batch.delivery_date >= start_date,
                              Batch.number==batch_number)
 
-            return self.db.query(Batch).filter(selection).all()
+            query = self.db.query(Batch).filter(selection)
+            return self._load_batch_graph(query, opportunity=opportunity,
+                    cable_batches=cable_batches).all()
 
 
     # FIRST_SELCTION ----------------------------------------------------------
@@ -726,6 +2438,7 @@ class DBHandler(object):
         """ A list of all first_selections in the database."""
         return self.db.query(FirstSelection).all()
 
+    @call_in_savepoint
     def add_first_selection(self, batches=[], **kwargs):
         """ Add a new first_selection to the database.
 
@@ -743,11 +2456,7 @@ class DBHandler(object):
 
         first_selection = FirstSelection(**kwargs)
         self.db.add(first_selection)
-        try:
-            self.db.commit()
-        except (IntegrityError, FlushError) as e:
-            self.db.rollback()
-            raise InvalidEntry(*e.args)
+        self.clear_first_selection_index()
 
         # DEPRECATED : massive speedups by bulk_insert
         #for batch_pk in batches:
@@ -756,15 +2465,17 @@ class DBHandler(object):
                     #first_selection=first_selection)
     
         # BULK INSERT FIRST SELECTION ITEMS
-        self.db.bulk_insert_mappings(FirstSelectionItem,
-                [ { 'batch_pk': batch_pk,
-                    'first_selection_pk': first_selection.pk }
-             for batch_pk in batches ])
         try:
-            self.db.commit()
+            # the first selection has to exist before its items
+            self.db.flush()
+            self.db.bulk_insert_mappings(FirstSelectionItem,
+                    [ { 'batch_pk': batch_pk,
+                        'first_selection_pk': first_selection.pk }
+                 for batch_pk in batches ])
         except (IntegrityError, FlushError) as e:
-            self.db.rollback()
-            raise InvalidEntry(*e.args)    
+            self.rollback()
+            raise InvalidEntry(*e.args)
+        self.commit()
 
         return first_selection
 
@@ -811,11 +2522,8 @@ class DBHandler(object):
         else:
             for attr in kwargs:
                 setattr(first_selection, attr, kwargs[attr])
-            try:
-                self.db.commit()
-            except (IntegrityError, FlushError) as e:
-                self.db.rollback()
-                raise InvalidEntry(*e.args)
+            self.clear_first_selection_index()
+            self.commit()
         return first_selection
 
     def remove_first_selection(self, pk):
@@ -826,35 +2534,246 @@ class DBHandler(object):
         pk: str
             the primary key of FirstSelection used in our table
         """
-        first_selection = self.find_first_selection(pk)
-        # delete all associated first_selection_items too
-        for fsi in first_selection.first_selection_items:
-            self.remove_first_selection_item(fsi.pk)
-        self.db.delete(first_selection)
-        try:
-            self.db.commit()
-        except (IntegrityError, FlushError) as e:
-            self.db.rollback()
-            raise InvalidEntry(*e.args)
+        self.find_first_selection(pk)
+        self.remove_first_selections([pk])
+
+    def remove_first_selections(self, pks):
+        """ Deletes many FirstSelections and their items from the database
+        with a few set-based statements.
+
+        Arguments
+        ---------
+        pks: list of str
+            the primary keys of the first selections to delete
+
+        Returns
+        -------
+        count : the number of deleted first selections
+        """
+        with self.transaction():
+            self._delete_in(
+                    FirstSelectionItem.__table__.c.first_selection_pk, pks)
+            count = self._delete_in(FirstSelection.__table__.c.pk, pks)
+            # the sets no other first selection refers to
+            first_selections = FirstSelection.__table__
+            sets = SelectionSet.__table__
+            self.db.execute(sets.delete().where(sets.c.digest.notin_(
+                select([first_selections.c.selection_digest]).where(
+                    first_selections.c.selection_digest.isnot(None)))))
+            self.clear_first_selection_index()
+        return count
+
+    def add_first_selections_bulk(self, selections,
+            chunk_size=BULK_INSERT_CHUNK, **kwargs):
+        """ Add many new first selections at once, content addressed.
+
+        Every distinct set of batches is stored once, as a
+        :class:`SelectionSet` keyed by the hash of its batch ordinals, and
+        the first selections refer to it by its digest. Recurring sets cost
+        a single small row per first selection. Their batches are read with
+        :attr:`FirstSelection.selected_batches`, they have no items.
+        ``selections`` is consumed lazily and written with ``executemany``
+        inserts of about ``chunk_size`` batches, all inside a single
+        transaction.
+
+        Arguments
+        ---------
+        selections : iterable of lists of batch primary keys
+        chunk_size : int
+            the number of batches buffered before writing
+        `**kwargs` : dict
+            other columns of all the first selections, e.g.
+            ``cluster_number``
+
+        Returns
+        -------
+        pks : list of the primary keys of the new first selections
+        """
+        from BruggCablesKTI import log
+
+        sets = SelectionSet.__table__
+        first_selections = FirstSelection.__table__
+        pks, buffered, n_batches = [], [], 0
+        n_sets = 0
+        start_time = time.time()
+        ordinals = {}
+
+        def write(buffered):
+            ordinals.update(self.batch_ordinals(set(batch_pk
+                for batches in buffered for batch_pk in batches
+                if batch_pk not in ordinals)))
+            new_sets = {}
+            digests = []
+            for batches in buffered:
+                members = np.unique(np.array([ordinals[batch_pk]
+                    for batch_pk in batches], dtype=np.int64))
+                digest = bitsets.digest(members)
+                digests.append(digest)
+                if digest not in new_sets:
+                    new_sets[digest] = {'digest': digest,
+                            'membership': bitsets.encode(members),
+                            'size': len(members)}
+            for digest in self._keys_in(sets.c.digest, sets.c.digest,
+                    list(new_sets)):
+                del new_sets[digest]
+
+            selection_pks = self.new_pks(FirstSelection, len(buffered))
+            try:
+                if new_sets:
+                    self.db.execute(sets.insert(), list(new_sets.values()))
+                self.db.execute(first_selections.insert(), [
+                    dict(kwargs, pk=pk, selection_digest=digest)
+                    for (pk, digest) in zip(selection_pks, digests) ])
+            except IntegrityError as e:
+                raise InvalidEntry(*e.args)
+            pks.extend(selection_pks)
+            return len(new_sets)
+
+        self.clear_first_selection_index()
+        with self.transaction():
+            for batches in selections:
+                batches = list(batches)
+                buffered.append(batches)
+                n_batches += len(batches)
+                if n_batches >= chunk_size:
+                    n_sets += write(buffered)
+                    buffered, n_batches = [], 0
+            if buffered:
+                n_sets += write(buffered)
+
+        elapsed = time.time() - start_time
+        log.get_logger().info('Wrote {} first selections ({} new sets) in '
+                '{:.1f} s'.format(len(pks), n_sets, elapsed))
+        return pks
 
     def select_first_selection(self, cluster_number, element_number = None):
             """ returns first selection items for a given cluster.
 
+            The keys of a cluster are read once and cached, so looking up
+            elements one by one costs O(1) each.
+
             Arguments
             ---------
             cluster_number : number of the selected clister
+            element_number : (defaults to None) the position of a single
+                first selection within the cluster
 
             Returns
             -------
             list of first selections : :class:`BruggCablesKTI.db.model.FirstSelection`
+                rows ``(pk, )``, or the pk at ``element_number``
             """
 
-            selection = FirstSelection.cluster_number == cluster_number
+            rows = self._first_selection_index.get(cluster_number)
+            if rows is None:
+                selection = FirstSelection.cluster_number == cluster_number
+                rows = self.db.query(FirstSelection.pk).filter(selection)\
+                        .order_by(*FIRST_SELECTION_ORDER).all()
+                self._first_selection_index[cluster_number] = rows
             if element_number == None:
-                return self.db.query(FirstSelection.pk).filter(selection).all()
+                return list(rows)
+            else:
+                return rows[int(element_number)][0]
+
+    def first_selection_membership(self, cluster_number):
+        """ The batches of all first selections of a cluster as a sparse
+        (selection x batch) matrix in CSR form, read with a single query.
+
+        The batches of the i-th first selection (in the order of
+        :meth:`select_first_selection`) are
+        ``batches[indices[offsets[i]:offsets[i+1]]]``. With scipy the
+        matrix is ``csr_matrix((np.ones(len(indices)), indices, offsets))``.
+
+        Arguments
+        ---------
+        cluster_number : number of the selected cluster
+
+        Returns
+        -------
+        membership : dict of numpy.ndarray
+            'first_selections' : the first selection pks (rows)
+            'batches' : the batch pks (columns)
+            'offsets' : int64, the row pointers, ``len(first_selections)+1``
+            'indices' : int64, the column of every member batch
+            'workload' : float64, the total batch workload per selection
+        """
+        first_selections = FirstSelection.__table__
+        items = FirstSelectionItem.__table__
+        batches = Batch.__table__
+        sets = SelectionSet.__table__
+        in_cluster = first_selections.c.cluster_number == cluster_number
+        rows = self.db.execute(
+                select([first_selections.c.pk, sets.c.membership])\
+                .select_from(first_selections.outerjoin(sets))\
+                .where(in_cluster)\
+                .order_by(*FIRST_SELECTION_ORDER)).fetchall()
+
+        # the members of the content addressed selections, decoded once
+        # per distinct set ..
+        members = {}
+        for (selection_pk, membership) in rows:
+            if membership is not None and membership not in members:
+                members[membership] = bitsets.decode(membership)
+        by_ordinal = {}
+        if members:
+            for chunk in chunks(np.unique(np.concatenate(
+                    list(members.values()))).tolist()):
+                by_ordinal.update((ordinal, (pk, workload))
+                    for (pk, ordinal, workload) in self.db.execute(
+                        select([batches.c.pk, batches.c.ordinal,
+                            batches.c.workload])\
+                        .where(batches.c.ordinal.in_(chunk))))
+        # .. and the ones of the selections stored as items
+        by_item = {}
+        for (selection_pk, batch_pk, workload) in self.db.execute(
+                select([items.c.first_selection_pk, batches.c.pk,
+                    batches.c.workload])\
+                .select_from(first_selections.join(items).join(batches))\
+                .where(and_(in_cluster,
+                    first_selections.c.selection_digest.is_(None)))):
+            by_item.setdefault(selection_pk, []).append((batch_pk, workload))
+
+        selection_pks, selection_rows = [], []
+        batch_codes = {}
+        indices, workloads = [], []
+        for (selection_pk, membership) in rows:
+            selection_pks.append(selection_pk)
+            if membership is None:
+                selected = by_item.get(selection_pk, [])
             else:
-                return (self.db.query(FirstSelection.pk).
-                            filter(selection))[element_number][0]
+                selected = [by_ordinal[ordinal] for ordinal in
+                        members[membership].tolist() if ordinal in by_ordinal]
+            for (batch_pk, workload) in selected:
+                selection_rows.append(len(selection_pks) - 1)
+                indices.append(batch_codes.setdefault(batch_pk,
+                    len(batch_codes)))
+                workloads.append(0. if workload is None else workload)
+
+        # the keys come in the order of select_first_selection(), keep them
+        self._first_selection_index[cluster_number] = \
+                [(pk, ) for pk in selection_pks]
+
+        n_selections = len(selection_pks)
+        counts = np.bincount(selection_rows, minlength=n_selections)
+        offsets = np.zeros(n_selections + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        batch_pks = np.empty(len(batch_codes), dtype=object)
+        batch_pks[:] = list(batch_codes)
+        selection_array = np.empty(n_selections, dtype=object)
+        selection_array[:] = selection_pks
+        return {
+            'first_selections': selection_array,
+            'batches': batch_pks,
+            'offsets': offsets,
+            'indices': np.array(indices, dtype=np.int64),
+            'workload': np.bincount(selection_rows, weights=workloads,
+                minlength=n_selections).astype(np.float64),
+        }
+
+    def clear_first_selection_index(self):
+        """ Forget the cached first selection keys of all clusters, needed
+        after first selections are written without the handler."""
+        self._first_selection_index.clear()
 
     # FIRST_SELCTION_ITEMS ----------------------------------------------------
     @property
@@ -862,6 +2781,25 @@ class DBHandler(object):
         """ A list of all first_selection_items in the database."""
         return self.db.query(FirstSelectionItem).all()
 
+    def iter_first_selection_items(self, chunk_size=1000):
+        """ Iterate over all first_selection_items in the database in bounded
+        memory.
+
+        The objects of a chunk are expunged from the session once the next
+        chunk is fetched, don't keep references to them.
+
+        Arguments
+        ---------
+        chunk_size : int
+            the number of rows fetched at a time
+
+        Returns
+        -------
+        generator of :class:`BruggCablesKTI.db.model.FirstSelectionItem`
+        """
+        return self._iter_chunked(self.db.query(FirstSelectionItem),
+                chunk_size)
+
     def add_first_selection_item(self, **kwargs):
         """ Add a new first_selection_item to the database.
 
@@ -879,11 +2817,7 @@ class DBHandler(object):
         """
         first_selection_item = FirstSelectionItem(**kwargs)
         self.db.add(first_selection_item)
-        try:
-            self.db.commit()
-        except (IntegrityError, FlushError) as e:
-            self.db.rollback()
-            raise InvalidEntry(*e.args)
+        self.commit()
         return first_selection_item
 
     def find_first_selection_item(self, pk):
@@ -929,11 +2863,7 @@ class DBHandler(object):
         else:
             for attr in kwargs:
                 setattr(first_selection_item, attr, kwargs[attr])
-            try:
-                self.db.commit()
-            except (IntegrityError, FlushError) as e:
-                self.db.rollback()
-                raise InvalidEntry(*e.args)
+            self.commit()
         return first_selection_item
 
     def remove_first_selection_item(self, pk):
@@ -947,11 +2877,7 @@ class DBHandler(object):
         first_selection_item = self.find_first_selection_item(pk)
         self.db.delete(first_selection_item)
 
-        try:
-            self.db.commit()
-        except (IntegrityError, FlushError) as e:
-            self.db.rollback()
-            raise InvalidEntry(*e.args)
+        self.commit()
 
 
     # SCHEDULE ----------------------------------------------------------------
@@ -960,12 +2886,143 @@ class DBHandler(object):
         """ A list of all schedules in the database."""
         return self.db.query(Schedule).all()
 
-    def add_schedule(self, batches_end_times=[], **kwargs):
+    def iter_schedules(self, chunk_size=1000):
+        """ Iterate over all schedules in the database in bounded
+        memory.
+
+        The objects of a chunk are expunged from the session once the next
+        chunk is fetched, don't keep references to them.
+
+        Arguments
+        ---------
+        chunk_size : int
+            the number of rows fetched at a time
+
+        Returns
+        -------
+        generator of :class:`BruggCablesKTI.db.model.Schedule`
+        """
+        return self._iter_chunked(self.db.query(Schedule), chunk_size)
+
+    def schedules_with(self, production_slots=False, batches=False,
+            opportunity=False):
+        """ A list of all schedules in the database, with the requested
+        relationships loaded in a constant number of queries.
+
+        Arguments
+        ---------
+        production_slots : bool
+            load ``schedule.production_slots``
+        batches : bool
+            load ``schedule.production_slots[..].batch`` (implies
+            ``production_slots``)
+        opportunity : bool
+            load ``schedule.production_slots[..].batch.cable.opportunity``
+            (implies ``batches``)
+
+        Returns
+        -------
+        list of :class:`BruggCablesKTI.db.model.Schedule`
+        """
+        query = self.db.query(Schedule)
+        if production_slots or batches or opportunity:
+            option = selectinload(Schedule.production_slots)
+            if batches or opportunity:
+                option = option.joinedload(ProductionSlot.batch)
+            if opportunity:
+                option = option.joinedload(Batch.cable)\
+                        .joinedload(Cable.opportunity)
+            query = query.options(option)
+        return query.all()
+
+    def schedule_rows(self, schedule_pk):
+        """ The production slots of a schedule with their batch, cable and
+        opportunity columns, read with a single joined query.
+
+        The rows of a bitmap schedule (see :meth:`add_schedule`) are its
+        batches, with the slot columns None where a batch has no production
+        slot yet.
+
+        Arguments
+        ---------
+        schedule_pk : str
+            the primary key of the schedule
+
+        Returns
+        -------
+        rows : list of dict, one per slot in the order the slots were added
+            (by batch ordinal for a bitmap schedule), with the keys
+            'slot_pk', 'end_time', 'slot_production_line', 'batch_pk',
+            'batch_number', 'workload', 'delivery_date', 'potential_type',
+            'cable_pk', 'cable_kind', 'cable_voltage', 'cable_area',
+            'cable_production_line', 'opportunity_pk', 'opportunity_id',
+            'opportunity_kind', 'opportunity_revenue', 'opportunity_margin',
+            'opportunity_probability'
+        """
+        schedules = Schedule.__table__
+        slots = ProductionSlot.__table__
+        batches, cables = Batch.__table__, Cable.__table__
+        opportunities = Opportunity.__table__
+        found = self.db.execute(select([schedules.c.membership])\
+                .where(schedules.c.pk == schedule_pk)).first()
+        if found is None:
+            raise MissingEntry("No such Schedule: {}".format(schedule_pk))
+
+        columns = [
+            slots.c.pk.label('slot_pk'),
+            slots.c.end_time,
+            slots.c.production_line.label('slot_production_line'),
+            batches.c.pk.label('batch_pk'),
+            batches.c.number.label('batch_number'),
+            batches.c.workload,
+            batches.c.delivery_date,
+            batches.c.potential_type,
+            cables.c.pk.label('cable_pk'),
+            cables.c.kind.label('cable_kind'),
+            cables.c.voltage.label('cable_voltage'),
+            cables.c.area.label('cable_area'),
+            cables.c.production_line.label('cable_production_line'),
+            opportunities.c.pk.label('opportunity_pk'),
+            opportunities.c.brugg_cables_id.label('opportunity_id'),
+            opportunities.c.kind.label('opportunity_kind'),
+            opportunities.c.revenue.label('opportunity_revenue'),
+            opportunities.c.margin.label('opportunity_margin'),
+            opportunities.c.probability.label('opportunity_probability'),
+            ]
+        parents = cables.outerjoin(opportunities,
+                cables.c.opportunity_pk == opportunities.c.pk)
+
+        if found.membership is None:
+            queries = [select(columns)\
+                .select_from(slots.join(batches,
+                    slots.c.batch_pk == batches.c.pk)\
+                    .outerjoin(parents, batches.c.cable_pk == cables.c.pk))\
+                .where(slots.c.schedule_pk == schedule_pk)\
+                .order_by(literal_column('production_slots.rowid'))]
+        else:
+            in_schedule = and_(slots.c.batch_pk == batches.c.pk,
+                    slots.c.schedule_pk == schedule_pk)
+            queries = [select(columns)\
+                .select_from(batches.outerjoin(slots, in_schedule)\
+                    .outerjoin(parents, batches.c.cable_pk == cables.c.pk))\
+                .where(batches.c.ordinal.in_(chunk))\
+                .order_by(batches.c.ordinal)
+                for chunk in chunks(bitsets.decode(found.membership).tolist())]
+
+        return [dict(row) for query in queries
+                for row in self.db.execute(query)]
+
+    @call_in_savepoint
+    def add_schedule(self, batches_end_times=[], bitmap=False, **kwargs):
         """ Add a new schedule to the database.
 
         Arguments
         ---------
         batches_end_times : list of tuples [(batch_pk, end_time), .. ]
+        bitmap : bool
+            store the batches as a compressed bitmap in
+            :attr:`Schedule.membership`, production slots are only created
+            for the batches with an end time
         `**kwargs` : dict
             other keyword arguments to the
             :class:`BruggCablesKTI.db.model.Schedule`
@@ -974,29 +3031,180 @@ class DBHandler(object):
         -------
         schedule: :class:`BruggCablesKTI.db.model.Schedule`
         """
+        batches_end_times = list(batches_end_times)
+        if bitmap:
+            ordinals = self.batch_ordinals(
+                    [batch_pk for (batch_pk, end_time) in batches_end_times])
+            kwargs['membership'] = bitsets.encode(ordinals.values())
+            batches_end_times = [ (batch_pk, end_time) for
+                    (batch_pk, end_time) in batches_end_times
+                    if end_time is not None ]
 
         schedule = Schedule(**kwargs)
         self.db.add(schedule)
-        try:
-            self.db.commit()
-        except (IntegrityError, FlushError) as e:
-            self.db.rollback()
-            raise InvalidEntry(*e.args)
     
         # BULK INSERT ProductionSlot's 
-        self.db.bulk_insert_mappings(ProductionSlot,
-                [ { 'batch_pk': batch_pk,
-                    'end_time': end_time,
-                    'schedule_pk': schedule.pk }
-             for (batch_pk, end_time) in batches_end_times ])
         try:
-            self.db.commit()
+            # the schedule has to exist before its production slots
+            self.db.flush()
+            self.db.bulk_insert_mappings(ProductionSlot,
+                    [ { 'batch_pk': batch_pk,
+                        'end_time': end_time,
+                        'schedule_pk': schedule.pk }
+                 for (batch_pk, end_time) in batches_end_times ])
         except (IntegrityError, FlushError) as e:
-            self.db.rollback()
-            raise InvalidEntry(*e.args)    
+            self.rollback()
+            raise InvalidEntry(*e.args)
+        self.commit()
 
         return schedule
 
+    def add_schedules_bulk(self, schedules, chunk_size=BULK_INSERT_CHUNK,
+            bitmap=False):
+        """ Add many new schedules and their production slots at once.
+
+        The schedule keys are assigned up front and both tables are written
+        with ``executemany`` inserts of about ``chunk_size`` production slots,
+        all inside a single transaction. ``schedules`` is consumed lazily, so
+        it can be a generator producing millions of candidate schedules.
+
+        Arguments
+        ---------
+        schedules : iterable of lists of tuples [(batch_pk, end_time), .. ]
+            the production slots of every schedule, as in :meth:`add_schedule`
+        chunk_size : int
+            the number of production slots buffered before writing
+        bitmap : bool
+            store the batches as bitmaps, see :meth:`add_schedule`
+
+        Returns
+        -------
+        pks : list of the primary keys of the new schedules
+        """
+        from BruggCablesKTI import log
+
+        schedule_table = Schedule.__table__
+        slot_table = ProductionSlot.__table__
+        pks, buffered, n_slots = [], [], 0
+        n_rows = 0
+        start_time = time.time()
+        ordinals = {}
+
+        def write(buffered, n_slots):
+            schedule_rows = [{} for slots in buffered]
+            if bitmap:
+                ordinals.update(self.batch_ordinals(set(batch_pk
+                    for slots in buffered for (batch_pk, end_time) in slots
+                    if batch_pk not in ordinals)))
+                for (row, slots) in zip(schedule_rows, buffered):
+                    row['membership'] = bitsets.encode(ordinals[batch_pk]
+                            for (batch_pk, end_time) in slots)
+                buffered = [ [ (batch_pk, end_time) for (batch_pk, end_time)
+                    in slots if end_time is not None ] for slots in buffered ]
+                n_slots = sum(len(slots) for slots in buffered)
+
+            schedule_pks = self.new_pks(Schedule, len(buffered))
+            for (row, pk) in zip(schedule_rows, schedule_pks):
+                row['pk'] = pk
+            slot_pks = iter(self.new_pks(ProductionSlot, n_slots))
+            slot_rows = [{ 'pk': next(slot_pks),
+                           'batch_pk': batch_pk,
+                           'end_time': end_time,
+                           'schedule_pk': schedule_pk }
+                for (schedule_pk, slots) in zip(schedule_pks, buffered)
+                for (batch_pk, end_time) in slots ]
+            try:
+                self.db.execute(schedule_table.insert(), schedule_rows)
+                if slot_rows:
+                    self.db.execute(slot_table.insert(), slot_rows)
+            except IntegrityError as e:
+                raise InvalidEntry(*e.args)
+            pks.extend(schedule_pks)
+            return len(schedule_pks) + len(slot_rows)
+
+        with self.transaction():
+            for slots in schedules:
+                slots = list(slots)
+                buffered.append(slots)
+                n_slots += len(slots)
+                if n_slots >= chunk_size:
+                    n_rows += write(buffered, n_slots)
+                    buffered, n_slots = [], 0
+            if buffered:
+                n_rows += write(buffered, n_slots)
+
+        elapsed = time.time() - start_time
+        log.get_logger().info('Wrote {} schedules ({} rows) in {:.1f} s, '
+                '{:.0f} rows/s'.format(len(pks), n_rows, elapsed,
+                    n_rows / elapsed if elapsed > 0 else float('inf')))
+        return pks
+
+    def batch_ordinals(self, pks):
+        """ The ordinals of batches, the bit positions used by the schedule
+        bitmaps.
+
+        Arguments
+        ---------
+        pks : iterable of batch primary keys
+
+        Returns
+        -------
+        ordinals : dict {batch_pk: ordinal}
+        """
+        pks = list(set(pks))
+        table = Batch.__table__
+        ordinals = {}
+        for chunk in chunks(pks):
+            ordinals.update(self.db.execute(
+                select([table.c.pk, table.c.ordinal])\
+                        .where(table.c.pk.in_(chunk))).fetchall())
+        missing = [pk for pk in pks if ordinals.get(pk) is None]
+        if missing:
+            raise MissingEntry("No such Batch: {}".format(
+                ', '.join(str(pk) for pk in missing)))
+        return ordinals
+
+    @call_in_savepoint
+    def set_production_slot_end_times(self, schedule_pk, batches_end_times):
+        """ Assign end times to batches of a schedule, creating their
+        production slots if needed.
+
+        This is how the slots of a bitmap schedule get materialized.
+
+        Arguments
+        ---------
+        schedule_pk : the primary key of the schedule
+        batches_end_times : list of tuples [(batch_pk, end_time), .. ]
+
+        Returns
+        -------
+        pks : the primary keys of the production slots, in input order
+        """
+        batches_end_times = list(batches_end_times)
+        existing = dict(self.db.query(ProductionSlot.batch_pk,
+            ProductionSlot.pk)\
+            .filter(ProductionSlot.schedule_pk == schedule_pk))
+        new = [batch_pk for (batch_pk, end_time) in batches_end_times
+                if batch_pk not in existing]
+        existing.update(zip(new, self.new_pks(ProductionSlot, len(new))))
+
+        records = [ { 'pk': existing[batch_pk],
+                      'batch_pk': batch_pk,
+                      'end_time': end_time,
+                      'schedule_pk': schedule_pk }
+                for (batch_pk, end_time) in batches_end_times ]
+        new = set(new)
+        try:
+            self.db.bulk_insert_mappings(ProductionSlot,
+                    [ r for r in records if r['batch_pk'] in new ])
+            self.db.bulk_update_mappings(ProductionSlot,
+                    [ r for r in records if r['batch_pk'] not in new ])
+        except (IntegrityError, FlushError) as e:
+            self.rollback()
+            raise InvalidEntry(*e.args)
+        self.commit()
+        return [r['pk'] for r in records]
+
     def find_schedule(self, pk):
         """ Find a schedule.
 
@@ -1040,11 +3248,7 @@ class DBHandler(object):
         else:
             for attr in kwargs:
                 setattr(schedule, attr, kwargs[attr])
-            try:
-                self.db.commit()
-            except (IntegrityError, FlushError) as e:
-                self.db.rollback()
-                raise InvalidEntry(*e.args)
+            self.commit()
         return schedule
 
     def remove_schedule(self, pk):
@@ -1055,16 +3259,32 @@ class DBHandler(object):
         pk: str
             the primary key of Schedule used in our table
         """
-        schedule = self.find_schedule(pk)
-        # delete all associated schedule_items too
-        for ps in schedule.production_slots:
-            self.remove_production_slot(ps.pk)
-        self.db.delete(schedule)
-        try:
-            self.db.commit()
-        except (IntegrityError, FlushError) as e:
-            self.db.rollback()
-            raise InvalidEntry(*e.args)
+        self.find_schedule(pk)
+        self.remove_schedules([pk])
+
+    def remove_schedules(self, pks=None):
+        """ Deletes many Schedules and their production slots from the
+        database with a few set-based statements.
+
+        Arguments
+        ---------
+        pks: list of str
+            the primary keys of the schedules to delete, None deletes all
+            schedules
+
+        Returns
+        -------
+        count : the number of deleted schedules
+        """
+        schedules = Schedule.__table__
+        with self.transaction():
+            if pks is None:
+                self.db.execute(ProductionSlot.__table__.delete())
+                count = self.db.execute(schedules.delete()).rowcount
+            else:
+                self._delete_in(ProductionSlot.__table__.c.schedule_pk, pks)
+                count = self._delete_in(schedules.c.pk, pks)
+        return count
 
 
     # PRODUCTION_SLOTS --------------------------------------------------------
@@ -1073,6 +3293,24 @@ class DBHandler(object):
         """ A list of all production_slots in the database."""
         return self.db.query(ProductionSlot).all()
 
+    def iter_production_slots(self, chunk_size=1000):
+        """ Iterate over all production_slots in the database in bounded
+        memory.
+
+        The objects of a chunk are expunged from the session once the next
+        chunk is fetched, don't keep references to them.
+
+        Arguments
+        ---------
+        chunk_size : int
+            the number of rows fetched at a time
+
+        Returns
+        -------
+        generator of :class:`BruggCablesKTI.db.model.ProductionSlot`
+        """
+        return self._iter_chunked(self.db.query(ProductionSlot), chunk_size)
+
     def add_production_slot(self, **kwargs):
         """ Add a new production_slot to the database.
 
@@ -1089,11 +3327,7 @@ class DBHandler(object):
         """
         production_slot = ProductionSlot(**kwargs)
         self.db.add(production_slot)
-        try:
-            self.db.commit()
-        except (IntegrityError, FlushError) as e:
-            self.db.rollback()
-            raise InvalidEntry(*e.args)
+        self.commit()
         return production_slot
 
     def find_production_slot(self, pk):
@@ -1139,11 +3373,7 @@ class DBHandler(object):
         else:
             for attr in kwargs:
                 setattr(production_slot, attr, kwargs[attr])
-            try:
-                self.db.commit()
-            except (IntegrityError, FlushError) as e:
-                self.db.rollback()
-                raise InvalidEntry(*e.args)
+            self.commit()
         return production_slot
 
     def remove_production_slot(self, pk):
@@ -1157,8 +3387,4 @@ class DBHandler(object):
         production_slot = self.find_production_slot(pk)
         self.db.delete(production_slot)
 
-        try:
-            self.db.commit()
-        except (IntegrityError, FlushError) as e:
-            self.db.rollback()
-            raise InvalidEntry(*e.args)
+        self.commit()
@@ -1,10 +1,93 @@
 
+'''
+Module loading the data model into pandas DataFrames.
+
+The loaders keep a snapshot of their DataFrame on disk, in a directory next to
+the database file (``BruggCables.db`` -> ``BruggCables.snapshots``). A snapshot
+is keyed by the data key of the database (see DBHandler.data_key()), so it is
+reused until the opportunities, cables or batches change. Pass ``cache=False``
+to rebuild the DataFrame from the database.
+
+Snapshots are typed Parquet files if the optional dependency pyarrow is
+installed. Without it they are pickles, and a warning is logged once.
+Pickles keep the dtypes too, but only the same pandas version can read them,
+and loading one runs code : don't share a snapshot directory with untrusted
+users.
+
+'''
+
+import os
+import glob
+import functools
+
 import pandas as pd
 import numpy as np
 
+from BruggCablesKTI import log
+
+
+def snapshot_directory(dbh):
+    ''' The directory of the snapshots of a database, None for in-memory
+    databases.
+    '''
+    path = dbh.engine.url.database
+    if not path or path == ':memory:':
+        return None
+    return os.path.splitext(os.path.abspath(path))[0] + '.snapshots'
+
+
+@functools.lru_cache()
+def _snapshot_format():
+    try:
+        import pyarrow
+    except ImportError:
+        log.get_logger().warning('pyarrow is not installed, the DataFrame '
+            'snapshots are written as pickles.')
+        return 'pkl'
+    return 'parquet'
+
+
+def snapshot_cached(build):
+    ''' Decorator keeping the DataFrame returned by ``build(dbh)`` in the
+    snapshot directory of the database, see the module documentation.
+    '''
+    name = build.__name__.replace('get_', '').replace('_as_df', '')
+
+    @functools.wraps(build)
+    def load(dbh, cache=True):
+        directory = snapshot_directory(dbh)
+        if not cache or directory is None:
+            return build(dbh)
+
+        extension = _snapshot_format()
+        path = os.path.join(directory, '{}-{}.{}'.format(name,
+            dbh.data_key(), extension))
+        if os.path.isfile(path):
+            if extension == 'parquet':
+                return pd.read_parquet(path)
+            return pd.read_pickle(path)
+
+        df = build(dbh)
+        os.makedirs(directory, exist_ok=True)
+        # written aside and moved, readers never see a partial snapshot
+        partial = '{}.{}.tmp'.format(path, os.getpid())
+        if extension == 'parquet':
+            df.to_parquet(partial)
+        else:
+            df.to_pickle(partial)
+        os.replace(partial, path)
+        for stale in glob.glob(os.path.join(directory, name + '-*')):
+            if stale != path and not stale.endswith('.tmp'):
+                os.remove(stale)
+        return df
+    return load
+
+
+@snapshot_cached
 def get_opportunities_as_df(dbh):
     ''' Returns all opportunities in a pandas DataFrame.
     '''
+    workloads = dbh.opportunity_workloads()
     df = pd.DataFrame([
         {   "pk": opp.pk,
             "brugg_cables_id": opp.brugg_cables_id,
@@ -15,12 +98,13 @@ def get_opportunities_as_df(dbh):
             "revenue": opp.revenue,
             "margin": opp.margin,
             "cables": ', '.join('{}: {}'.format(c.kind, c.voltage) for c in opp.cables),
-            "workload": np.sum([b.workload for c in opp.cables for b in c.batches]),
+            "workload": workloads.get(opp.pk, 0.),
             }
-        for opp in dbh.opportunities ])
+        for opp in dbh.opportunities_with(cables=True) ])
     return df
 
 
+@snapshot_cached
 def get_cables_as_df(dbh):
     ''' Returns all batches in pandas DataFrame.
     '''
@@ -38,10 +122,11 @@ def get_cables_as_df(dbh):
             "opportunity_margin": c.opportunity.margin,
             "opportunity_description": c.opportunity.description,
             }
-        for c in dbh.cables ])
+        for c in dbh.cables_with(opportunity=True) ])
     return df
 
 
+@snapshot_cached
 def get_batches_as_df(dbh):
     ''' Returns all batches in pandas DataFrame.
     '''
@@ -64,5 +149,5 @@ def get_batches_as_df(dbh):
             "opportunity_margin": b.cable.opportunity.margin,
             "opportunity_description": b.cable.opportunity.description,
             }
-        for b in dbh.batches ])
+        for b in dbh.batches_with(opportunity=True) ])
     return df
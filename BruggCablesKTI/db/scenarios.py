@@ -0,0 +1,156 @@
+'''
+Module implementing scenario overlays : a what-if scenario shares a read-only
+base database and stores only its own changes.
+
+The base database is attached to the (small) overlay database as ``base``.
+The overlay holds a ``scenario_<table>`` table for every model table, with the
+rows the scenario added or modified, and the ``scenario_removed`` table with
+the keys of the base rows it deleted. Temporary views named like the model
+tables merge both, they shadow the base tables for unqualified names, so all
+queries of the data model read the merged data. INSTEAD OF triggers on the
+views redirect the writes to the overlay tables.
+
+'''
+
+from sqlalchemy import MetaData, Table, Column, Index
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.schema import CreateTable, CreateIndex
+
+# the prefix of the overlay tables, inside triggers sqlite doesn't allow the
+# schema qualified names which would tell them apart from the views
+OVERLAY_PREFIX = 'scenario_'
+REMOVED_TABLE = OVERLAY_PREFIX + 'removed'
+
+
+def _key_expression(alias, key_columns):
+    ''' A single SQL value identifying a row, also for composite keys.
+    '''
+    return " || '|' || ".join('{}.{}'.format(alias, column)
+            for column in key_columns)
+
+
+def _same_key(alias, other, key_columns):
+    return ' AND '.join('{0}.{2} = {1}.{2}'.format(alias, other, column)
+            for column in key_columns)
+
+
+def attach_base(connection, base_path, metadata):
+    ''' Attaches the base database to a new overlay connection and sets up
+    the overlay tables, the merging views and their triggers.
+
+    The temporary views and triggers only live as long as the connection, the
+    overlay tables persist in an overlay file.
+
+    Arguments
+    ---------
+    connection : a sqlite3 connection to the overlay database
+    base_path : the path to the base database file, opened read-only
+    metadata : the metadata of the data model
+    '''
+    connection.execute("ATTACH DATABASE ? AS base",
+            ('file:{}?mode=ro'.format(base_path), ))
+
+    existing = set(name for (name, ) in connection.execute(
+            "SELECT name FROM main.sqlite_master WHERE type = 'table'"))
+    overlay_metadata = MetaData()
+    dialect = sqlite.dialect()
+    for table in metadata.sorted_tables:
+        if OVERLAY_PREFIX + table.name in existing:
+            continue
+        # without foreign keys, the rows refer to rows of the base too
+        overlay = Table(OVERLAY_PREFIX + table.name, overlay_metadata,
+                *[ Column(column.name, column.type, nullable=column.nullable,
+                    primary_key=column.primary_key)
+                    for column in table.columns ])
+        connection.execute(str(CreateTable(overlay).compile(dialect=dialect)))
+        for index in table.indexes:
+            connection.execute(str(CreateIndex(Index(
+                OVERLAY_PREFIX + index.name,
+                *[overlay.c[column.name] for column in index.columns],
+                unique=index.unique)).compile(dialect=dialect)))
+    connection.execute('CREATE TABLE IF NOT EXISTS {} ('
+            'table_name TEXT NOT NULL, key TEXT NOT NULL, '
+            'PRIMARY KEY (table_name, key))'.format(REMOVED_TABLE))
+
+    for table in metadata.sorted_tables:
+        _create_view(connection, table.name,
+                [column.name for column in table.columns],
+                [column.name for column in table.primary_key.columns],
+                table.info.get('after_delete', []))
+    connection.commit()
+
+
+def _create_view(connection, table, columns, key_columns, after_delete=()):
+    ''' The temporary view merging the overlay and base rows of ``table`` and
+    the triggers writing to it. The ``after_delete`` statements are run for
+    every deleted row, like the table triggers of the base.
+    '''
+    names = {
+        'table': table,
+        'overlay': OVERLAY_PREFIX + table,
+        'removed': REMOVED_TABLE,
+        'columns': ', '.join(columns),
+        'values': ', '.join('NEW.{}'.format(column) for column in columns),
+        'same': _same_key('o', 'b', key_columns),
+        'base_key': _key_expression('b', key_columns),
+        'new_key': _key_expression('NEW', key_columns),
+        'old_key': _key_expression('OLD', key_columns),
+        'old_row': ' AND '.join('{0} = OLD.{0}'.format(column)
+            for column in key_columns),
+        'after_delete': ''.join('\n            {};'.format(statement)
+            for statement in after_delete),
+    }
+
+    connection.execute('''
+        CREATE TEMP VIEW {table} AS
+            SELECT {columns} FROM {overlay}
+        UNION ALL
+            SELECT {columns} FROM base.{table} b
+            WHERE NOT EXISTS (SELECT 1 FROM {overlay} o WHERE {same})
+            AND NOT EXISTS (SELECT 1 FROM {removed} r
+                WHERE r.table_name = '{table}' AND r.key = {base_key})
+        '''.format(**names))
+
+    connection.execute('''
+        CREATE TEMP TRIGGER {table}_insert INSTEAD OF INSERT ON {table}
+        BEGIN
+            DELETE FROM {removed} WHERE table_name = '{table}'
+                AND key = {new_key};
+            INSERT INTO {overlay} ({columns}) VALUES ({values});
+        END'''.format(**names))
+
+    connection.execute('''
+        CREATE TEMP TRIGGER {table}_update INSTEAD OF UPDATE ON {table}
+        BEGIN
+            DELETE FROM {overlay} WHERE {old_row};
+            INSERT OR IGNORE INTO {removed} (table_name, key)
+                SELECT '{table}', {old_key} WHERE {old_key} <> {new_key};
+            INSERT INTO {overlay} ({columns}) VALUES ({values});
+        END'''.format(**names))
+
+    connection.execute('''
+        CREATE TEMP TRIGGER {table}_delete INSTEAD OF DELETE ON {table}
+        BEGIN
+            DELETE FROM {overlay} WHERE {old_row};
+            INSERT OR IGNORE INTO {removed} (table_name, key)
+                VALUES ('{table}', {old_key});{after_delete}
+        END'''.format(**names))
+
+
+def changes(connection, metadata):
+    ''' The number of rows the scenario added or modified and removed per
+    table.
+
+    Returns
+    -------
+    changes : dict {table name: (changed, removed)}
+    '''
+    changes = {}
+    for table in metadata.sorted_tables:
+        changed = connection.execute('SELECT count(*) FROM {}'.format(
+                OVERLAY_PREFIX + table.name)).scalar()
+        removed = connection.execute(
+                "SELECT count(*) FROM {} WHERE table_name = '{}'".format(
+                    REMOVED_TABLE, table.name)).scalar()
+        changes[table.name] = (changed, removed)
+    return changes
@@ -1,36 +1,22 @@
+from BruggCablesKTI.db.model import BULK_INSERT_CHUNK
 
-from BruggCablesKTI.db.model import FirstSelectionItem, FirstSelection, new_uuid
 
-def write_first_selections_for_cluster(dbh, firstselections, **kwargs):
+def write_first_selections_for_cluster(dbh, firstselections,
+        chunk_size=BULK_INSERT_CHUNK, **kwargs):
     ''' Writes a list of first selections (for a cluster) to the database.
 
+    The selections are content addressed and streamed in chunks, see
+    DBHandler.add_first_selections_bulk().
+
     Arguments
     ---------
     dbh : a database handler
-    firstselections : a list of lists of batch primary keys
-    '''
-
-    # BULK SAVE / INSERT FIRST_SELECTION OBJECTS
-    first_selections = [ FirstSelection(pk=new_uuid(), **kwargs) for fs in firstselections ]
+    firstselections : a list (or any iterable) of lists of batch primary keys
+    chunk_size : the number of batches written at once
 
-    for fs in first_selections:
-        print(fs.pk)
-
-    dbh.db.bulk_save_objects(first_selections)
-    try:
-        dbh.db.commit()
-    except (IntegrityError, FlushError) as e:
-        dbh.db.rollback()
-        raise InvalidEntry(*e.args)
-
-    #BULK INSERT FIRST_SELECTION_ITEM OBJECTS
-    dbh.db.bulk_insert_mappings(FirstSelectionItem,
-            [ { 'batch_pk': batch_pk,
-                'first_selection_pk': first_selections[idx].pk }
-                for idx, batches in enumerate(firstselections) for batch_pk in batches 
-                ] )
-    try:
-        dbh.db.commit()
-    except (IntegrityError, FlushError) as e:
-        dbh.db.rollback()
-        raise InvalidEntry(*e.args)    
+    Returns
+    -------
+    pks : list of the primary keys of the new first selections
+    '''
+    return dbh.add_first_selections_bulk(firstselections,
+            chunk_size=chunk_size, **kwargs)
@@ -0,0 +1,233 @@
+'''
+Module implementing a single writer process for the database.
+
+SQLite allows one writer at a time, compute workers writing their results
+directly serialize on the write lock. The DBWriter process owns the
+connection instead : the workers put write requests on a multiprocessing
+queue and the writer performs them, committing many requests at once.
+
+usage :
+
+    >>> writer = DBWriter('sqlite:///BruggCables.db')
+    >>> writer.start()
+    >>> pool = multiprocessing.Pool(initializer=init_worker,
+    ...                             initargs=(writer, ))
+    >>> # in the workers
+    >>> writer.add_schedule([(batch_pk, None), ...])
+    >>> # once all workers have exited (close() and join() the pool, a
+    >>> # terminated worker may lose its queued requests) :
+    >>> failures = writer.stop()
+
+The writer has to reach the workers when they are created (as an argument of
+``multiprocessing.Process`` or the ``initargs`` of a pool), queues can't be
+sent through pool tasks. The writes are asynchronous : the producers don't get
+the written objects back, pass the keys with the request (e.g.
+``pk=new_uuid()``) if they are needed later. The requests which failed are
+returned by ``stop()``.
+
+'''
+
+import time
+import multiprocessing
+from queue import Empty
+
+from BruggCablesKTI import log
+
+
+# the maximum number of requests committed in one transaction
+WRITER_BATCH_SIZE = 1000
+
+# the DBHandler methods a DBWriter accepts
+WRITE_METHODS = (
+    'add_schedule',
+    'add_schedules_bulk',
+    'update_or_create_schedule',
+    'remove_schedules',
+    'update_or_create_production_slot',
+    'set_production_slot_end_times',
+    'add_first_selection',
+    'add_first_selections_bulk',
+    'bulk_upsert_batches',
+)
+
+
+class DBWriter(object):
+    ''' A background process performing the writes requested by any number of
+    producer processes.
+    '''
+
+    def __init__(self, db_url='sqlite:///BruggCables.db',
+            batch_size=WRITER_BATCH_SIZE, performance_profile='bulk_load',
+            max_pending=0):
+        ''' Create the writer, :meth:`start` starts its process.
+
+        Arguments
+        ---------
+        db_url : string
+            The URL to the database, e.g. ``sqlite:///BruggCables.db``
+        batch_size : int
+            the maximum number of requests committed at once
+        performance_profile : string
+            the sqlite pragmas preset of the writer's DBHandler
+        max_pending : int
+            (defaults to 0 : unbounded) the number of requests the producers
+            can queue before they block
+        '''
+        self.db_url = db_url
+        self.batch_size = batch_size
+        self.performance_profile = performance_profile
+        self.queue = multiprocessing.Queue(max_pending)
+        # the writer process sends back the failed requests when it stops
+        self.results = multiprocessing.Queue()
+        self.process = None
+        # whether stop() has queued the end of the requests, and the failed
+        # requests it received
+        self.stopping = False
+        self.failures = None
+
+    def start(self):
+        ''' Start the writer process.
+        '''
+        self.process = multiprocessing.Process(target=serve,
+                args=(self.db_url, self.queue, self.batch_size,
+                    self.performance_profile, self.results))
+        self.process.daemon = True
+        self.process.start()
+
+    def stop(self, timeout=None):
+        ''' Perform and commit all queued requests and stop the writer
+        process.
+
+        Arguments
+        ---------
+        timeout : float
+            (defaults to None : no limit) the seconds to wait for the writer
+            process, a TimeoutError is raised if it is still writing then.
+            ``stop()`` can be called again to go on waiting.
+
+        Returns
+        -------
+        failures : list of tuples (method, args, kwargs, error)
+            the requests which failed and were not written, with the repr of
+            their exception
+        '''
+        if not self.stopping:
+            self.queue.put(None)
+            self.stopping = True
+        deadline = None if timeout is None else time.time() + timeout
+        while self.failures is None and self.process.is_alive():
+            wait = 1. if deadline is None else \
+                    min(1., deadline - time.time())
+            if wait <= 0.:
+                break
+            try:
+                self.failures = self.results.get(timeout=wait)
+            except Empty:
+                pass
+        self.process.join(None if deadline is None else
+                max(0., deadline - time.time()))
+        if self.process.is_alive():
+            raise TimeoutError('The DBWriter process did not stop within {} '
+                'seconds, it is still writing.'.format(timeout))
+        if self.process.exitcode != 0:
+            raise RuntimeError('The DBWriter process failed with exit code '
+                '{}.'.format(self.process.exitcode))
+        if self.failures is None:
+            self.failures = self.results.get()
+        return self.failures
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        failures = self.stop()
+        if failures and exc_type is None:
+            raise RuntimeError('The DBWriter dropped {} requests, the first '
+                'one {}{} : {}'.format(len(failures), *failures[0][:2],
+                    failures[0][3]))
+
+    def submit(self, method, *args, **kwargs):
+        ''' Queue a call of a DBHandler write method.
+
+        Arguments
+        ---------
+        method : string, one of :data:`WRITE_METHODS`
+        `*args`, `**kwargs` : the picklable arguments of the method
+        '''
+        if method not in WRITE_METHODS:
+            raise ValueError('{!r} is not a write method, use one of {}'\
+                    .format(method, WRITE_METHODS))
+        self.queue.put((method, args, kwargs))
+
+    def add_schedule(self, *args, **kwargs):
+        ''' Queue a :meth:`DBHandler.add_schedule` call.'''
+        self.submit('add_schedule', *args, **kwargs)
+
+    def update_or_create_production_slot(self, *args, **kwargs):
+        ''' Queue a :meth:`DBHandler.update_or_create_production_slot` call.'''
+        self.submit('update_or_create_production_slot', *args, **kwargs)
+
+    def set_production_slot_end_times(self, *args, **kwargs):
+        ''' Queue a :meth:`DBHandler.set_production_slot_end_times` call.'''
+        self.submit('set_production_slot_end_times', *args, **kwargs)
+
+
+def serve(db_url, queue, batch_size, performance_profile=None, results=None):
+    ''' The loop of the writer process : performs the queued requests and
+    commits them in batches, until it gets ``None``.
+
+    A request failing rolls back its batch, the other requests of the batch
+    are then retried one by one and the failed ones are logged and dropped.
+    The list of the dropped requests, (method, args, kwargs, error) tuples,
+    is put on the ``results`` queue at the end.
+    '''
+    from BruggCablesKTI.db.model import DBHandler
+
+    logger = log.get_logger()
+    dbh = DBHandler(db_url, performance_profile=performance_profile)
+
+    done = False
+    failures = []
+    n_requests, start_time = 0, time.time()
+    while not done:
+        batch = [queue.get()]
+        while batch[-1] is not None and len(batch) < batch_size:
+            try:
+                batch.append(queue.get_nowait())
+            except Empty:
+                break
+        if batch[-1] is None:
+            batch.pop()
+            done = True
+
+        try:
+            with dbh.transaction():
+                for request in batch:
+                    perform(dbh, request)
+        except Exception:
+            for request in batch:
+                try:
+                    with dbh.transaction():
+                        perform(dbh, request)
+                except Exception as e:
+                    logger.error('DBWriter dropped {}{} : {!r}'.format(
+                        request[0], request[1], e))
+                    failures.append(tuple(request) + (repr(e), ))
+        n_requests += len(batch)
+
+    elapsed = time.time() - start_time
+    logger.info('DBWriter performed {} requests in {:.1f} s, {} failed'\
+        .format(n_requests, elapsed, len(failures)))
+    dbh.close()
+    if results is not None:
+        results.put(failures)
+
+
+def perform(dbh, request):
+    ''' Performs a request and flushes it, later requests of the same
+    batch see its changes.
+    '''
+    method, args, kwargs = request
+    getattr(dbh, method)(*args, **kwargs)
+    dbh.db.flush()
@@ -113,12 +113,17 @@ def selection_proprties(selections, attributes_list, i_cluster, dbh):
     attr_sel = []
     df = pd.DataFrame(attributes_list)
 
+    # the batches of all selections with their opportunities' batches
+    selected = dict((batch.pk, batch) for batch in dbh.find_batches_many(
+        set(pk for selection in selections for pk in selection),
+        opportunity_batches=True))
+
     for selection in selections:
         df_tmp = df[df.id.isin(selection)]
 
         batches = []
-        for pk in selection:
-            opp = dbh.find_batch(pk).cable.opportunity
+        for batch in (selected[pk] for pk in selection):
+            opp = batch.cable.opportunity
             for cable in opp.cables:
                 batches += cable.batches
 
@@ -223,7 +228,7 @@ def generate_baselines(dbfile, clustersize='month'):
     from BruggCablesKTI.db import utils
 
     # 1. connect to db
-    dbh = DBHandler('sqlite:///'+ dbfile)
+    dbh = DBHandler.for_url('sqlite:///'+ dbfile)
     cl_s_date = copy(START_DATE)
 
     small_size_offers = []
@@ -237,7 +242,9 @@ def generate_baselines(dbfile, clustersize='month'):
         print(cl_s_date.date(), ' - ', cl_e_date.date())
 
         attributes_list = []
-        batches = dbh.select_batch_timerange(cl_s_date, cl_e_date, batch_number=0)
+        batches = dbh.select_batch_timerange(cl_s_date, cl_e_date, batch_number=0,
+                                             opportunity=True,
+                                             cable_batches=True)
         cl_s_date = copy(cl_e_date) #-> update the time interval
 
         # get list of dictionaries of first batches in cluster
@@ -308,7 +315,7 @@ def generate_baselines(dbfile, clustersize='month'):
 
 
 def main():
-    from shutil import copyfile,rmtree
+    from BruggCablesKTI.db.model import DBHandler
 
     import time
     start = time.clock()
@@ -316,11 +323,13 @@ def main():
     dbfile_template = '/Users/sgi01501141/Desktop/new_model/BruggCables_new.db'
     dbfile = '/Users/sgi01501141/Desktop/new_model/BruggCables.db'
 
-    rmtree(dbfile, ignore_errors = True)
-    copyfile(dbfile_template, dbfile)
+    # work on an in-memory copy of the template, written to dbfile at the end
+    dbh = DBHandler.open_in_memory(dbfile_template, 'sqlite:///'+ dbfile)
 
     baselines , small_size_offers = generate_baselines(dbfile, clustersize='month')
 
+    dbh.flush_to(dbfile)
+
     print( time.clock()-start )
     import pdb; pdb.set_trace()
 
@@ -276,7 +276,8 @@ def generate_first_selections_on_database(dbfile, clustersize='month'):
     from BruggCablesKTI.db import utils
 
     # 1. connect to db
-    dbh = DBHandler('sqlite:///'+ dbfile)
+    dbh = DBHandler.for_url('sqlite:///'+ dbfile,
+                                  performance_profile='bulk_load')
     cl_s_date = copy(START_DATE)
 
     # 2. loop over clusters defined by clustersize
@@ -292,7 +293,9 @@ def generate_first_selections_on_database(dbfile, clustersize='month'):
         print(cl_s_date, cl_e_date)
 
         attributes_list = []
-        batches = dbh.select_batch_timerange(cl_s_date, cl_e_date)
+        batches = dbh.select_batch_timerange(cl_s_date, cl_e_date,
+                                             opportunity=True,
+                                             cable_batches=True)
 
         # get list of dictionaries of first batches in cluster
         count = 0
@@ -365,16 +368,18 @@ def generate_first_selections_on_database(dbfile, clustersize='month'):
 
 
 def main():
-    from shutil import copyfile,rmtree
+    from BruggCablesKTI.db.model import DBHandler
 
     dbfile_template = '/Users/sgi01501141/Desktop/new_model/BruggCables_new.db'
     dbfile = '/Users/sgi01501141/Desktop/new_model/BruggCables.db'
 
-    rmtree(dbfile, ignore_errors = True)
-    copyfile(dbfile_template, dbfile)
+    # work on an in-memory copy of the template, written to dbfile at the end
+    dbh = DBHandler.open_in_memory(dbfile_template, 'sqlite:///'+ dbfile)
 
     generate_first_selections_on_database(dbfile, clustersize='month')
 
+    dbh.flush_to(dbfile)
+
 
 if __name__ == '__main__':
     main()
@@ -27,15 +27,11 @@ def read_batches(dbfile, baseline, small_size_offers):
     from BruggCablesKTI.db.model import DBHandler
     from BruggCablesKTI.db import utils
 
-    dbh = DBHandler('sqlite:///'+ dbfile)
+    dbh = DBHandler.for_url('sqlite:///'+ dbfile)
 
-    bl_batches = []
-    for ibase in baseline:
-        bl_batches.append([dbh.find_batch(ibatch) for ibatch in ibase])
+    bl_batches = [dbh.find_batches_many(ibase) for ibase in baseline]
 
-    so_batches = []
-    for ibase in small_size_offers:
-        so_batches.append([dbh.find_batch(ibatch) for ibatch in ibase])
+    so_batches = [dbh.find_batches_many(ibase) for ibase in small_size_offers]
 
     import csv
     myfile = open('Baselines.csv','w')
@@ -68,7 +64,7 @@ def plot_baselines_prop(bls, dbfile):
 
     from BruggCablesKTI.db.model import DBHandler
     from BruggCablesKTI.db import utils
-    dbh = DBHandler('sqlite:///'+ dbfile)
+    dbh = DBHandler.for_url('sqlite:///'+ dbfile)
 
     baselines = []
     batches = []
@@ -246,7 +242,7 @@ def optimizer(dbfile, baseline, small_size_offers):
 
 def main():
 
-    from shutil import copyfile,rmtree
+    from BruggCablesKTI.db.model import DBHandler
     from baseline_simulation import generate_baselines
     import time
 
@@ -255,13 +251,15 @@ def main():
     dbfile_template = '/Users/sgi01501141/Desktop/new_model/BruggCables_new.db'
     dbfile = '/Users/sgi01501141/Desktop/new_model/BruggCables.db'
 
-    rmtree(dbfile, ignore_errors = True)
-    copyfile(dbfile_template, dbfile)
+    # work on an in-memory copy of the template, written to dbfile at the end
+    dbh = DBHandler.open_in_memory(dbfile_template, 'sqlite:///'+ dbfile)
 
     baselines, small_size_offers = generate_baselines(dbfile, clustersize='month')
 
     optimizer(dbfile, baselines, small_size_offers)
 
+    dbh.flush_to(dbfile)
+
     print( time.clock()-start )
     import pdb; pdb.set_trace()
 
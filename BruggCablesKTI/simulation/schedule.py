@@ -231,9 +231,9 @@ def schedule():
     '''
     from BruggCablesKTI.db.model import DBHandler
 
-    dbh = DBHandler('sqlite:///'+ DBFILE)
+    dbh = DBHandler.for_url('sqlite:///'+ DBFILE)
 
-    #1.get the batches -> preliminary version
+    #1.get the schedules
     schedules = dbh.schedules
 
     #2.generate a dictionary for the batch
@@ -243,49 +243,47 @@ def schedule():
 
 
         batch_dictionary = []
-        for slots in schedule.production_slots:
+        for row in dbh.schedule_rows(schedule.pk):
 
             # TODO: define the parameters in capital at the beginning of the script
 
-            try:
-                storage_cost = (slots.batch.cable.opportunity.revenue -
-                                slots.batch.cable.opportunity.margin) * 0.045/52.
-            except:
+            revenue = row['opportunity_revenue']
+            margin = row['opportunity_margin']
+            if revenue is not None and margin is not None:
+                storage_cost = (revenue - margin) * 0.045/52.
+            else:
                 storage_cost = None
 
-            try:
-                delay_cost = slots.batch.cable.opportunity.revenue / 100.
-            except:
+            if revenue is not None:
+                delay_cost = revenue / 100.
+            else:
                 delay_cost = None
 
             #TODO: solve the problem with the potential type
-            if slots.batch.potential_type == 'project' and \
-                 (slots.batch.cable.opportunity.revenue in [None,0]):
+            if row['potential_type'] == 'project' and revenue in [None,0]:
                  pot_type = 'internal'
             else:
-                 pot_type = slots.batch.potential_type
+                 pot_type = row['potential_type']
 
             #TODO: selection line within the database
-            prod_line = slots.batch.cable.production_line
-            if pot_type in ['project', 'internal']:
-                prod_line = slots.batch.cable.production_line
-            elif pot_type in ['offer', 'batch'] and \
-                    slots.batch.cable.production_line == '':
-                if (slots.batch.cable.voltage > MAX_VOLTAGE_L1) or \
-                    (slots.batch.cable.area > MAX_AREA_L1 ) or \
-                    (slots.batch.cable.kind == 'SEG'):
+            prod_line = row['cable_production_line']
+            if pot_type in ['offer', 'batch'] and prod_line == '':
+                if (row['cable_voltage'] > MAX_VOLTAGE_L1) or \
+                    (row['cable_area'] > MAX_AREA_L1 ) or \
+                    (row['cable_kind'] == 'SEG'):
                         prod_line = 'Line2'
 
-            attr = {'cable_id': slots.batch.cable.pk,
-                    'slots_id': slots.pk,
-                    'revenue': slots.batch.cable.opportunity.revenue,
-                    'workload': slots.batch.workload,
-                    'delivery_date': slots.batch.delivery_date,
+            attr = {'cable_id': row['cable_pk'],
+                    'slots_id': row['slot_pk'],
+                    'batch_id': row['batch_pk'],
+                    'revenue': revenue,
+                    'workload': row['workload'],
+                    'delivery_date': row['delivery_date'],
                     'storage_cost': storage_cost,
                     'delay_cost': delay_cost,
                     'kind': pot_type,
-                    'margin': slots.batch.cable.opportunity.margin,
-                    'probability': slots.batch.cable.opportunity.probability,
+                    'margin': margin,
+                    'probability': row['opportunity_probability'],
                     'production_line': prod_line,
                     'sched_date': None,}
 
@@ -308,12 +306,16 @@ def schedule():
         margin = fitness['margin']
         revenue = fitness['revenue']
 
-        for ind, row in df.iterrows():
-            dbh.update_or_create_production_slot( pk = row.slots_id,
+        with dbh.transaction():
+            for ind, row in df.iterrows():
+                # the batches of a bitmap schedule get their slot here
+                dbh.update_or_create_production_slot( pk = row.slots_id,
+                                        batch_pk = row.batch_id,
+                                        schedule_pk = schedule.pk,
                                         end_time = row.sched_date,
                                         production_line = row.production_line )
 
-            dbh.update_or_create_schedule(pk = schedule.pk, margin = margin,
+                dbh.update_or_create_schedule(pk = schedule.pk, margin = margin,
                                                             revenue = revenue)
 
         print('Schedule computed in', time.clock() - check_time, 'seconds')
@@ -83,7 +83,8 @@ def generate_second_selections_on_database(dbfile, clustersize='month'):
     cluster_edges = get_cluster_edges()
 
     #1.connect to the database
-    dbh = DBHandler('sqlite:///'+ dbfile)
+    dbh = DBHandler.for_url('sqlite:///'+ dbfile,
+                                  performance_profile='bulk_load')
 
     #2.Cartesian product of the first selections
     fs_len = np.asarray([len(dbh.select_first_selection(icl))
@@ -92,48 +93,51 @@ def generate_second_selections_on_database(dbfile, clustersize='month'):
     ss_len = np.prod(fs_len[np.where(fs_len > 0)],dtype = np.float64)
     ss_len = int(ss_len)
 
-    ss_array = np.zeros(N_CLUSTERS)
+    memberships = [dbh.first_selection_membership(icl)
+                            for icl in range(0, N_CLUSTERS)]
 
-    ss_curr = 0
+    def second_selections():
+        # the schedules are produced lazily and streamed to the database
+        ss_array = np.zeros(N_CLUSTERS)
 
-    batch_dict = []
-    for batch in dbh.batches:
-        batch_dict.append(batch.to_dict())
-    batch_df = pd.DataFrame(batch_dict)
+        ss_curr = 0
 
-    while ss_curr < ss_len:
-        import time; check_time = time.clock()
-        cl_sched = np.zeros(N_CLUSTERS)
+        while ss_curr < ss_len:
+            import time; check_time = time.clock()
+            cl_sched = np.zeros(N_CLUSTERS)
 
-        for icl in range(0, N_CLUSTERS):
-            ### This step thakes 0.1 sec for single cluster
-            frst_sel_pk = dbh.select_first_selection(icl, \
-                                                element_number = ss_array[icl])
+            for icl in range(0, N_CLUSTERS):
+                membership = memberships[icl]
+                if len(membership['first_selections']) == 0:
+                    continue
 
-            ### This step thakes 3 sec for single cluster
-            frst_sel_batches = dbh.find_first_selection(frst_sel_pk).batches
+                frst_sel = int(ss_array[icl])
+                start, end = membership['offsets'][frst_sel:frst_sel+2]
 
-            prmry_ks = [batch.batch_pk for batch in frst_sel_batches]
+                prmry_ks = membership['batches'][
+                                    membership['indices'][start:end]].tolist()
 
-            cl_sched[icl] = np.sum(batch_df[batch_df.pk.isin(prmry_ks)].workload)
+                cl_sched[icl] = membership['workload'][frst_sel]
 
-        if check_schedule(cl_sched, cluster_edges):
-            to_bd_list = []
-            for pk in prmry_ks:
-                to_bd_list.append((pk,None))
-            dbh.add_schedule(to_bd_list)
+            if check_schedule(cl_sched, cluster_edges):
+                to_bd_list = []
+                for pk in prmry_ks:
+                    to_bd_list.append((pk,None))
+                yield to_bd_list
 
-        print('Second selection',ss_curr,'of',ss_len,'computed in',\
-                                              time.clock()-check_time,'seconds')
+            print('Second selection',ss_curr,'of',ss_len,'computed in',\
+                                          time.clock()-check_time,'seconds')
 
-        # Update rule
-        ss_curr += 1
-        ss_array[0] += 1
+            # Update rule
+            ss_curr += 1
+            ss_array[0] += 1
 
-        while (ss_array == fs_len).any():
-            iup = np.min(np.where(ss_array == fs_len))
-            ss_array = ss_array % fs_len
-            ss_array[iup+1] += 1
+            while (ss_array == fs_len).any():
+                iup = np.min(np.where(ss_array == fs_len))
+                ss_array = ss_array % fs_len
+                ss_array[iup+1] += 1
+
+    dbh.add_schedules_bulk(second_selections(), bitmap=True)
 
 
 def main():
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+'''
+This script converts a database with the default uuid primary keys into a new
+database with integer primary keys.
+
+Every row keeps its position : its new key is the rowid it had in the source
+table and all foreign keys are translated accordingly. The content hash keys
+of the selection sets are kept. The source database is not modified.
+
+usage :
+
+    $ python migrate_to_integer_keys.py BruggCables.db BruggCables_int.db
+
+The converted database has to be used with integer keys enabled :
+
+    $ export BRUGGCABLES_KEY_TYPE=integer
+
+'''
+
+import os, sys, sqlite3
+
+# the model has to be imported with integer keys to create the new schema
+os.environ['BRUGGCABLES_KEY_TYPE'] = 'integer'
+
+from BruggCablesKTI.db import model
+
+
+def source_expression(column):
+    ''' The SQL expression selecting the converted value of ``column`` from
+    the row ``t`` of its source table.
+    '''
+    # only the uuid keys are converted, other keys (the content hashes of
+    # the selection sets, the columns of composite keys) are copied as is
+    if column.name == 'pk' and not column.foreign_keys:
+        return 't.rowid'
+    for foreign_key in column.foreign_keys:
+        if foreign_key.column.name != 'pk':
+            continue
+        target = foreign_key.column.table.name
+        return '(SELECT r.rowid FROM src.{} r WHERE r.pk = t.{})'.format(
+                target, column.name)
+    return 't.{}'.format(column.name)
+
+
+def migrate(source, target):
+    ''' Copies all rows of the model tables from source to target.
+    '''
+    if os.path.exists(target):
+        sys.exit('Target database {} already exists! Aborted.'.format(target))
+
+    # create the integer keyed schema
+    model.DBHandler('sqlite:///' + target)
+
+    connection = sqlite3.connect(target)
+    connection.execute('ATTACH DATABASE ? AS src', (source, ))
+    source_tables = set(name for (name, ) in connection.execute(
+            "SELECT name FROM src.sqlite_master WHERE type = 'table'"))
+
+    # the keys of deleted rows can't be translated, the change tracking
+    # restarts from the current versions, and the workload aggregates are
+    # recomputed from the copied batches
+    skipped = [cls.__table__ for cls in
+            (model.Deletion, ) + model.WORKLOAD_CLASSES]
+    for table in model.Base.metadata.sorted_tables:
+        if table.name not in source_tables or table in skipped:
+            continue
+        source_columns = set(row[1] for row in connection.execute(
+                'PRAGMA src.table_info({})'.format(table.name)))
+        columns = [c for c in table.columns if c.name in source_columns]
+        # the new database already has its data version row, it is replaced
+        # to keep the version and the deleted batch ordinals
+        verb = 'INSERT OR REPLACE' if table is model.DataVersion.__table__ \
+                else 'INSERT'
+        connection.execute('{} INTO main.{} ({}) SELECT {} FROM src.{} t'\
+            .format(verb, table.name,
+                ', '.join(c.name for c in columns),
+                ', '.join(source_expression(c) for c in columns),
+                table.name))
+        print('{:>24} : {} rows'.format(table.name, connection.execute(
+            'SELECT count(*) FROM main.{}'.format(table.name)).fetchone()[0]))
+
+    # the copied rows may come from an older schema
+    connection.execute('PRAGMA user_version = 0')
+    connection.commit()
+    connection.execute('DETACH DATABASE src')
+    connection.execute('VACUUM')
+    connection.close()
+
+    # the upgrade fills the columns the source database didn't have yet and
+    # rebuilds the workload aggregates
+    model.DBHandler('sqlite:///' + target).close()
+
+    print('Size {:.1f} MB -> {:.1f} MB'.format(os.path.getsize(source)/1e6,
+        os.path.getsize(target)/1e6))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit(__doc__)
+    migrate(sys.argv[1], sys.argv[2])
@@ -0,0 +1,40 @@
+from datetime import datetime
+
+import pytest
+
+from BruggCablesKTI.db import model
+
+
+@pytest.fixture
+def db_file(tmp_path):
+    ''' The path of a fresh SQLite database file.
+    '''
+    return str(tmp_path / 'test.db')
+
+
+@pytest.fixture
+def dbh(db_file):
+    ''' A handler of a fresh SQLite database file.
+    '''
+    handler = model.DBHandler('sqlite:///' + db_file)
+    yield handler
+    handler.close()
+
+
+def opportunity_records(count, **attrs):
+    ''' ``count`` offer records with consecutive Brugg Cables ids.
+    '''
+    records = []
+    for idx in range(count):
+        record = {
+                'brugg_cables_id': idx,
+                'description': 'opportunity {}'.format(idx),
+                'margin': 1000.,
+                'revenue': 10000.,
+                'probability': .5,
+                'delivery_date': datetime(2030, 1, 1),
+                'kind': 'offer',
+                }
+        record.update(attrs)
+        records.append(record)
+    return records
@@ -0,0 +1,30 @@
+import numpy as np
+
+from BruggCablesKTI.db import bitsets
+
+
+def test_round_trip():
+    ordinals = [17, 0, 3, 1000, 3]
+    blob = bitsets.encode(ordinals)
+    assert bitsets.decode(blob).tolist() == [0, 3, 17, 1000]
+    assert bitsets.decode(blob).dtype == np.int64
+    assert bitsets.count(blob) == 4
+
+
+def test_empty_set():
+    blob = bitsets.encode([])
+    assert bitsets.decode(blob).tolist() == []
+    assert bitsets.count(blob) == 0
+    assert bitsets.similarity(blob, bitsets.encode([])) == 1.
+
+
+def test_set_operations():
+    blob_a = bitsets.encode(range(0, 20))
+    blob_b = bitsets.encode(range(10, 100))
+    assert bitsets.common(blob_a, blob_b) == 10
+    assert bitsets.similarity(blob_a, blob_b) == 10 / 100
+
+
+def test_digest_ignores_order_and_repetitions():
+    assert bitsets.digest([3, 1, 2]) == bitsets.digest([1, 2, 3, 3])
+    assert bitsets.digest([1, 2]) != bitsets.digest([1, 2, 3])
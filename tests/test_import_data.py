@@ -0,0 +1,78 @@
+import pandas as pd
+
+from BruggCablesKTI.db import import_data, model
+from BruggCablesKTI.db.model import Batch, Cable, Opportunity
+
+from conftest import opportunity_records
+
+
+def cable_records(count, length=10000.):
+    ''' Two cables per opportunity, the second without area, as read from
+    the excel files.'''
+    records = []
+    for idx in range(count):
+        records.append((idx, {'kind': 'SEG', 'voltage': 220., 'area': 1000.,
+            'length': length, 'production_line': 'Line1'}))
+        records.append((idx, {'kind': 'RMV', 'voltage': 220.,
+            'area': float('nan'), 'length': length,
+            'production_line': 'Line1'}))
+    return records
+
+
+def counts(dbh):
+    return tuple(dbh.db.query(cls).count()
+            for cls in (Opportunity, Cable, Batch))
+
+
+def changed_counts(dbh, version):
+    changed = dbh.changed_since(version)['changed']
+    return dict((name, len(pks)) for (name, pks) in changed.items())
+
+
+def test_reimport_is_idempotent(dbh):
+    import_data._write_opportunities_and_cables(dbh,
+            opportunity_records(10), cable_records(10))
+    assert counts(dbh) == (10, 20, 0)
+    version = dbh.current_version()
+
+    for _ in range(2):
+        import_data._write_opportunities_and_cables(dbh,
+                opportunity_records(10), cable_records(10))
+        assert counts(dbh) == (10, 20, 0)
+        assert dbh.current_version() == version
+        assert changed_counts(dbh, version) == \
+                {'opportunities': 0, 'cables': 0, 'batches': 0}
+
+
+def test_reimport_stamps_changed_cables_only(dbh):
+    import_data._write_opportunities_and_cables(dbh,
+            opportunity_records(10), cable_records(10))
+    version = dbh.current_version()
+
+    records = cable_records(10)
+    records[3][1]['length'] = 20000.
+    import_data._write_opportunities_and_cables(dbh,
+            opportunity_records(10), records)
+    assert counts(dbh) == (10, 20, 0)
+    assert changed_counts(dbh, version) == \
+            {'opportunities': 0, 'cables': 1, 'batches': 0}
+
+
+def test_generate_batches_removes_stale_batches(db_file, monkeypatch):
+    # only offers, the projects file is not read
+    monkeypatch.setattr(pd, 'read_excel',
+            lambda path: pd.DataFrame({'Auftrag': [], 'Zeit': []}))
+    dbh = model.DBHandler('sqlite:///' + db_file)
+    import_data._write_opportunities_and_cables(dbh,
+            opportunity_records(2), cable_records(2, length=30000.))
+    version = import_data.generate_batches(db_file, 'projects.xlsx')
+    assert counts(dbh) == (2, 4, 6)
+
+    records = cable_records(2, length=30000.)
+    records[0][1]['length'] = 10000.
+    import_data._write_opportunities_and_cables(dbh,
+            opportunity_records(2), records)
+    import_data.generate_batches(db_file, 'projects.xlsx', since=version)
+    dbh.db.expire_all()
+    assert counts(dbh) == (2, 4, 4)
+    dbh.close()
@@ -0,0 +1,49 @@
+from BruggCablesKTI.db import instrumentation, model
+from BruggCablesKTI.db.instrumentation import QueryProfiler
+
+from conftest import opportunity_records
+
+
+def test_disabled_without_the_environment_variable(monkeypatch, db_file):
+    monkeypatch.delenv(instrumentation.REPORT_VARIABLE, raising=False)
+    assert not instrumentation.enabled()
+    monkeypatch.setenv(instrumentation.REPORT_VARIABLE, '0')
+    assert not instrumentation.enabled()
+
+    handler = model.DBHandler('sqlite:///' + db_file)
+    assert handler.engine not in instrumentation.PROFILER.engines
+    handler.close()
+
+    monkeypatch.setenv(instrumentation.REPORT_VARIABLE, '1')
+    assert instrumentation.enabled()
+
+
+def test_statements_are_attributed_to_the_handler_methods(dbh, monkeypatch):
+    monkeypatch.setattr(instrumentation, 'N_PLUS_ONE_THRESHOLD', 5)
+    profiler = QueryProfiler()
+    profiler.instrument(dbh.engine)
+
+    (opportunity_pk, ) = dbh.bulk_upsert_opportunities(opportunity_records(1))
+    (cable_pk, ) = dbh.bulk_upsert_cables([{'opportunity_pk': opportunity_pk,
+        'kind': 'SEG', 'voltage': 220., 'area': 1000.}])
+    batch_pks = dbh.bulk_upsert_batches([{'cable_pk': cable_pk,
+        'number': number} for number in range(10)])
+    for pk in batch_pks:
+        dbh.find_batch(pk)
+
+    sites = dict((method, site) for (method, site) in profiler.stats)
+    assert {'bulk_upsert_opportunities', 'bulk_upsert_batches',
+            'find_batch'} <= set(sites)
+    assert sites['find_batch'].startswith('tests/test_instrumentation.py:')
+    assert sites['find_batch'].endswith(
+            ' test_statements_are_attributed_to_the_handler_methods')
+    assert profiler.stats[('find_batch', sites['find_batch'])].count == 10
+
+    # the private helpers count for the public method calling them
+    assert not any(method.startswith('_') for method in sites)
+
+    report = profiler.report()
+    assert 'Possible N+1 patterns' in report
+    assert '10 x find_batch at tests/test_instrumentation.py:' in report
+    # nothing is printed at exit
+    profiler.reset()
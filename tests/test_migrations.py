@@ -0,0 +1,128 @@
+import os
+import sqlite3
+import subprocess
+import sys
+from datetime import datetime
+
+import pytest
+
+from BruggCablesKTI.db import migrations, model
+
+from conftest import opportunity_records
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_upgrade_runs_once_per_schema_version(db_file):
+    model.DBHandler('sqlite:///' + db_file).close()
+    connection = sqlite3.connect(db_file)
+    assert connection.execute('PRAGMA user_version').fetchone() == \
+            (migrations.SCHEMA_VERSION, )
+
+    # an up to date database is left alone
+    connection.execute('UPDATE data_version SET identity = NULL')
+    connection.commit()
+    model.DBHandler('sqlite:///' + db_file).close()
+    assert connection.execute('SELECT identity FROM data_version')\
+            .fetchone() == (None, )
+
+    # an older one is upgraded
+    connection.execute('PRAGMA user_version = 0')
+    connection.commit()
+    model.DBHandler('sqlite:///' + db_file).close()
+    assert connection.execute('SELECT identity FROM data_version')\
+            .fetchone() != (None, )
+    connection.close()
+
+
+def joined_rows(connection):
+    return connection.execute('''
+        SELECT o.brugg_cables_id, c.area, b.number, b.ordinal, s.margin,
+            p.end_time
+        FROM production_slots p
+        JOIN schedules s ON s.pk = p.schedule_pk
+        JOIN batches b ON b.pk = p.batch_pk
+        JOIN cables c ON c.pk = b.cable_pk
+        JOIN opportunities o ON o.pk = c.opportunity_pk
+        ORDER BY b.ordinal''').fetchall()
+
+
+def migrate_to_integer_keys(source, target):
+    subprocess.run([sys.executable,
+        os.path.join(ROOT, 'scripts', 'migrate_to_integer_keys.py'),
+        source, target], check=True, stdout=subprocess.DEVNULL,
+        env=dict(os.environ, PYTHONPATH=ROOT))
+
+
+@pytest.mark.skipif(model.KEY_TYPE != 'uuid', reason='uuid keyed source')
+def test_migrate_to_integer_keys(dbh, db_file, tmp_path):
+    opportunity_pks = dbh.bulk_upsert_opportunities(opportunity_records(2))
+    cable_pks = dbh.bulk_upsert_cables([{'opportunity_pk': pk,
+        'kind': 'SEG', 'voltage': 220., 'area': 1000.}
+        for pk in opportunity_pks])
+    batch_pks = dbh.bulk_upsert_batches([{'cable_pk': pk, 'number': number,
+        'workload': 10., 'delivery_date': datetime(2030, 1, 1)}
+        for pk in cable_pks for number in range(3)])
+    dbh.remove_batch(batch_pks.pop())
+    dbh.add_schedule([(pk, datetime(2030, 1, 1)) for pk in batch_pks],
+            margin=1.)
+    dbh.add_first_selections_bulk([batch_pks[:2], batch_pks[2:],
+        batch_pks[:2]], cluster_number=0)
+    dbh.close()
+
+    target = str(tmp_path / 'integer.db')
+    migrate_to_integer_keys(db_file, target)
+
+    source, migrated = sqlite3.connect(db_file), sqlite3.connect(target)
+    assert migrated.execute('SELECT DISTINCT typeof(pk) FROM batches')\
+            .fetchall() == [('integer', )]
+    assert joined_rows(migrated) == joined_rows(source)
+    assert len(joined_rows(migrated)) == 5
+    query = '''SELECT f.cluster_number, s.digest, s.membership
+        FROM first_selections f
+        JOIN selection_sets s ON s.digest = f.selection_digest
+        ORDER BY f.rowid'''
+    assert len(migrated.execute(query).fetchall()) == 3
+    assert migrated.execute(query).fetchall() == \
+            source.execute(query).fetchall()
+    query = '''SELECT o.brugg_cables_id, m.month, m.production_line,
+            m.workload, m.batches
+        FROM monthly_workloads m
+        JOIN opportunities o ON o.pk = m.opportunity_pk
+        ORDER BY o.brugg_cables_id'''
+    assert migrated.execute(query).fetchall() == \
+            source.execute(query).fetchall() == \
+            [(0, '2030-01-01 00:00:00.000000', '', 30., 3),
+             (1, '2030-01-01 00:00:00.000000', '', 20., 2)]
+    query = 'SELECT version, identity, max_ordinal FROM data_version'
+    assert migrated.execute(query).fetchall() == \
+            source.execute(query).fetchall()
+    source.close()
+    migrated.close()
+
+
+@pytest.mark.skipif(model.KEY_TYPE != 'uuid', reason='uuid keyed source')
+def test_migrate_to_integer_keys_upgrades_older_sources(dbh, db_file,
+        tmp_path):
+    opportunity_pks = dbh.bulk_upsert_opportunities(opportunity_records(1))
+    cable_pks = dbh.bulk_upsert_cables([{'opportunity_pk': opportunity_pks[0],
+        'kind': 'SEG', 'voltage': 220., 'area': 1000.}])
+    dbh.bulk_upsert_batches([{'cable_pk': cable_pks[0], 'number': number,
+        'workload': 10.} for number in range(3)])
+    dbh.close()
+    # batches written before the ordinals
+    connection = sqlite3.connect(db_file)
+    connection.execute('UPDATE batches SET ordinal = NULL')
+    connection.execute('PRAGMA user_version = 0')
+    connection.commit()
+    connection.close()
+
+    target = str(tmp_path / 'integer.db')
+    migrate_to_integer_keys(db_file, target)
+    migrated = sqlite3.connect(target)
+    assert migrated.execute('SELECT ordinal FROM batches ORDER BY pk')\
+            .fetchall() == [(0, ), (1, ), (2, )]
+    assert migrated.execute('PRAGMA user_version').fetchone() == \
+            (migrations.SCHEMA_VERSION, )
+    migrated.close()
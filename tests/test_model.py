@@ -0,0 +1,425 @@
+import sqlite3
+from datetime import datetime
+
+import numpy as np
+import pytest
+from sqlalchemy import event
+
+from BruggCablesKTI.db import bitsets, model
+from BruggCablesKTI.db.model import Batch, Opportunity
+
+from conftest import opportunity_records
+
+
+def add_batches(dbh, count, cables=1):
+    ''' ``cables`` cables of one opportunity with ``count`` batches each.
+    '''
+    opportunity_pks = dbh.bulk_upsert_opportunities(opportunity_records(1))
+    cable_pks = dbh.bulk_upsert_cables([{'opportunity_pk': opportunity_pks[0],
+        'kind': 'SEG', 'voltage': 220., 'area': 1000. + idx}
+        for idx in range(cables)])
+    batch_pks = dbh.bulk_upsert_batches([{'cable_pk': cable_pk,
+        'number': number, 'workload': 10.} for cable_pk in cable_pks
+        for number in range(count)])
+    return opportunity_pks[0], cable_pks, batch_pks
+
+
+def test_ordinals_are_not_reused(dbh):
+    opportunity_pk, (cable_pk, ), batch_pks = add_batches(dbh, 5)
+    schedule = dbh.add_schedule([(pk, None) for pk in batch_pks],
+            bitmap=True)
+
+    dbh.remove_batches(batch_pks[3:])
+    new_pks = dbh.bulk_upsert_batches([{'cable_pk': cable_pk,
+        'number': number} for number in range(3, 5)])
+    assert sorted(dbh.batch_ordinals(new_pks).values()) == [5, 6]
+
+    # the schedule still selects the remaining batches only
+    assert [batch.pk for batch in dbh.find_schedule(schedule.pk).batches] \
+            == batch_pks[:3]
+    assert bitsets.count(dbh.find_schedule(schedule.pk).membership) == 5
+
+
+def brugg_cables_ids(dbh):
+    return sorted(opportunity.brugg_cables_id
+            for opportunity in dbh.db.query(Opportunity))
+
+
+def test_nested_transaction_rolls_back_its_own_changes(dbh):
+    records = opportunity_records(4)
+    with dbh.transaction():
+        dbh.bulk_upsert_opportunities(records[:1])
+        with pytest.raises(RuntimeError):
+            with dbh.transaction():
+                dbh.bulk_upsert_opportunities(records[1:2])
+                raise RuntimeError
+        dbh.bulk_upsert_opportunities(records[2:3])
+    assert brugg_cables_ids(dbh) == [0, 2]
+
+    with pytest.raises(RuntimeError):
+        with dbh.transaction():
+            dbh.bulk_upsert_opportunities(records[3:])
+            with dbh.transaction():
+                dbh.remove_opportunity(0)
+            raise RuntimeError
+    assert brugg_cables_ids(dbh) == [0, 2]
+
+
+def test_failing_call_rolls_back_its_own_changes(dbh):
+    records = opportunity_records(3)
+    with dbh.transaction():
+        dbh.add_opportunity(**records[1])
+        with pytest.raises(model.InvalidEntry):
+            dbh.add_schedule([(None, None)])
+        dbh.add_opportunity(**records[2])
+    assert brugg_cables_ids(dbh) == [1, 2]
+    assert dbh.db.query(model.Schedule).count() == 0
+
+
+def test_selected_batches_of_both_first_selections(dbh):
+    opportunity_pk, cable_pks, batch_pks = add_batches(dbh, 3)
+    with_items = dbh.add_first_selection(batch_pks[:2], cluster_number=0)
+    (content_addressed, ) = dbh.add_first_selections_bulk([batch_pks[1:]],
+            cluster_number=0)
+
+    assert [batch.pk for batch in dbh.find_first_selection(
+        with_items.pk).selected_batches] == batch_pks[:2]
+    assert [batch.pk for batch in dbh.find_first_selection(
+        content_addressed).selected_batches] == batch_pks[1:]
+
+
+def test_first_selection_order(dbh):
+    opportunity_pk, cable_pks, batch_pks = add_batches(dbh, 4)
+    pks = [dbh.add_first_selection(batch_pks[idx:], cluster_number=0).pk
+            for idx in range(2)]
+    pks += dbh.add_first_selections_bulk([batch_pks[:idx + 1]
+        for idx in range(2)], cluster_number=0)
+
+    assert [pk for (pk, ) in dbh.select_first_selection(0)] == pks
+    assert dbh.first_selection_membership(0)['first_selections'].tolist() \
+            == pks
+
+
+def test_cache_hits_save_queries(dbh):
+    opportunity_pk, (cable_pk, ), batch_pks = add_batches(dbh, 1)
+    statements = []
+    event.listen(dbh.engine, 'before_cursor_execute',
+            lambda *args: statements.append(args[2]))
+
+    dbh.find_cable(cable_pk).length
+    dbh.find_cable(cable_pk).length
+    assert dbh.cache_info()['hits'] == 1
+    assert len(statements) == 1
+
+    # expired by the commit, the attributes are loaded again
+    dbh.commit()
+    dbh.find_cable(cable_pk).length
+    assert dbh.cache_info()['hits'] == 1
+    assert dbh.cache_info()['refreshes'] == 1
+    assert len(statements) == 2
+
+
+def test_for_url(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    dbh = model.DBHandler.for_url('sqlite:///shared.db')
+    assert model.DBHandler.for_url(
+            'sqlite:///' + str(tmp_path / 'shared.db')) is dbh
+    dbh.bulk_upsert_opportunities(opportunity_records(1))
+    assert dbh.find_opportunity(0).description == 'opportunity 0'
+
+    # committed by another connection
+    connection = sqlite3.connect('shared.db')
+    connection.execute("UPDATE opportunities SET description = 'changed'")
+    connection.commit()
+    connection.close()
+    assert model.DBHandler.for_url('sqlite:///shared.db')\
+            .find_opportunity(0).description == 'changed'
+
+    copy = model.DBHandler.open_in_memory('shared.db',
+            db_url='sqlite:///shared.db')
+    assert model.DBHandler.for_url('sqlite:///shared.db',
+            performance_profile='bulk_load') is copy
+    assert copy.db.execute('PRAGMA synchronous').scalar() == 0
+    copy.close()
+    dbh.close()
+
+
+def test_select_batch_timerange_loads_cable_batches(dbh):
+    opportunity_pk, cable_pks, batch_pks = add_batches(dbh, 3, cables=4)
+    dbh.db.execute(Batch.__table__.update().values(
+        delivery_date=datetime(2030, 1, 1)))
+    dbh.commit()
+    statements = []
+    event.listen(dbh.engine, 'before_cursor_execute',
+            lambda *args: statements.append(args[2]))
+
+    batches = dbh.select_batch_timerange(datetime(2029, 1, 1),
+            datetime(2031, 1, 1), opportunity=True, cable_batches=True)
+    assert sorted(len(batch.cable.batches) for batch in batches) == [3]*4
+    assert all(batch.cable.opportunity.pk == opportunity_pk
+            for batch in batches)
+    assert len(statements) == 2
+
+
+def test_find_batches_many_loads_opportunity_batches(dbh):
+    opportunity_pk, cable_pks, batch_pks = add_batches(dbh, 3, cables=4)
+    dbh.commit()
+    dbh.clear_lookup_cache()
+    statements = []
+    event.listen(dbh.engine, 'before_cursor_execute',
+            lambda *args: statements.append(args[2]))
+
+    (batch, ) = dbh.find_batches_many(batch_pks[:1], opportunity_batches=True)
+    assert sum(len(cable.batches)
+            for cable in batch.cable.opportunity.cables) == 12
+    assert len(statements) == 3
+
+
+def counts(dbh):
+    return dict((table, dbh.db.execute(
+        'SELECT count(*) FROM {}'.format(table)).scalar())
+        for table in ('opportunities', 'cables', 'batches', 'first_selections',
+            'first_selection_items', 'schedules', 'production_slots',
+            'opportunity_workloads'))
+
+
+def test_bulk_upsert_is_idempotent(dbh):
+    opportunity_pk, cable_pks, batch_pks = add_batches(dbh, 3, cables=2)
+    version = dbh.current_version()
+    before = counts(dbh)
+
+    assert dbh.bulk_upsert_opportunities(opportunity_records(1)) == \
+            [opportunity_pk]
+    assert dbh.bulk_upsert_batches([{'cable_pk': cable_pk,
+        'number': number, 'workload': 10.} for cable_pk in cable_pks
+        for number in range(3)]) == batch_pks
+    assert counts(dbh) == before
+    assert dbh.current_version() == version
+
+
+def test_remove_opportunities_cascades(dbh):
+    opportunity_pk, cable_pks, batch_pks = add_batches(dbh, 3, cables=2)
+    dbh.add_first_selection(batch_pks, cluster_number=0)
+    schedule = dbh.add_schedule([(pk, datetime(2030, 1, 1))
+        for pk in batch_pks])
+    assert counts(dbh)['production_slots'] == 6
+
+    dbh.remove_cables(cable_pks[:1])
+    assert counts(dbh)['batches'] == 3
+    assert counts(dbh)['first_selection_items'] == 3
+    assert counts(dbh)['production_slots'] == 3
+
+    dbh.remove_opportunities([0])
+    assert counts(dbh) == {'opportunities': 0, 'cables': 0, 'batches': 0,
+            'first_selections': 1, 'first_selection_items': 0,
+            'schedules': 1, 'production_slots': 0,
+            'opportunity_workloads': 0}
+
+
+def test_changed_since(dbh):
+    opportunity_pk, cable_pks, batch_pks = add_batches(dbh, 3)
+    version = dbh.current_version()
+    assert dbh.changed_since(version) == {'version': version,
+        'changed': {'opportunities': [], 'cables': [], 'batches': []},
+        'deleted': {'opportunities': [], 'cables': [], 'batches': []}}
+
+    dbh.bulk_upsert_batches([{'cable_pk': cable_pks[0], 'number': 0,
+        'workload': 20.}])
+    dbh.remove_batch(batch_pks[2])
+    changes = dbh.changed_since(version)
+    assert changes['version'] > version
+    assert changes['changed'] == {'opportunities': [], 'cables': [],
+            'batches': batch_pks[:1]}
+    assert changes['deleted'] == {'opportunities': [], 'cables': [],
+            'batches': batch_pks[2:]}
+    assert dbh.changed_since(changes['version'])['changed']['batches'] == []
+
+
+def workload_rows(dbh):
+    return [sorted(dbh.db.execute('SELECT * FROM {}'.format(table)))
+            for table in ('opportunity_workloads', 'monthly_workloads')]
+
+
+def assert_workloads_are_current(dbh):
+    maintained = workload_rows(dbh)
+    dbh.refresh_workloads()
+    assert workload_rows(dbh) == maintained
+
+
+def test_workloads_follow_the_writes(dbh):
+    opportunity_pks = dbh.bulk_upsert_opportunities(opportunity_records(2))
+    cable_pks = dbh.bulk_upsert_cables([{'opportunity_pk': pk, 'kind': 'SEG',
+        'voltage': 220., 'area': 1000. + idx, 'production_line': 'Line1'}
+        for pk in opportunity_pks for idx in range(2)])
+    batch_pks = dbh.bulk_upsert_batches([{'cable_pk': pk, 'number': number,
+        'workload': 10., 'delivery_date': datetime(2030, 1 + number, 1)}
+        for pk in cable_pks for number in range(3)])
+    assert dbh.opportunity_workloads() == dict((pk, 60.)
+            for pk in opportunity_pks)
+    assert_workloads_are_current(dbh)
+
+    # bulk upsert
+    dbh.bulk_upsert_batches([{'cable_pk': cable_pks[0], 'number': 0,
+        'workload': 20., 'delivery_date': datetime(2030, 6, 1)}])
+    assert dbh.opportunity_workloads()[opportunity_pks[0]] == 70.
+    assert_workloads_are_current(dbh)
+
+    # updates through the ORM, a cable moved to the other opportunity
+    dbh.update_or_create_batch(batch_pks[1], workload=5.)
+    dbh.update_or_create_cable(cable_pks[1], opportunity_pk=opportunity_pks[1])
+    assert dbh.opportunity_workloads() == {opportunity_pks[0]: 35.,
+            opportunity_pks[1]: 90.}
+    assert_workloads_are_current(dbh)
+
+    # a batch without cable doesn't count
+    dbh.update_or_create_batch(number=9, workload=100.)
+    assert_workloads_are_current(dbh)
+
+    # deletes
+    dbh.remove_batch(batch_pks[0])
+    dbh.remove_batches(batch_pks[6:8])
+    dbh.remove_cable(cable_pks[3])
+    assert dbh.opportunity_workloads() == {opportunity_pks[0]: 15.,
+            opportunity_pks[1]: 40.}
+    assert_workloads_are_current(dbh)
+    dbh.remove_opportunities([1])
+    assert list(dbh.opportunity_workloads()) == [opportunity_pks[0]]
+    assert_workloads_are_current(dbh)
+
+
+def test_workloads_of_a_flushed_working_copy(dbh, db_file, tmp_path):
+    opportunity_pk, cable_pks, batch_pks = add_batches(dbh, 3, cables=2)
+    dbh.close()
+
+    copy = model.DBHandler.open_in_memory(db_file)
+    copy.bulk_upsert_batches([{'cable_pk': cable_pks[0], 'number': 3,
+        'workload': 10., 'delivery_date': datetime(2030, 1, 1)}])
+    copy.remove_batches(batch_pks[:2])
+    assert_workloads_are_current(copy)
+    expected = workload_rows(copy)
+    flushed = str(tmp_path / 'flushed.db')
+    copy.flush_to(flushed)
+    copy.close()
+
+    handler = model.DBHandler('sqlite:///' + flushed)
+    assert handler.opportunity_workloads() == {opportunity_pk: 50.}
+    assert workload_rows(handler) == expected
+    assert_workloads_are_current(handler)
+    handler.close()
+
+
+def test_load_batch_arrays(dbh):
+    opportunity_pk, cable_pks, batch_pks = add_batches(dbh, 2)
+    dbh.bulk_upsert_batches([{'cable_pk': cable_pks[0], 'number': 0,
+        'workload': 10., 'delivery_date': datetime(1970, 1, 2, 3),
+        'potential_type': 'batch'}])
+    orphan = Batch(number=5)
+    dbh.db.add(orphan)
+    dbh.commit()
+
+    arrays = dbh.load_batch_arrays()
+    rows = dict((pk, idx) for (idx, pk) in enumerate(arrays['pk']))
+    first, second, orphan = rows[batch_pks[0]], rows[batch_pks[1]], \
+            rows[orphan.pk]
+    assert arrays['delivery_date'][[first, second, orphan]].tolist() == \
+            [27, model.MISSING_HOURS, model.MISSING_HOURS]
+    assert dbh.load_batch_arrays(epoch=datetime(1970, 1, 2))\
+            ['delivery_date'][first] == 3
+    assert arrays['potential_type'][[first, second]].tolist() == [2, -1]
+    assert arrays['cable_kind'][[first, orphan]].tolist() == [0, -1]
+    assert arrays['cable_production_line'][first] == -1
+    assert arrays['cable'][orphan] == arrays['opportunity'][orphan] == -1
+    assert arrays['cable_pks'][arrays['cable'][first]] == cable_pks[0]
+    assert arrays['opportunity_pks'][arrays['opportunity'][second]] == \
+            opportunity_pk
+    assert arrays['workload'][first] == 10.
+    assert np.isnan(arrays['workload'][orphan])
+
+
+def stored_schedule(dbh, schedule_pk):
+    slots = sorted(dbh.db.query(model.ProductionSlot.batch_pk,
+        model.ProductionSlot.end_time)\
+        .filter(model.ProductionSlot.schedule_pk == schedule_pk))
+    (membership, ) = dbh.db.query(model.Schedule.membership)\
+            .filter(model.Schedule.pk == schedule_pk).one()
+    return slots, membership
+
+
+@pytest.mark.parametrize('bitmap', [False, True])
+def test_add_schedules_bulk_writes_what_add_schedule_writes(dbh, bitmap):
+    opportunity_pk, cable_pks, batch_pks = add_batches(dbh, 4)
+    schedules = [[(pk, datetime(2030, 1, 1 + idx)) for pk in batch_pks[:idx]]
+            + [(pk, None) for pk in batch_pks[idx:]] for idx in range(5)]
+    expected = [stored_schedule(dbh, dbh.add_schedule(slots, bitmap=bitmap).pk)
+            for slots in schedules]
+
+    # several chunks of production slots
+    pks = dbh.add_schedules_bulk((slots for slots in schedules),
+            chunk_size=6, bitmap=bitmap)
+    assert len(pks) == len(set(pks)) == len(schedules)
+    assert [stored_schedule(dbh, pk) for pk in pks] == expected
+    assert len(dbh.schedules) == 2 * len(schedules)
+
+
+def test_schedule_rows(dbh):
+    opportunity_pk, cable_pks, batch_pks = add_batches(dbh, 3)
+    parents = {'cable_pk': cable_pks[0], 'cable_kind': 'SEG',
+        'cable_voltage': 220., 'cable_area': 1000.,
+        'opportunity_pk': opportunity_pk, 'opportunity_id': 0,
+        'opportunity_kind': 'offer', 'opportunity_revenue': 10000.,
+        'opportunity_margin': 1000., 'opportunity_probability': .5}
+
+    # timed slots, in the order they were added
+    end_times = [datetime(2030, 1, 3), datetime(2030, 1, 1)]
+    schedule = dbh.add_schedule(list(zip(batch_pks[::-1], end_times)))
+    rows = dbh.schedule_rows(schedule.pk)
+    assert [(row['batch_pk'], row['batch_number'], row['end_time'])
+            for row in rows] == [(batch_pks[2], 2, end_times[0]),
+                    (batch_pks[1], 1, end_times[1])]
+    for row in rows:
+        assert row['slot_pk'] is not None
+        assert dict((key, row[key]) for key in parents) == parents
+
+    # a bitmap schedule without slots lists its batches
+    schedule = dbh.add_schedule([(pk, None) for pk in batch_pks],
+            bitmap=True)
+    rows = dbh.schedule_rows(schedule.pk)
+    assert [row['batch_pk'] for row in rows] == batch_pks
+    for row in rows:
+        assert row['slot_pk'] is None and row['end_time'] is None
+        assert row['workload'] == 10.
+        assert dict((key, row[key]) for key in parents) == parents
+
+    schedule_pk = schedule.pk
+    dbh.remove_schedules([schedule_pk])
+    with pytest.raises(model.MissingEntry):
+        dbh.schedule_rows(schedule_pk)
+
+
+def test_iter_batches_expunges_the_previous_chunks(dbh):
+    opportunity_pk, cable_pks, batch_pks = add_batches(dbh, 7)
+    yielded = []
+    for batch in dbh.iter_batches(chunk_size=3):
+        yielded.append(batch)
+        if len(yielded) == 2:
+            batch.workload = 20.
+        # the current chunk and the modified batch
+        start = (len(yielded) - 1) // 3 * 3
+        assert [obj in dbh.db for obj in yielded] == \
+                [start <= idx or idx == 1 for idx in range(len(yielded))]
+    assert [obj in dbh.db for obj in yielded] == \
+            [idx == 1 for idx in range(7)]
+    assert sorted(batch.pk for batch in yielded) == sorted(batch_pks)
+
+
+def test_iter_chunked_yields_every_row_once(dbh):
+    opportunity_pk, cable_pks, batch_pks = add_batches(dbh, 4)
+    dbh.add_first_selection(batch_pks, cluster_number=0)
+    schedule_pks = dbh.add_schedules_bulk([[(pk, None)] for pk in batch_pks]
+            + [[]])
+    assert sorted((item.first_selection_pk, item.batch_pk) for item in
+            dbh.iter_first_selection_items(chunk_size=3)) == \
+            sorted((item.first_selection_pk, item.batch_pk) for item in
+                dbh.db.query(model.FirstSelectionItem))
+    assert sorted(schedule.pk for schedule in
+            dbh.iter_schedules(chunk_size=3)) == sorted(schedule_pks)
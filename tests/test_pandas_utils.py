@@ -0,0 +1,32 @@
+import os
+
+import pandas as pd
+
+from BruggCablesKTI.db import pandas_utils
+
+from conftest import opportunity_records
+
+
+def snapshots(dbh):
+    return sorted(os.listdir(pandas_utils.snapshot_directory(dbh)))
+
+
+def test_writes_invalidate_the_snapshot(dbh):
+    dbh.bulk_upsert_opportunities(opportunity_records(2))
+    df = pandas_utils.get_opportunities_as_df(dbh)
+    (snapshot, ) = snapshots(dbh)
+
+    # unchanged data is read from the snapshot
+    pd.testing.assert_frame_equal(pandas_utils.get_opportunities_as_df(dbh),
+            df)
+    assert snapshots(dbh) == [snapshot]
+
+    dbh.bulk_upsert_opportunities(opportunity_records(3))
+    df = pandas_utils.get_opportunities_as_df(dbh)
+    assert sorted(df.brugg_cables_id) == [0, 1, 2]
+    assert len(snapshots(dbh)) == 1
+    assert snapshots(dbh) != [snapshot]
+
+    dbh.remove_opportunity(0)
+    assert sorted(pandas_utils.get_opportunities_as_df(dbh).brugg_cables_id) \
+            == [1, 2]
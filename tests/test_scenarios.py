@@ -0,0 +1,74 @@
+import sqlite3
+
+import pytest
+
+from BruggCablesKTI.db import model
+
+from conftest import opportunity_records
+
+
+@pytest.fixture
+def base_file(db_file):
+    ''' A base database file with a few opportunities.
+    '''
+    dbh = model.DBHandler('sqlite:///' + db_file)
+    dbh.bulk_upsert_opportunities(opportunity_records(3))
+    dbh.close()
+    return db_file
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_base_is_not_written(base_file):
+    content = read(base_file)
+    scenario = model.DBHandler.open_scenario(base_file)
+    scenario.remove_opportunity(0)
+    scenario.close()
+    assert read(base_file) == content
+
+
+def test_outdated_base_is_refused(base_file):
+    connection = sqlite3.connect(base_file)
+    connection.execute('PRAGMA user_version = 0')
+    connection.commit()
+    connection.close()
+    content = read(base_file)
+    with pytest.raises(model.OutdatedSchema):
+        model.DBHandler.open_scenario(base_file)
+    assert read(base_file) == content
+
+
+def descriptions(dbh):
+    return sorted((opportunity.brugg_cables_id, opportunity.description)
+            for opportunity in dbh.opportunities)
+
+
+def test_scenario_writes_are_isolated(base_file, tmp_path):
+    first = model.DBHandler.open_scenario(base_file,
+            str(tmp_path / 'first.db'))
+    second = model.DBHandler.open_scenario(base_file)
+    first.bulk_upsert_opportunities([{'brugg_cables_id': 0,
+        'description': 'changed'}, {'brugg_cables_id': 9,
+        'description': 'added'}])
+    first.remove_opportunity(1)
+
+    assert descriptions(first) == [(0, 'changed'), (2, 'opportunity 2'),
+            (9, 'added')]
+    assert first.scenario_changes()['opportunities'] == (2, 1)
+    expected = [(idx, 'opportunity {}'.format(idx)) for idx in range(3)]
+    assert descriptions(second) == expected
+    base = model.DBHandler('sqlite:///' + base_file)
+    assert descriptions(base) == expected
+    base.close()
+    second.close()
+
+    # an overlay file continues its scenario
+    first.close()
+    first = model.DBHandler.open_scenario(base_file,
+            str(tmp_path / 'first.db'))
+    assert descriptions(first) == [(0, 'changed'), (2, 'opportunity 2'),
+            (9, 'added')]
+    first.close()
@@ -0,0 +1,41 @@
+import pytest
+
+from BruggCablesKTI.db import model
+from BruggCablesKTI.db.writer import DBWriter
+
+from conftest import opportunity_records
+
+
+def test_stop_returns_the_failed_requests(dbh, db_file):
+    (opportunity_pk, ) = dbh.bulk_upsert_opportunities(opportunity_records(1))
+    (cable_pk, ) = dbh.bulk_upsert_cables([{'opportunity_pk': opportunity_pk}])
+    batch_pks = dbh.bulk_upsert_batches([{'cable_pk': cable_pk,
+        'number': number} for number in range(3)])
+
+    writer = DBWriter('sqlite:///' + db_file)
+    writer.start()
+    writer.add_schedule([(pk, None) for pk in batch_pks])
+    writer.add_schedule([(None, None)])
+    failures = writer.stop()
+
+    assert [failure[:3] for failure in failures] == \
+            [('add_schedule', ([(None, None)], ), {})]
+    assert len(dbh.schedules) == 1
+
+
+def test_context_raises_on_failed_requests(db_file):
+    model.DBHandler('sqlite:///' + db_file).close()
+    with pytest.raises(RuntimeError):
+        with DBWriter('sqlite:///' + db_file) as writer:
+            writer.add_schedule([(None, None)])
+
+
+def test_stop_times_out(db_file):
+    model.DBHandler('sqlite:///' + db_file).close()
+    writer = DBWriter('sqlite:///' + db_file)
+    writer.start()
+    writer.add_schedule([(None, None)])
+    # the process is still starting
+    with pytest.raises(TimeoutError):
+        writer.stop(timeout=0.)
+    assert [failure[0] for failure in writer.stop()] == ['add_schedule']